@@ -0,0 +1,135 @@
+"""
+Compares the generated model codecs with the generic field-by-field conversion they replace, and with lazy instances
+(`Queryset.lazy`) when only a couple of fields are read.
+
+    python benchmarks/bench_codecs.py [--rows N] [--repeat N]
+
+No database connection is needed.
+"""
+import argparse
+import enum
+import timeit
+from contextlib import contextmanager
+from functools import partial
+
+from resync import codecs, fields
+from resync.models import Model, ModelBase, NestedDocument
+
+
+class Color(enum.IntEnum):
+    red = 1
+    blue = 2
+
+
+class Grommet(NestedDocument):
+    weight = fields.FloatField()
+    enabled = fields.BooleanField(default=False)
+    label = fields.StrField()
+
+
+class Part(NestedDocument):
+    name = fields.StrField()
+    grommet = fields.NestedDocumentField(Grommet)
+    grommets = fields.ListField(fields.NestedDocumentField(Grommet))
+
+
+class Owner(Model):
+    id = fields.StrField()
+
+
+def _wide_model_attrs():
+    attrs = {'id': fields.StrField(), 'owner': fields.ForeignKeyField(Owner), 'blob': fields.DictField()}
+    for i in range(8):
+        attrs['name_{}'.format(i)] = fields.StrField()
+        attrs['count_{}'.format(i)] = fields.IntField(default=0)
+        attrs['weight_{}'.format(i)] = fields.FloatField()
+        attrs['enabled_{}'.format(i)] = fields.BooleanField(default=False)
+    attrs['color'] = fields.IntEnumField(Color, default=Color.red)
+    attrs['created'] = fields.DateTimeField()
+    return attrs
+
+WideWidget = ModelBase('WideWidget', (Model,), _wide_model_attrs())
+
+
+class NestedWidget(Model):
+    id = fields.StrField()
+    part = fields.NestedDocumentField(Part)
+    parts = fields.ListField(fields.NestedDocumentField(Part))
+    tags = fields.ListField(fields.StrField())
+
+
+def wide_document(i):
+    document = {'id': str(i), 'owner': 'owner-{}'.format(i % 10), 'blob': {'a': i}, 'color': 2,
+                'created': '2016-06-08T12:00:00+00:00'}
+    for j in range(8):
+        document['name_{}'.format(j)] = 'name {}'.format(i)
+        document['count_{}'.format(j)] = i
+        document['weight_{}'.format(j)] = i / 3
+        if j % 2:
+            document['enabled_{}'.format(j)] = True  # Leave the others missing, to exercise the defaults
+    return document
+
+
+def nested_document(i):
+    grommet = {'weight': i / 7, 'enabled': True, 'label': 'g'}
+    part = {'name': 'part {}'.format(i), 'grommet': grommet, 'grommets': [grommet] * 3}
+    return {'id': str(i), 'part': part, 'parts': [part] * 4, 'tags': ['a', 'b', 'c']}
+
+
+@contextmanager
+def generic_codecs(*classes):
+    """
+    Temporarily switch the given classes back to the generic conversion, so nested documents use it too.
+    """
+    saved = [(cls, cls.__dict__['_decode'], cls.__dict__['_encode']) for cls in classes]
+    for cls in classes:
+        cls._decode = staticmethod(partial(codecs.generic_decode, cls))
+        cls._encode = staticmethod(codecs.generic_encode)
+    try:
+        yield
+    finally:
+        for cls, decode, encode in saved:
+            cls._decode = decode
+            cls._encode = encode
+
+
+def read_two_fields(instance):
+    return instance.id, instance.name_0
+
+
+def bench(label, function, documents, repeat):
+    def run():
+        for document in documents:
+            function(document)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    print('{:<40} {:>10.2f} us/row'.format(label, best / len(documents) * 1e6))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for model, make_document in ((WideWidget, wide_document), (NestedWidget, nested_document)):
+        documents = [make_document(i) for i in range(args.rows)]
+        instances = [model.from_db(document) for document in documents]
+        print(model.__name__)
+        with generic_codecs(model, Part, Grommet):
+            generic_decode = bench('  from_db (generic)', model.from_db, documents, args.repeat)
+            generic_encode = bench('  to_db (generic)', model.to_db, instances, args.repeat)
+        generated_decode = bench('  from_db (generated)', model.from_db, documents, args.repeat)
+        generated_encode = bench('  to_db (generated)', model.to_db, instances, args.repeat)
+        print('  from_db speedup: {:.2f}x'.format(generic_decode / generated_decode))
+        print('  to_db speedup: {:.2f}x'.format(generic_encode / generated_encode))
+        if model is WideWidget:
+            eager = bench('  from_db, read 2 fields', lambda document: read_two_fields(model.from_db(document)),
+                          documents, args.repeat)
+            lazy = bench('  from_db_lazy, read 2 fields', lambda document: read_two_fields(model.from_db_lazy(document)),
+                         documents, args.repeat)
+            print('  lazy speedup: {:.2f}x'.format(eager / lazy))
+
+
+if __name__ == '__main__':
+    main()
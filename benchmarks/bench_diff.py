@@ -0,0 +1,108 @@
+"""
+Compares the diffs given with changes (`resync.diff.get_diff_from_changeset`) with running dictdiffer over every
+change, on a stream of changefeed events: mostly a few top level fields changing, some nested changes, inserts and
+deletes.
+
+    python benchmarks/bench_diff.py [--changes N] [--repeat N]
+
+No database connection is needed.
+"""
+import argparse
+import random
+import timeit
+
+import dictdiffer
+
+from resync.diff import DiffObject, create, delete, get_diff_from_changeset
+
+
+def make_document(i):
+    return {
+        'id': str(i),
+        'owner': 'owner-{}'.format(i % 50),
+        'name': 'widget {}'.format(i),
+        'status': 'active',
+        'count': i,
+        'score': i / 3,
+        'enabled': True,
+        'created': '2016-06-08T12:00:00+00:00',
+        'updated': '2016-06-08T12:00:00+00:00',
+        'address': {'street': '{} Main St'.format(i), 'city': 'Springfield', 'zip': '12345'},
+        'settings': {'theme': 'dark', 'notifications': {'email': True, 'sms': False}},
+        'tags': ['red', 'green', 'blue'],
+        'history': [{'at': '2016-06-08T12:00:00+00:00', 'count': n} for n in range(5)],
+    }
+
+
+def make_changes(n, seed=0):
+    rnd = random.Random(seed)
+    changes = []
+    for i in range(n):
+        old = make_document(i)
+        new = make_document(i)
+        kind = rnd.random()
+        if kind < 0.6:
+            new['count'] += 1
+            new['updated'] = '2016-06-08T12:00:01+00:00'
+            if rnd.random() < 0.3:
+                new['status'] = 'idle'
+        elif kind < 0.75:
+            new['settings']['notifications']['sms'] = True
+        elif kind < 0.85:
+            new['history'].append({'at': '2016-06-08T12:00:01+00:00', 'count': 5})
+        elif kind < 0.95:
+            old = None
+        else:
+            new = None
+        changes.append({'old_val': old, 'new_val': new})
+    return changes
+
+
+def dictdiffer_diff(changeset):
+    """
+    What get_diff_from_changeset used to do.
+    """
+    old, new = changeset['old_val'], changeset['new_val']
+    if old is None:
+        return create
+    if new is None:
+        return delete
+    return [DiffObject(*x) for x in dictdiffer.diff(old, new)]
+
+
+def read_diff(changeset):
+    diff = get_diff_from_changeset(changeset)
+    if diff is not create and diff is not delete:
+        len(diff)
+    return diff
+
+
+def bench(label, function, changes, repeat):
+    def run():
+        for change in changes:
+            function(change)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    print('{:<40} {:>10.2f} us/change'.format(label, best / len(changes) * 1e6))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--changes', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    changes = make_changes(args.changes)
+    for change in changes:
+        diff, expected = read_diff(change), dictdiffer_diff(change)
+        assert diff is expected if expected in (create, delete) else diff == expected
+
+    eager = bench('dictdiffer', dictdiffer_diff, changes, args.repeat)
+    unread = bench('get_diff_from_changeset, not read', get_diff_from_changeset, changes, args.repeat)
+    read = bench('get_diff_from_changeset, read', read_diff, changes, args.repeat)
+    print('speedup when the diff is read: {:.2f}x'.format(eager / read))
+    print('speedup when the diff is not read: {:.2f}x'.format(eager / unread))
+
+
+if __name__ == '__main__':
+    main()
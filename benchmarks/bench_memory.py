@@ -0,0 +1,99 @@
+"""
+Measures the memory taken by model instances decoded from documents, with and without `compact = True`, and with
+the snapshots kept for `save()` (`track_changes = True`).
+
+    python benchmarks/bench_memory.py [--rows N]
+
+No database connection is needed.
+"""
+import argparse
+import gc
+import tracemalloc
+
+from resync import fields
+from resync.models import Model, NestedDocument, setup
+
+
+class Part(NestedDocument):
+    name = fields.StrField()
+    weight = fields.FloatField()
+
+
+class CompactPart(NestedDocument):
+    compact = True
+    name = fields.StrField()
+    weight = fields.FloatField()
+
+
+class Widget(Model):
+    id = fields.StrField()
+    name = fields.StrField()
+    count = fields.IntField(default=0)
+    enabled = fields.BooleanField(default=False)
+    created = fields.DateTimeField()
+    part = fields.NestedDocumentField(Part)
+
+
+class CompactWidget(Model):
+    compact = True
+    id = fields.StrField()
+    name = fields.StrField()
+    count = fields.IntField(default=0)
+    enabled = fields.BooleanField(default=False)
+    created = fields.DateTimeField()
+    part = fields.NestedDocumentField(CompactPart)
+
+
+class TrackedCompactWidget(Model):
+    compact = True
+    track_changes = True
+    id = fields.StrField()
+    name = fields.StrField()
+    count = fields.IntField(default=0)
+    enabled = fields.BooleanField(default=False)
+    created = fields.DateTimeField()
+    part = fields.NestedDocumentField(CompactPart)
+
+
+class Gadget(Model):
+    """
+    Gives both widget models a reverse relation, which regular instances hold a queryset for.
+    """
+    id = fields.StrField()
+    widget = fields.ForeignKeyField(Widget)
+    compact_widget = fields.ForeignKeyField(CompactWidget)
+
+
+def document(i):
+    return {'id': str(i), 'name': 'widget {}'.format(i), 'count': i, 'enabled': bool(i % 2),
+            'created': '2016-06-08T12:00:00+00:00', 'part': {'name': 'part {}'.format(i), 'weight': i / 3}}
+
+
+def measure(model, rows):
+    """
+    Returns the number of bytes allocated to hold the decoded instances, including documents kept alive by them.
+    """
+    gc.collect()
+    tracemalloc.start()
+    instances = [model.from_db(document(i)) for i in range(rows)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del instances
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000)
+    args = parser.parse_args()
+    setup()
+
+    regular = measure(Widget, args.rows)
+    print('{:<28} {:>10.0f} bytes/row'.format('regular', regular / args.rows))
+    for label, model in (('compact', CompactWidget), ('compact, track_changes=True', TrackedCompactWidget)):
+        size = measure(model, args.rows)
+        print('{:<28} {:>10.0f} bytes/row ({:.0%} of regular)'.format(label, size / args.rows, size / regular))
+
+
+if __name__ == '__main__':
+    main()
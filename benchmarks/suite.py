@@ -0,0 +1,268 @@
+"""
+Benchmarks of resync's own overhead, with queries answered in-process by resync.testing's stand-in connections
+instead of a server: decoding and encoding wide and nested models, iterating over querysets and exporting them to
+columns, handling the changes returned by `update`, dispatching changefeed changes through a ChangeListener, and the
+connection pool under contention.
+
+    python benchmarks/suite.py [--repeat N] [--scale X] [--only PREFIX ...] [--output results.json]
+                               [--compare baseline.json] [--threshold PERCENT]
+
+Each benchmark reports the best time per operation over `--repeat` runs.  `--output` saves the results as JSON, and
+`--compare` shows the change from results saved earlier, e.g. by the previous release, exiting with status 1 if any
+benchmark got slower by more than `--threshold` percent.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import timeit
+from collections import OrderedDict
+
+import resync
+from resync import fields
+from resync.connection import ConnectionPool
+from resync.listener import ChangeListener
+from resync.models import Model
+from resync.testing import FakeConnector, FakeCursor, get_table, get_term_name
+
+from bench_codecs import NestedWidget, WideWidget, nested_document, wide_document
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """
+    Register a benchmark.  The function is called with the scale and returns the number of operations in a run and a
+    function doing a run.
+    """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+class Gizmo(Model):
+    id = fields.StrField()
+    name = fields.StrField()
+    count = fields.IntField(default=0)
+    enabled = fields.BooleanField(default=False)
+    created = fields.DateTimeField()
+
+
+def gizmo_document(i):
+    return {'id': str(i), 'name': 'gizmo {}'.format(i), 'count': i, 'enabled': bool(i % 2),
+            'created': '2016-06-08T12:00:00+00:00'}
+
+
+# Results of the queries on each table, set up by the benchmarks
+responses = {}
+
+
+def respond(query, options):
+    name = get_term_name(query)
+    response = responses[get_table(query), name]
+    if name == 'CHANGES':
+        return FakeCursor(response, endless=True)
+    if name in ('TABLE', 'FILTER', 'PLUCK'):
+        return FakeCursor(response)
+    return response
+
+
+def run_async(coroutine_function):
+    loop = asyncio.get_event_loop()
+    return lambda: loop.run_until_complete(coroutine_function())
+
+
+def _codec_benchmark(model, make_document, n_rows, encode):
+    documents = [make_document(i) for i in range(n_rows)]
+    instances = [model.from_db(document) for document in documents]
+
+    def run():
+        if encode:
+            for instance in instances:
+                model.to_db(instance)
+        else:
+            for document in documents:
+                model.from_db(document)
+    return n_rows, run
+
+
+@benchmark('codecs.from_db.wide')
+def from_db_wide(scale):
+    return _codec_benchmark(WideWidget, wide_document, int(5000 * scale), encode=False)
+
+
+@benchmark('codecs.to_db.wide')
+def to_db_wide(scale):
+    return _codec_benchmark(WideWidget, wide_document, int(5000 * scale), encode=True)
+
+
+@benchmark('codecs.from_db.nested')
+def from_db_nested(scale):
+    return _codec_benchmark(NestedWidget, nested_document, int(2000 * scale), encode=False)
+
+
+@benchmark('codecs.to_db.nested')
+def to_db_nested(scale):
+    return _codec_benchmark(NestedWidget, nested_document, int(2000 * scale), encode=True)
+
+
+@benchmark('queryset.iterate')
+def iterate_queryset(scale):
+    n_rows = int(20000 * scale)
+    responses['gizmo', 'TABLE'] = [gizmo_document(i) for i in range(n_rows)]
+
+    async def run():
+        async for gizmo in Gizmo.objects.all():
+            pass
+    return n_rows, run_async(run)
+
+
+@benchmark('queryset.await')
+def await_queryset(scale):
+    n_rows = int(20000 * scale)
+    responses['gizmo', 'FILTER'] = [gizmo_document(i) for i in range(n_rows)]
+
+    async def run():
+        await Gizmo.objects.filter(enabled=True)
+    return n_rows, run_async(run)
+
+
+@benchmark('queryset.to_columns')
+def queryset_to_columns(scale):
+    n_rows = int(20000 * scale)
+    responses['gizmo', 'PLUCK'] = [gizmo_document(i) for i in range(n_rows)]
+
+    async def run():
+        await Gizmo.objects.to_columns(['count', 'enabled', 'created'])
+    return n_rows, run_async(run)
+
+
+@benchmark('queryset.update')
+def update_queryset(scale):
+    n_rows = int(5000 * scale)
+    changes = []
+    for i in range(n_rows):
+        old, new = gizmo_document(i), gizmo_document(i)
+        new['count'] += 1
+        changes.append({'old_val': old, 'new_val': new})
+    responses['gizmo', 'UPDATE'] = {'replaced': n_rows, 'unchanged': 0, 'inserted': 0, 'deleted': 0, 'skipped': 0,
+                                    'errors': 0, 'changes': changes}
+
+    async def run():
+        for gizmo, diff in await Gizmo.objects.all().update(count=1):
+            len(diff)
+    return n_rows, run_async(run)
+
+
+@benchmark('listener.dispatch')
+def dispatch_changes(scale):
+    n_changes = int(10000 * scale)
+    changes = []
+    for i in range(n_changes):
+        old, new = gizmo_document(i % 100), gizmo_document(i % 100)
+        new['count'] = i
+        changes.append({'old_val': old, 'new_val': new})
+    responses['gizmo', 'CHANGES'] = changes
+
+    async def run():
+        received = []
+        done = asyncio.Event()
+
+        async def callback(gizmo, diff):
+            received.append(gizmo)
+            if len(received) == n_changes:
+                done.set()
+        listener = asyncio.ensure_future(ChangeListener(Gizmo.objects.all(), callback, concurrency=4).listen())
+        await done.wait()
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+    return n_changes, run_async(run)
+
+
+@benchmark('pool.contention')
+def pool_contention(scale):
+    n_tasks, n_acquires = 64, int(50 * scale)
+    pool = ConnectionPool()
+    pool.set_config({'db': 'bench'}, min_size=4, max_size=4)
+    FakeConnector(respond, pool=pool).install()
+
+    async def use_connections():
+        for _ in range(n_acquires):
+            conn = await pool.get_conn()
+            await asyncio.sleep(0)
+            await pool.put_conn(conn)
+
+    async def run():
+        await asyncio.gather(*[use_connections() for _ in range(n_tasks)])
+    return n_tasks * n_acquires, run_async(run)
+
+
+def run_benchmarks(names, scale, repeat):
+    results = OrderedDict()
+    for name in names:
+        n_operations, run = BENCHMARKS[name](scale)
+        run()  # Warm up, e.g. the query cache
+        best = min(timeit.repeat(run, number=1, repeat=repeat))
+        results[name] = {'operations': n_operations, 'best': best, 'us_per_op': best / n_operations * 1e6}
+        print('{:<28} {:>10.2f} us/op'.format(name, results[name]['us_per_op']))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of each benchmark from the baseline.  Returns the names of the benchmarks which got slower by
+    more than `threshold` percent.
+    """
+    regressions = []
+    print('\n{:<28} {:>12} {:>12} {:>9}'.format('benchmark', 'baseline', 'current', 'change'))
+    for name, result in results.items():
+        if name not in baseline:
+            print('{:<28} {:>12} {:>12.2f}'.format(name, '-', result['us_per_op']))
+            continue
+        before = baseline[name]['us_per_op']
+        change = (result['us_per_op'] - before) / before * 100
+        flag = ''
+        if change > threshold:
+            flag = '  slower'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  faster'
+        print('{:<28} {:>12.2f} {:>12.2f} {:>+8.1f}%{}'.format(name, before, result['us_per_op'], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the size of each benchmark')
+    parser.add_argument('--only', nargs='*', default=None, help='Run the benchmarks with names starting with these')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='Compare with results saved by --output')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent slower counted as a regression')
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.only or any(name.startswith(prefix) for prefix in args.only)]
+    with FakeConnector(respond):
+        resync.setup({'db': 'bench'})
+        try:
+            results = run_benchmarks(names, args.scale, args.repeat)
+        finally:
+            asyncio.get_event_loop().run_until_complete(resync.teardown())
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'scale': args.scale, 'repeat': args.repeat,
+                       'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != args.scale:
+            print('\nWarning: the baseline was run with --scale {}'.format(baseline.get('scale')))
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
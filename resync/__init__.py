@@ -4,18 +4,36 @@ from typing import Mapping
 import asyncio
 
 from resync import models
+from resync.cache import stop_caches
 from resync.connection import connection_pool
+from resync.hub import changefeed_hub
+from resync.identity import identity_scope
+from resync.models import ensure_indexes
+from resync.queryset import gather
+from resync.replica import stop_replicas
+
+__all__ = ['setup', 'teardown', 'ResyncConfiguration', 'changefeed_hub', 'ensure_indexes', 'gather', 'identity_scope']
 
 l = logging.getLogger('resync')
 l.addHandler(logging.NullHandler())
 
 
-def setup(config: Mapping[str, str]):
-    connection_pool.set_config(config)
+def setup(config: Mapping[str, str], warmup: bool=False, **pool_options):
+    """
+    Configure resync.  `config` is passed to rethinkdb.connect, and `pool_options` to the connection pool (see
+    ConnectionPool.DEFAULT_OPTIONS).  If `warmup` is True, the pool starts opening its minimum number of connections
+    concurrently, and the returned future can be awaited to wait until they're open.
+    """
+    connection_pool.set_config(config, **pool_options)
     models.setup()
+    if warmup:
+        return asyncio.ensure_future(connection_pool.warmup())
 
 
 async def teardown():
+    await stop_caches()
+    await stop_replicas()
+    await changefeed_hub.close()
     await connection_pool.teardown()
 
 
@@ -24,11 +42,16 @@ class ResyncConfiguration:
     Contextmanager helper to ensure proper cleanup of resources.
     """
 
-    def __init__(self, config: Mapping[str, str]):
+    def __init__(self, config: Mapping[str, str], warmup: bool=False, **pool_options):
         self.config = config
+        self.warmup = warmup
+        self.pool_options = pool_options
 
     def __enter__(self):
-        setup(self.config)
+        warmup = setup(self.config, self.warmup, **self.pool_options)
+        loop = asyncio.get_event_loop()
+        if warmup is not None and not loop.is_running():
+            loop.run_until_complete(warmup)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         loop = asyncio.get_event_loop()
@@ -37,7 +60,9 @@ class ResyncConfiguration:
             loop.run_until_complete(fut)
 
     async def __aenter__(self):
-        setup(self.config)
+        warmup = setup(self.config, self.warmup, **self.pool_options)
+        if warmup is not None:
+            await warmup
 
     async def __aexit__(self, exc_type, exc_value, traceback):
         await teardown()
@@ -0,0 +1,44 @@
+"""
+Command line helpers, e.g. to create the secondary indexes declared on the models in `myapp.models`:
+    python -m resync ensure_indexes myapp.models --host my.rethinkdb.fqdn --db my_database_name
+"""
+import argparse
+import asyncio
+import importlib
+
+import resync
+
+
+def ensure_indexes(args):
+    for module_name in args.modules:
+        importlib.import_module(module_name)  # Defining the models registers them
+    config = {key: getattr(args, key) for key in ('host', 'port', 'db', 'user', 'password')
+              if getattr(args, key) is not None}
+
+    async def run():
+        async with resync.ResyncConfiguration(config):
+            await resync.ensure_indexes()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+COMMANDS = {
+    'ensure_indexes': ensure_indexes,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m resync')
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('modules', nargs='+', help='Modules to import to define the models')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--db')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    args = parser.parse_args()
+    COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+Aggregates computed by the server, so that only their values are sent back rather than every document, e.g.:
+
+    await Widget.objects.filter(enabled=True).count()
+    await Widget.objects.aggregate(total=Sum('weight'), heaviest=Max('weight'))
+    await Widget.objects.group_by('owner').count()  # {owner id: number of widgets}
+"""
+import asyncio
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import rethinkdb as r
+
+from resync.connection import DatabaseQuery, QueryFunction, QueryRunner
+
+
+class Aggregate:
+    """
+    Base class for aggregates, see Queryset.aggregate.
+    """
+
+    # The value for an empty sequence, which the server refuses to aggregate if `fails_when_empty`
+    empty_value = None
+    fails_when_empty = False
+
+    def __init__(self, field_name: Optional[str]=None):
+        self.field_name = field_name
+
+    def get_queries(self) -> Tuple[DatabaseQuery, ...]:
+        """
+        The queries turning a sequence of documents (or grouped documents) into the aggregate's value.
+        """
+        raise NotImplementedError()
+
+    def decode(self, model, value):
+        return value
+
+    def get_grouped_queries(self) -> Tuple[DatabaseQuery, ...]:
+        """
+        The queries reducing each group of a grouped query to the aggregate's value.  Every group has documents, but
+        maybe none with the field, so aggregates which fail when empty must reduce groups differently.
+        """
+        return self.get_queries()
+
+    def decode_grouped(self, model, value):
+        return self.decode(model, value)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.field_name)
+
+
+class Count(Aggregate):
+    """
+    The number of documents, or of documents with a value for the field if one is given.
+    """
+
+    empty_value = 0
+
+    def get_queries(self):
+        if self.field_name is None:
+            return (('count', (), {}),)
+        return (('has_fields', (self.field_name,), {}), ('count', (), {}))
+
+
+class Sum(Aggregate):
+    """
+    The sum of the field's values, documents without it are skipped.
+    """
+
+    empty_value = 0
+
+    def __init__(self, field_name: str):
+        super(Sum, self).__init__(field_name)
+
+    def get_queries(self):
+        # Unset fields are stored as null, which `sum` would fail on
+        return (('has_fields', (self.field_name,), {}), ('sum', (self.field_name,), {}))
+
+
+class Avg(Aggregate):
+    """
+    The average of the field's values, documents without it are skipped.  None if no document has the field.
+    """
+
+    fails_when_empty = True
+
+    def __init__(self, field_name: str):
+        super(Avg, self).__init__(field_name)
+
+    def get_queries(self):
+        return (('has_fields', (self.field_name,), {}), ('avg', (self.field_name,), {}))
+
+    def get_grouped_queries(self):
+        # The sum and count of the values, so groups with no values give a count of 0 rather than failing
+        return (('map', (FieldValue(self.field_name, counted=True),), {}),
+                ('reduce', (NullSafeReduction('add'),), {}))
+
+    def decode_grouped(self, model, value):
+        total, count = value
+        return total / count if count else None
+
+
+class Min(Aggregate):
+    """
+    The smallest of the field's values, converted like the field's values on instances.  None if no document has the
+    field.
+    """
+
+    fails_when_empty = True
+    reql_term = 'min'
+
+    def __init__(self, field_name: str):
+        super(Min, self).__init__(field_name)
+
+    def get_queries(self):
+        # `min(field)` gives the whole document, take the values first to only get the value back
+        return (('has_fields', (self.field_name,), {}), ('get_field', (self.field_name,), {}),
+                (self.reql_term, (), {}))
+
+    def get_grouped_queries(self):
+        return (('map', (FieldValue(self.field_name),), {}), ('reduce', (NullSafeReduction(self.reql_term),), {}))
+
+    def decode(self, model, value):
+        if value is None:
+            return None
+        return model._meta.fields[self.field_name].from_db(value)
+
+
+class Max(Min):
+    """
+    The largest of the field's values, converted like the field's values on instances.  None if no document has the
+    field.
+    """
+
+    reql_term = 'max'
+
+
+class FieldValue(QueryFunction):
+    """
+    Maps documents to the field's value, null if they don't have it.  If `counted`, to a pair of the value and 1, or
+    of 0 and 0 without one, to be summed up.
+    """
+
+    def __init__(self, field_name: str, counted: bool=False):
+        self.field_name = field_name
+        self.counted = counted
+        self.shape = (field_name, counted)
+
+    def bind(self, params):
+        return self
+
+    def as_function(self) -> Callable[[Any], Any]:
+        field_name, counted = self.field_name, self.counted
+        if counted:
+            return lambda row: r.branch(row.has_fields(field_name), [row[field_name], 1], [0, 0])
+        return lambda row: r.branch(row.has_fields(field_name), row[field_name], None)
+
+
+class NullSafeReduction(QueryFunction):
+    """
+    Reduces the values mapped by FieldValue: 'add' sums up the pairs of a counted FieldValue, 'min' and 'max' take
+    the smallest or largest value, skipping nulls.
+    """
+
+    def __init__(self, operation: str):
+        assert operation in ('add', 'min', 'max'), 'Unknown reduction {}'.format(operation)
+        self.operation = operation
+        self.shape = operation
+
+    def bind(self, params):
+        return self
+
+    def as_function(self) -> Callable[[Any, Any], Any]:
+        if self.operation == 'add':
+            return lambda left, right: [left[0] + right[0], left[1] + right[1]]
+        compare = 'lt' if self.operation == 'min' else 'gt'
+        return lambda left, right: r.branch(
+            left.eq(None), right,
+            r.branch(right.eq(None), left, r.branch(getattr(left, compare)(right), left, right)))
+
+
+class GroupedQueryset:
+    """
+    A queryset's documents grouped on the values of some fields, see Queryset.group_by.  Aggregates are given as a
+    dict from each group's key to its value.  The keys are the fields' values as stored in the database (e.g. ids for
+    foreign keys), tuples of them when grouping on several fields.
+    """
+
+    def __init__(self, queryset, field_names: Tuple[str, ...]):
+        self.queryset = queryset
+        self.field_names = field_names
+
+    async def count(self) -> Dict[Any, int]:
+        """
+        The number of documents in each group.
+        """
+        return await self._run_aggregate(Count())
+
+    async def aggregate(self, **aggregates: Aggregate) -> Dict[Any, Dict[str, Any]]:
+        """
+        The given aggregates for each group, e.g.:
+            await Widget.objects.group_by('owner').aggregate(total=Sum('weight'), n=Count())
+            {'owner-1': {'total': 42.0, 'n': 3}, ...}
+        """
+        check_aggregates(self.queryset.model, aggregates)
+        results = await asyncio.gather(*[self._run_aggregate(aggregate) for aggregate in aggregates.values()])
+        groups = {}
+        for name, values in zip(aggregates, results):
+            for key, value in values.items():
+                groups.setdefault(key, {})[name] = value
+        for group in groups.values():
+            # Groups with no documents counted by an aggregate, e.g. Count('field'), don't show up in its results
+            for name, aggregate in aggregates.items():
+                group.setdefault(name, aggregate.empty_value)
+        return groups
+
+    async def _run_aggregate(self, aggregate: Aggregate) -> Dict[Any, Any]:
+        model = self.queryset.model
+        queries = self.queryset.queries + (('group', self.field_names, {}),) + aggregate.get_grouped_queries() + \
+            (('ungroup', (), {}),)
+        rows = await run_query(model.table, queries)
+        return {_get_group_key(row['group']): aggregate.decode_grouped(model, row['reduction']) for row in rows}
+
+
+def check_aggregates(model, aggregates: Dict[str, Aggregate]):
+    for name, aggregate in aggregates.items():
+        if not isinstance(aggregate, Aggregate):
+            raise TypeError('Expected an Aggregate for {}, got {!r}'.format(name, aggregate))
+        if aggregate.field_name is not None and aggregate.field_name not in model._meta.fields:
+            raise ValueError('{} has no field {}'.format(model.__name__, aggregate.field_name))
+
+
+async def run_aggregate(model, queries: Tuple[DatabaseQuery, ...], aggregate: Aggregate):
+    queries += aggregate.get_queries()
+    if aggregate.fails_when_empty:
+        queries += (('default', (aggregate.empty_value,), {}),)
+    return aggregate.decode(model, await run_query(model.table, queries))
+
+
+async def run_query(table: str, queries: Tuple[DatabaseQuery, ...]):
+    async with QueryRunner(table, queries) as query:
+        return await query.run()
+
+
+def _get_group_key(key):
+    # Keys of groups on several fields come back as lists
+    return tuple(key) if isinstance(key, list) else key
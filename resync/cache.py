@@ -0,0 +1,214 @@
+import asyncio
+import weakref
+from collections import OrderedDict
+from functools import partial
+from logging import getLogger
+from typing import Any, Mapping, NamedTuple, Optional
+
+from resync.codecs import copy_document
+from resync.connection import QueryRunner
+from resync.identity import get_identity_map
+from resync.manager import Manager
+from resync.queryset import BaseQueryset, Queryset, PRIMARY_KEY
+
+l = getLogger('resync.cache')
+
+ModelCacheStats = NamedTuple('ModelCacheStats', [
+    ('hits', int),
+    ('misses', int),
+    ('evictions', int),
+    ('expirations', int),
+    ('refreshes', int),
+    ('invalidations', int),
+    ('size', int),
+    ('maxsize', int),
+    ('live', bool),
+])
+
+_running_caches = weakref.WeakSet()
+
+
+class CachedManager(Manager):
+    """
+    Manager answering `get(id=...)` from an in-memory LRU cache of documents, for small sets of hot documents.  Switch
+    it on by declaring it on the model in place of the default manager:
+
+        class Setting(Model):
+            objects = CachedManager(maxsize=1000, ttl=300)
+
+    The first `get` starts a changefeed on the table, which refreshes cached documents when they change and drops
+    them when they are deleted.  Documents are only cached and served from the cache while the changefeed is running,
+    and the cache is emptied whenever it stops, so reads don't go stale while changes could be missed.  `ttl` (seconds,
+    None for no limit) bounds how long an entry is served regardless.  Everything other than `get` by primary key goes
+    to the database as usual.
+    """
+
+    RETRY_DELAY = 1.0  # Seconds to wait before resubscribing after the changefeed fails
+
+    def __init__(self, maxsize: int=1024, ttl: Optional[float]=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # id -> (document, expires_at), least recently used first
+        self._loading = {}  # id -> future of the document being fetched, removed if it changes meanwhile
+        self._live = False
+        self._generation = 0  # Bumped whenever the changefeed goes live or stops
+        self._feed_task = None
+        self._counters = dict.fromkeys(('hits', 'misses', 'evictions', 'expirations', 'refreshes', 'invalidations'), 0)
+
+    def copy(self) -> 'CachedManager':
+        return type(self)(maxsize=self.maxsize, ttl=self.ttl)
+
+    async def get(self, **kwargs):
+        if set(kwargs) != {PRIMARY_KEY}:
+            return await super(CachedManager, self).get(**kwargs)
+        id = kwargs[PRIMARY_KEY]
+        identity_map = get_identity_map()
+        instance = identity_map.get(self.model, id) if identity_map is not None else None
+        if instance is not None:
+            return instance
+        document = await self._get_document(id)
+        if document is None:
+            raise self.model.DoesNotExist()
+        return Queryset(self.model).transform_query_result(copy_document(document))
+
+    async def update_document(self, instance, document):
+        try:
+            return await super(CachedManager, self).update_document(instance, document)
+        finally:
+            self.invalidate(instance.id)
+
+    async def bulk_update(self, instances, fields, batch_size=None):
+        instances = list(instances)
+        try:
+            return await super(CachedManager, self).bulk_update(instances, fields, batch_size)
+        finally:
+            for instance in instances:
+                self.invalidate(instance.id)
+
+    async def delete(self, instance):
+        try:
+            return await super(CachedManager, self).delete(instance)
+        finally:
+            self.invalidate(instance.id)
+
+    def start(self):
+        """
+        Start following the changefeed, `get` does this automatically.
+        """
+        if self._feed_task is None:
+            self._feed_task = asyncio.ensure_future(self._follow_changes())
+            _running_caches.add(self)
+
+    async def stop(self):
+        """
+        Stop the changefeed and empty the cache.
+        """
+        _running_caches.discard(self)
+        task, self._feed_task = self._feed_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.clear()
+
+    def invalidate(self, id):
+        if self._entries.pop(id, None) is not None:
+            self._counters['invalidations'] += 1
+        self._loading.pop(id, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._loading.clear()
+
+    def stats(self) -> ModelCacheStats:
+        return ModelCacheStats(size=len(self._entries), maxsize=self.maxsize, live=self._live, **self._counters)
+
+    async def _get_document(self, id) -> Optional[Mapping[str, Any]]:
+        self.start()
+        entry = self._entries.get(id)
+        if entry is not None:
+            document, expires_at = entry
+            if expires_at is None or expires_at > asyncio.get_event_loop().time():
+                self._entries.move_to_end(id)
+                self._counters['hits'] += 1
+                return document
+            del self._entries[id]
+            self._counters['expirations'] += 1
+        self._counters['misses'] += 1
+        loading = self._loading.get(id)
+        if loading is None:
+            # Concurrent misses for the same document share one query
+            loading = self._loading[id] = asyncio.ensure_future(self._fetch(id))
+            # Changes made before the changefeed is live aren't seen, so only fetches started while it is are stored
+            generation = self._generation if self._live else None
+            loading.add_done_callback(partial(self._loaded, id, generation))
+        return await asyncio.shield(loading)
+
+    async def _fetch(self, id) -> Optional[Mapping[str, Any]]:
+        async with QueryRunner(self.model.table, (('get', (id,), {}),)) as query:
+            return await query.run()
+
+    def _loaded(self, id, generation, loading):
+        if self._loading.get(id) is not loading:
+            return  # The document changed while it was being fetched, the result may be out of date
+        del self._loading[id]
+        if not loading.cancelled() and loading.exception() is None:
+            document = loading.result()
+            if document is not None and self._live and generation == self._generation:
+                self._store(id, document)
+
+    def _store(self, id, document):
+        expires_at = None if self.ttl is None else asyncio.get_event_loop().time() + self.ttl
+        self._entries[id] = (document, expires_at)
+        self._entries.move_to_end(id)
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def _apply_change(self, change):
+        old_document, new_document = change.get('old_val'), change.get('new_val')
+        id = (new_document or old_document or {}).get(PRIMARY_KEY)
+        self._loading.pop(id, None)
+        if id not in self._entries:
+            return
+        if new_document is None:
+            del self._entries[id]
+            self._counters['invalidations'] += 1
+        else:
+            self._store(id, new_document)
+            self._counters['refreshes'] += 1
+
+    async def _follow_changes(self):
+        while True:
+            feed = BaseQueryset(self.model, (('changes', tuple(), {}),))
+            try:
+                await feed.__aiter__()
+                self._live = True
+                self._generation += 1
+                while True:
+                    try:
+                        change = await feed.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    self._apply_change(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                l.debug('Exception in changefeed of {} cache'.format(self.model.__name__), exc_info=True)
+            finally:
+                # Changes may be missed until the feed is back up
+                self._live = False
+                self._generation += 1
+                self.clear()
+                await feed.aclose()
+            await asyncio.sleep(self.RETRY_DELAY)
+
+
+async def stop_caches():
+    """
+    Stop the changefeeds of all running caches, see CachedManager.
+    """
+    for cache in list(_running_caches):
+        await cache.stop()
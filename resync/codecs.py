@@ -0,0 +1,198 @@
+"""
+Generates the functions converting documents between their db and Python representations for each model class.
+
+The generic implementations (`generic_decode` and `generic_encode`) loop over the model's fields for every document,
+looking up each field's default and calling its `from_db`/`to_db`, then set each attribute through the model's
+`__init__`.  The generated functions do the same work in straight-line code, with the converter of each field, its
+default and whether it needs to be called for None values all worked out when the class is created.
+"""
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+# A function converting a value, or None if values are used as they are, and whether None is always converted to None,
+# in which case the function is never called with None.
+Converter = Tuple[Optional[Callable[[Any], Any]], bool]
+
+_MISSING = object()
+_STOCK_INITS = set()
+
+
+def register_stock_init(init):
+    """
+    Mark an `__init__` implementation as doing nothing more than setting the fields passed as kwargs and defaulting
+    the rest, so generated decoders can set the attributes directly instead of calling it.
+    """
+    _STOCK_INITS.add(init)
+
+
+def get_field_decoder(field) -> Converter:
+    if _overrides_conversion(type(field), 'get_decoder', 'from_db'):
+        return field.from_db, False
+    return field.get_decoder()
+
+
+def get_field_encoder(field) -> Converter:
+    if _overrides_conversion(type(field), 'get_encoder', 'to_db'):
+        return field.to_db, False
+    return field.get_encoder()
+
+
+def _overrides_conversion(field_class, describe_name, convert_name) -> bool:
+    """
+    A Field subclass which overrides `from_db` without overriding `get_decoder` (or `to_db`/`get_encoder`) can't be
+    described, fall back to calling the conversion method.
+    """
+    for klass in field_class.__mro__:
+        if describe_name in klass.__dict__:
+            return False
+        if convert_name in klass.__dict__:
+            return True
+    return True
+
+
+def build_decoder(cls) -> Callable[[Mapping[str, Any]], Any]:
+    """
+    Returns a function building an instance of `cls` from a document in its db representation, equivalent to
+    `generic_decode(cls, document)`.
+    """
+    namespace = {'cls': cls, 'MISSING': _MISSING, 'new': object.__new__}
+    lines = ['def decode(data):', '    get = data.get']
+    names = []
+    for i, (field_name, field) in enumerate(cls._meta.fields.items()):
+        var = 'v{}'.format(i)
+        names.append((field_name, var))
+        default = field._default
+        if default is None:
+            lines.append('    {} = get({!r})'.format(var, field_name))
+        else:
+            lines.append('    {} = get({!r}, MISSING)'.format(var, field_name))
+            if callable(default):
+                # Go through the `default` property, which has its own rules for what counts as a callable default
+                namespace['default_{}'.format(i)] = default if default in (list, dict) else _default_getter(field)
+                lines.append('    if {0} is MISSING: {0} = default_{1}()'.format(var, i))
+            else:
+                namespace['default_{}'.format(i)] = default
+                lines.append('    if {0} is MISSING: {0} = default_{1}'.format(var, i))
+        convert, none_passthrough = get_field_decoder(field)
+        if convert is not None:
+            namespace['convert_{}'.format(i)] = convert
+            if none_passthrough:
+                lines.append('    if {0} is not None: {0} = convert_{1}({0})'.format(var, i))
+            else:
+                lines.append('    {0} = convert_{1}({0})'.format(var, i))
+
+    field_values = ', '.join('{!r}: {}'.format(field_name, var) for field_name, var in names)
+    is_model = hasattr(cls, '_set_reverse_relations')
+    if is_stock_init(cls.__init__):
+        lines.append('    obj = new(cls)')
+        if cls._compact:
+            lines.extend('    obj.{} = {}'.format(field_name, var) for field_name, var in names)
+        else:
+            lines.append('    obj.__dict__ = {{{}}}'.format(field_values))
+        if is_model:
+            namespace['reverse_relations'] = cls._meta.reverse_relations  # Filled in as related models are defined
+            lines.append('    if reverse_relations: obj._set_reverse_relations()')
+    else:
+        lines.append('    obj = cls(**{{{}}})'.format(field_values))
+    if is_model and cls._track_changes:
+        # Copied, so that changes made in place to the instance's lists and dicts show up against it, see Model.save
+        namespace['copy_document'] = copy_document
+        lines.append('    obj._snapshot = copy_document(data)')
+    lines.append('    return obj')
+    return _compile(lines, namespace, 'decode', cls)
+
+
+def build_encoder(cls) -> Callable[[Any], Dict[str, Any]]:
+    """
+    Returns a function converting an instance of `cls` into its db representation, equivalent to
+    `generic_encode(instance)`.
+    """
+    namespace = {}
+    lines = ['def encode(obj):']
+    names = []
+    for i, (field_name, field) in enumerate(cls._meta.fields.items()):
+        var = 'v{}'.format(i)
+        names.append((field_name, var))
+        lines.append('    {} = obj.{}'.format(var, field_name))
+        convert, none_passthrough = get_field_encoder(field)
+        if convert is not None:
+            namespace['convert_{}'.format(i)] = convert
+            if none_passthrough:
+                lines.append('    if {0} is not None: {0} = convert_{1}({0})'.format(var, i))
+            else:
+                lines.append('    {0} = convert_{1}({0})'.format(var, i))
+    lines.append('    return {{{}}}'.format(', '.join('{!r}: {}'.format(name, var) for name, var in names)))
+    return _compile(lines, namespace, 'encode', cls)
+
+
+def build_field_decoder(field) -> Callable[[Mapping[str, Any]], Any]:
+    """
+    Returns a function decoding a single field out of a document, for lazy instances.
+    """
+    field_name = field.name
+    convert, none_passthrough = get_field_decoder(field)
+
+    def decode(data):
+        value = data.get(field_name, _MISSING)
+        if value is _MISSING:
+            value = field.default
+        if convert is None or (value is None and none_passthrough):
+            return value
+        return convert(value)
+    return decode
+
+
+def build_field_encoder(field) -> Callable[[Any], Any]:
+    """
+    Returns a function encoding a single field value, for lazy instances.
+    """
+    convert, none_passthrough = get_field_encoder(field)
+
+    def encode(value):
+        if convert is None or (value is None and none_passthrough):
+            return value
+        return convert(value)
+    return encode
+
+
+def copy_document(document):
+    """
+    Copy the dicts and lists of a document, leaving the other values shared.
+    """
+    if isinstance(document, dict):
+        return {key: copy_document(value) for key, value in document.items()}
+    if isinstance(document, list):
+        return [copy_document(value) for value in document]
+    return document
+
+
+def is_stock_init(init) -> bool:
+    return init in _STOCK_INITS
+
+
+def _default_getter(field):
+    return lambda: field.default
+
+
+def _compile(lines, namespace, function_name, cls):
+    source = '\n'.join(lines)
+    code = compile(source, '<resync codec {} for {}>'.format(function_name, cls.__qualname__), 'exec')
+    exec(code, namespace)
+    return namespace[function_name]
+
+
+def generic_decode(cls, data_dict: Mapping[str, Any]):
+    """
+    Deserializes a document field by field, this is what the generated decoders are equivalent to.
+    """
+    transformed_data = {}
+    for field_name, field in cls._meta.fields.items():
+        value = data_dict.get(field_name, field.default)
+        transformed_data[field_name] = field.from_db(value)
+    return cls(**transformed_data)
+
+
+def generic_encode(instance) -> Dict[str, Any]:
+    """
+    Serializes an instance field by field, this is what the generated encoders are equivalent to.
+    """
+    return instance.serialize_fields(instance._get_field_data())
@@ -0,0 +1,199 @@
+"""
+Columnar exports of querysets, for analytics jobs which need a few fields of many documents, e.g.:
+
+    columns = await Widget.objects.filter(enabled=True).to_columns(['weight', 'created', 'colour'], encode=['colour'])
+    columns['weight']  # array('d', [...])
+    columns['created']  # array('d', [...]), seconds since the epoch
+    columns['colour'].codes, columns['colour'].categories
+
+The server plucks the fields, and each batch of documents is written straight into the columns without building
+model instances.  `Queryset.to_numpy` gives NumPy arrays instead, if NumPy is installed.
+"""
+import calendar
+import re
+from array import array
+from collections import OrderedDict
+from typing import Any, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Union
+
+import arrow
+
+from resync.fields import BooleanField, DateTimeField, FloatField, ForeignKeyField, IntField, StrField
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A dictionary encoded column: the values are `categories[code]`, with code -1 for null values unless `fill` is given
+DictionaryColumn = NamedTuple('DictionaryColumn', [('codes', Any), ('categories', Any)])
+
+Column = Union[array, list, DictionaryColumn]
+
+NAN = float('nan')
+
+# Array type codes of the columns for each type of field, see the array module.  Dates are seconds since the epoch.
+COLUMN_TYPECODES = OrderedDict([
+    (BooleanField, 'b'),
+    (IntField, 'q'),
+    (FloatField, 'd'),
+    (DateTimeField, 'd'),
+])
+
+# What null values become in the arrays of each type, unless given by `fill`.  Int and boolean arrays can't hold them.
+NULL_VALUES = {FloatField: NAN, DateTimeField: NAN}
+
+_ISO_DATETIME = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+_NO_VALUE = object()
+
+
+class ColumnBuilder:
+    """
+    Appends the values of a field in batches of raw documents to a column: an array for booleans, ints, floats and
+    datetimes, a DictionaryColumn if `encode` is True (strings and foreign keys only), or else a list of the values
+    as `Queryset.values` would give them.  Null values become `fill` if given (in dictionary columns, the code of
+    `fill` as a category), or else NaN in float and datetime arrays, -1 codes in dictionary columns and None in lists;
+    int and boolean arrays can't hold them.
+    """
+
+    def __init__(self, model, field_name: str, encode: bool=False, fill: Any=_NO_VALUE):
+        field = model._meta.fields.get(field_name)
+        if field is None:
+            raise ValueError('{} has no field {}'.format(model.__name__, field_name))
+        self.model = model
+        self.field_name = field_name
+        self.default = field.default
+        self.encoded = encode
+        field_type = _get_field_type(field, COLUMN_TYPECODES)
+        self.typecode = COLUMN_TYPECODES.get(field_type)
+        if encode:
+            if not isinstance(field, (StrField, ForeignKeyField)):
+                raise ValueError('Only string and foreign key fields can be dictionary encoded, not {}.{}'.format(
+                    model.__name__, field_name))
+            self.column = DictionaryColumn(array('i'), [])
+            self._codes = {}
+            self.null = None if fill is _NO_VALUE else fill
+        elif self.typecode is not None:
+            self.column = array(self.typecode)
+            self.convert = iso_to_epoch if field_type is DateTimeField else field_type.from_db
+            self.null = NULL_VALUES.get(field_type, _NO_VALUE) if fill is _NO_VALUE else fill
+        else:
+            self.column = []
+            # Foreign keys are left as ids rather than wrapped in a RelatedObjectProxy
+            self.convert = None if isinstance(field, ForeignKeyField) else field.from_db
+            self.null = None if fill is _NO_VALUE else fill
+
+    def extend(self, documents: Iterable[Mapping[str, Any]]):
+        field_name, default = self.field_name, self.default
+        values = [document.get(field_name, default) for document in documents]
+        if self.encoded:
+            self._extend_encoded(values)
+        elif self.typecode is None:
+            self.column.extend(self._convert(values) if self.convert is not None or self.null is not None else values)
+        elif self.convert is iso_to_epoch:
+            self.column.extend(self._convert(values))
+        else:
+            length = len(self.column)
+            try:
+                # Most batches are already of the column's type
+                self.column.extend(values)
+            except TypeError:
+                del self.column[length:]  # Dropping the values appended before the one that failed
+                self.column.extend(self._convert(values))
+
+    def _extend_encoded(self, values):
+        codes, categories, null = self._codes, self.column.categories, self.null
+        batch_codes = []
+        for value in values:
+            if value is None:
+                value = null
+                if value is None:
+                    batch_codes.append(-1)
+                    continue
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(categories)
+                categories.append(value)
+            batch_codes.append(code)
+        self.column.codes.extend(batch_codes)
+
+    def _convert(self, values):
+        convert, null = self.convert, self.null
+        converted = []
+        for value in values:
+            if value is None:
+                if null is _NO_VALUE:
+                    raise ValueError('Null value for {}.{}, give the value to use instead in `fill`'.format(
+                        self.model.__name__, self.field_name))
+                converted.append(null)
+            else:
+                converted.append(value if convert is None else convert(value))
+        return converted
+
+
+def get_column_builders(model, field_names: Sequence[str], encode: Iterable[str]=(),
+                        fill: Optional[Mapping[str, Any]]=None) -> List[ColumnBuilder]:
+    if isinstance(field_names, str):
+        raise TypeError('Expected a list of field names, got {!r}'.format(field_names))
+    encode, fill = frozenset(encode), fill or {}
+    unknown_names = (encode | frozenset(fill)).difference(field_names)
+    if unknown_names:
+        raise ValueError('{} not in the exported fields'.format(', '.join(sorted(unknown_names))))
+    return [ColumnBuilder(model, field_name, field_name in encode, fill.get(field_name, _NO_VALUE))
+            for field_name in field_names]
+
+
+def to_numpy(columns: Mapping[str, Column]) -> 'OrderedDict[str, Any]':
+    """
+    Convert columns to NumPy arrays: arrays of the same type (int8 arrays for booleans are converted to bool), object
+    arrays for lists, and DictionaryColumns of a code array and an object array of categories, e.g. for
+    `pandas.Categorical.from_codes(column.codes, column.categories)`.
+    """
+    if numpy is None:
+        raise ImportError('NumPy is needed for numpy exports, install it with `pip install numpy`')
+    numpy_columns = OrderedDict()
+    for name, column in columns.items():
+        if isinstance(column, DictionaryColumn):
+            numpy_columns[name] = DictionaryColumn(_array_to_numpy(column.codes), _list_to_numpy(column.categories))
+        elif isinstance(column, array):
+            numpy_columns[name] = _array_to_numpy(column)
+        else:
+            numpy_columns[name] = _list_to_numpy(column)
+    return numpy_columns
+
+
+def iso_to_epoch(value) -> float:
+    """
+    Seconds since the epoch of a datetime as stored by a DateTimeField, parsed quicker than by arrow for the ISO 8601
+    strings `isoformat()` gives.  Datetimes without a timezone are taken to be UTC, like arrow does.
+    """
+    match = _ISO_DATETIME.match(value) if isinstance(value, str) else None
+    if match is None:
+        return arrow.get(value).float_timestamp
+    year, month, day, hour, minute, second, fraction, utc, sign, offset_hours, offset_minutes = match.groups()
+    epoch = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+    if fraction:
+        epoch += int(fraction) / 10 ** len(fraction)
+    if sign:
+        offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+        epoch += -offset if sign == '+' else offset
+    return epoch
+
+
+def _get_field_type(field, field_types):
+    for field_type in field_types:
+        if isinstance(field, field_type):
+            return field_type
+    return None
+
+
+def _array_to_numpy(column: array):
+    numpy_array = numpy.array(column, dtype=column.typecode)
+    return numpy_array.astype(bool) if column.typecode == 'b' else numpy_array
+
+
+def _list_to_numpy(column: list):
+    numpy_array = numpy.empty(len(column), dtype=object)
+    numpy_array[:] = column  # Rather than numpy.array, which makes nested arrays of list values
+    return numpy_array
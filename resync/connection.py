@@ -1,10 +1,16 @@
-from asyncio import Queue, QueueEmpty
+import asyncio
+import inspect
+import json
+from collections import deque, OrderedDict
 from logging import getLogger
-from typing import Tuple, Iterable
-from weakref import WeakSet
+from typing import Any, Tuple, Iterable, NamedTuple, Sequence, Callable
 
 import rethinkdb as r
+from rethinkdb.ast import RqlQuery
 from rethinkdb.net import DefaultConnection
+from rethinkdb.ql2_pb2 import Term
+
+from resync.instrumentation import QueryInfo, count_rows, get_size, instrumentation, is_cursor
 
 l = getLogger('resync.connection')
 
@@ -12,57 +18,385 @@ r.set_loop_type('asyncio')
 
 DatabaseQuery = Tuple[str, tuple, dict]
 
+PoolStats = NamedTuple('PoolStats', [
+    ('size', int),
+    ('in_use', int),
+    ('in_flight', int),
+    ('idle', int),
+    ('waiters', int),
+    ('max_size', int),
+    ('acquired', int),
+    ('waited', int),
+    ('wait_time_total', float),
+    ('wait_time_max', float),
+    ('timeouts', int),
+    ('opened', int),
+    ('closed', int),
+])
+
+
+QueryCacheStats = NamedTuple('QueryCacheStats', [
+    ('hits', int),
+    ('misses', int),
+    ('uncacheable', int),
+    ('evictions', int),
+    ('size', int),
+    ('maxsize', int),
+])
+
+
+class ConnectionPoolTimeout(Exception):
+    pass
+
 
 class ConnectionPool:
+    """
+    A bounded pool of rethinkdb connections.  At most `max_size` connections are open at once, callers beyond that
+    wait in FIFO order for a connection to be returned, for up to `acquire_timeout` seconds.  Idle connections are
+    checked before they are handed out, and closed once they have been idle for longer than `max_idle_time` or open
+    for longer than `max_lifetime` (both in seconds, None to disable), although the pool never shrinks below
+    `min_size` because of idleness.
+
+    By default each connection runs one query at a time.  With `max_in_flight` above 1 the pool is in shared mode:
+    the driver tags queries with tokens so many can be outstanding on one connection, and callers are given the least
+    busy connection with fewer than `max_in_flight` queries running, so a few connections serve many concurrent short
+    queries.  New connections are only opened once all of them are that busy.  Cursors, e.g. changefeeds, hold their
+    share of a connection until they are closed.
+    """
+
+    DEFAULT_OPTIONS = {
+        'min_size': 1,
+        'max_size': 20,
+        'acquire_timeout': 10.0,
+        'max_idle_time': 600.0,
+        'max_lifetime': None,
+        'health_check_interval': None,
+        'max_in_flight': 1,
+    }
+
+    # Given to a waiter instead of a connection when a slot in the pool is freed up for it to open a new connection
+    _NEW_CONNECTION = object()
 
     def __init__(self):
+        self.connect = None  # Opens a connection given the config instead of r.connect, see resync.testing
         self._config_dict = None
-        self._queue = Queue()
-        self._outstanding_connections = WeakSet()
+        self._options = dict(self.DEFAULT_OPTIONS)
+        self._idle = deque()  # (connection, released_at) pairs, most recently used on the right
+        self._in_use = {}  # connection -> number of queries running on it
+        self._retiring = set()  # Shared connections to close once the queries running on them are done
+        self._opened_at = {}
+        self._waiters = deque()
+        self._size = 0  # Open connections plus connections being opened
+        self._health_check_task = None
+        self._counters = dict.fromkeys(('acquired', 'waited', 'timeouts', 'opened', 'closed'), 0)
+        self._counters.update(wait_time_total=0.0, wait_time_max=0.0)
 
-    async def get_conn(self):
+    async def get_conn(self, timeout=None):
+        """
+        Take a connection from the pool, opening a new one if none are idle and the pool isn't full, otherwise wait
+        for one to be returned.
+        :param timeout: Seconds to wait for a connection, defaults to the pool's `acquire_timeout`.
+        """
         self._check_config()
-        try:
-            while True:
-                conn = self._queue.get_nowait()
-                if conn.is_open():
-                    break
-                try:
-                    await conn.close()
-                except Exception:
-                    l.debug('Exception in close rethink connection', exc_info=True)
-        except QueueEmpty:
-            conn = await r.connect(**self._config_dict)
-        self._outstanding_connections.add(conn)
+        if timeout is None:
+            timeout = self._options['acquire_timeout']
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        waited = False
+        while True:
+            conn = await self._pop_idle()
+            if conn is None:
+                conn = self._get_shared()
+            if conn is not None:
+                self._reserve(conn)
+                break
+            if self._size < self._options['max_size']:
+                self._size += 1
+                conn = self._NEW_CONNECTION
+            else:
+                waited = True
+                remaining = self._remaining_timeout(timeout, started, loop)
+                # Connections handed over by put_conn are already reserved for us
+                conn = await self._wait_for_conn(remaining)
+            if conn is self._NEW_CONNECTION:
+                conn = await self._open_conn()
+                self._reserve(conn)
+                self._hand_to_waiters(conn)  # In shared mode, callers queued meanwhile can use it too
+            if conn is not None:
+                break
+
+        self._record_acquire(loop.time() - started if waited else None)
         return conn
 
     async def put_conn(self, conn):
-        self._queue.put_nowait(conn)
-        self._outstanding_connections.remove(conn)
+        """
+        Return a connection to the pool, handing it straight to the longest waiting caller if there is one.  In shared
+        mode, a connection still running other queries stays in use and only its freed up share is handed on.
+        """
+        n_queries = self._in_use.pop(conn, 1) - 1
+        if n_queries > 0:
+            self._in_use[conn] = n_queries
+            if conn not in self._retiring and self._is_reusable(conn):
+                self._hand_to_waiters(conn)
+            return
+        if conn in self._retiring or conn not in self._opened_at or not self._is_reusable(conn):
+            await self.discard_conn(conn)
+            return
+        if not self._hand_to_waiters(conn):
+            self._idle.append((conn, asyncio.get_event_loop().time()))
+            await self._prune_idle()
+
+    async def discard_conn(self, conn):
+        """
+        Close a connection that shouldn't be reused, e.g. after an unexpected error, and free its slot in the pool.  A
+        shared connection is closed once the other queries running on it are done, it isn't handed out meanwhile.
+        """
+        n_queries = self._in_use.pop(conn, 1) - 1
+        if n_queries > 0:
+            self._in_use[conn] = n_queries
+            self._retiring.add(conn)
+            return
+        self._retiring.discard(conn)
+        if self._opened_at.pop(conn, None) is not None:
+            self._release_slot()
+        await self._close_conn(conn)
+
+    def release_abandoned(self, conn, cursor=None):
+        """
+        Return the connection of a query which was dropped without being closed, e.g. by breaking out of an `async
+        for` over a queryset, closing its cursor first.  Called when the query's QueryRunner is garbage collected, so
+        the connection is returned by a task scheduled on the event loop.
+        """
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            return  # No event loop in this thread
+        if loop.is_closed():
+            return
+        if cursor is not None:
+            _close_cursor(cursor, loop)
+        asyncio.ensure_future(self.put_conn(conn), loop=loop)
 
-    def set_config(self, config):
+    async def warmup(self):
+        """
+        Open connections concurrently until the pool holds `min_size` connections.
+        """
+        self._check_config()
+        n_missing = self._options['min_size'] - self._size
+        if n_missing > 0:
+            self._size += n_missing
+            results = await asyncio.gather(*[self._open_conn() for _ in range(n_missing)], return_exceptions=True)
+            now = asyncio.get_event_loop().time()
+            for result in results:
+                if isinstance(result, Exception):
+                    l.debug('Exception in warming up connection pool', exc_info=result)
+                else:
+                    self._idle.append((result, now))
+        self._start_health_checks()
+
+    def set_config(self, config, **pool_options):
+        unknown_options = set(pool_options).difference(self.DEFAULT_OPTIONS)
+        if unknown_options:
+            raise TypeError('Unexpected connection pool options: {}'.format(', '.join(sorted(unknown_options))))
         self._config_dict = config
+        self._options.update(pool_options)
+        assert 0 <= self._options['min_size'] <= self._options['max_size'], 'Expected 0 <= min_size <= max_size'
+        assert self._options['max_in_flight'] >= 1, 'Expected max_in_flight >= 1'
 
     def get_config(self):
         self._check_config()
         return self._config_dict
 
+    def stats(self) -> PoolStats:
+        """
+        A snapshot of the pool's current state and its counters since it was created.
+        """
+        return PoolStats(
+            size=self._size,
+            in_use=len(self._in_use),
+            in_flight=sum(self._in_use.values()),
+            idle=len(self._idle),
+            waiters=sum(1 for waiter in self._waiters if not waiter.done()),
+            max_size=self._options['max_size'],
+            **self._counters
+        )
+
     async def teardown(self):
-        while True:
-            try:
-                conn = self._queue.get_nowait()
-            except QueueEmpty:
-                break
-            self._outstanding_connections.add(conn)
-        for conn in self._outstanding_connections:
-            try:
-                await conn.close()
-            except Exception:
-                l.debug('Exception in close rethink connection', exc_info=True)
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            self._health_check_task = None
+        while self._waiters:
+            self._waiters.popleft().cancel()
+        connections = [conn for conn, released_at in self._idle] + list(self._in_use)
+        self._idle.clear()
+        self._in_use.clear()
+        self._retiring.clear()
+        self._opened_at.clear()
+        self._size = 0
+        for conn in connections:
+            await self._close_conn(conn)
 
     def _check_config(self):
         assert self._config_dict is not None, "Did you remember to run resync.setup()?"
 
+    async def _open_conn(self):
+        """
+        Open a new connection in a slot already reserved by the caller.
+        """
+        try:
+            conn = await (self.connect or r.connect)(**self._config_dict)
+        except Exception:
+            self._release_slot()
+            raise
+        self._opened_at[conn] = asyncio.get_event_loop().time()
+        self._counters['opened'] += 1
+        return conn
+
+    async def _close_conn(self, conn):
+        self._counters['closed'] += 1
+        try:
+            await conn.close()
+        except Exception:
+            l.debug('Exception in close rethink connection', exc_info=True)
+
+    def _release_slot(self):
+        """
+        Give a freed slot to the longest waiting caller so it can open a new connection, or shrink the pool.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(self._NEW_CONNECTION)
+                return
+        self._size -= 1
+
+    def _reserve(self, conn):
+        self._in_use[conn] = self._in_use.get(conn, 0) + 1
+
+    def _get_shared(self):
+        """
+        In shared mode, the least busy connection in use which can take another query, if any.
+        """
+        max_in_flight = self._options['max_in_flight']
+        if max_in_flight <= 1:
+            return None
+        candidates = [(n_queries, conn) for conn, n_queries in self._in_use.items()
+                      if n_queries < max_in_flight and conn not in self._retiring and self._is_reusable(conn)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda candidate: candidate[0])[1]
+
+    def _hand_to_waiters(self, conn) -> int:
+        """
+        Give a connection to the longest waiting caller, or in shared mode give its free shares to as many waiting
+        callers as it can take.  Returns the number of callers it was given to.
+        """
+        n_handed = 0
+        while self._waiters and self._in_use.get(conn, 0) < self._options['max_in_flight']:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._reserve(conn)
+                waiter.set_result(conn)
+                n_handed += 1
+        return n_handed
+
+    async def _pop_idle(self):
+        """
+        Get the most recently used idle connection that is still fit for use, closing any that aren't.
+        """
+        while self._idle:
+            conn, released_at = self._idle.pop()
+            if self._is_reusable(conn, released_at):
+                return conn
+            await self.discard_conn(conn)
+        return None
+
+    async def _prune_idle(self):
+        """
+        Close connections which have been idle for too long, oldest first, down to `min_size` connections.
+        """
+        while self._idle and self._size > self._options['min_size']:
+            conn, released_at = self._idle[0]
+            if self._is_reusable(conn, released_at):
+                break
+            self._idle.popleft()
+            await self.discard_conn(conn)
+
+    def _is_reusable(self, conn, released_at=None) -> bool:
+        try:
+            if not conn.is_open():
+                return False
+        except Exception:
+            return False
+        now = asyncio.get_event_loop().time()
+        max_lifetime = self._options['max_lifetime']
+        if max_lifetime is not None and now - self._opened_at.get(conn, now) > max_lifetime:
+            return False
+        max_idle_time = self._options['max_idle_time']
+        if released_at is not None and max_idle_time is not None and now - released_at > max_idle_time:
+            return False
+        return True
+
+    async def _wait_for_conn(self, timeout):
+        waiter = asyncio.Future()
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self._counters['timeouts'] += 1
+            raise ConnectionPoolTimeout(
+                'Timed out after {}s waiting for a connection. Pool stats: {}'.format(timeout, self.stats()))
+        except asyncio.CancelledError:
+            # We may have been handed a connection (or a free slot) just before being cancelled
+            if waiter.done() and not waiter.cancelled():
+                result = waiter.result()
+                if result is self._NEW_CONNECTION:
+                    self._release_slot()
+                else:
+                    asyncio.ensure_future(self.put_conn(result))
+            raise
+
+    @staticmethod
+    def _remaining_timeout(timeout, started, loop):
+        if timeout is None:
+            return None
+        return max(0, timeout - (loop.time() - started))
+
+    def _record_acquire(self, wait_time):
+        self._counters['acquired'] += 1
+        if wait_time is not None:
+            self._counters['waited'] += 1
+            self._counters['wait_time_total'] += wait_time
+            self._counters['wait_time_max'] = max(self._counters['wait_time_max'], wait_time)
+        if instrumentation.hooks:
+            instrumentation.connection_acquired(wait_time or 0.0)
+
+    def _start_health_checks(self):
+        interval = self._options['health_check_interval']
+        if interval is not None and self._health_check_task is None:
+            self._health_check_task = asyncio.ensure_future(self._health_check_loop(interval))
+
+    async def _health_check_loop(self, interval):
+        """
+        Periodically close dead or expired idle connections and top the pool back up to `min_size`, so failures are
+        noticed before a caller is handed a broken connection.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                healthy = deque()
+                while self._idle:
+                    conn, released_at = self._idle.popleft()
+                    if self._is_reusable(conn, released_at):
+                        healthy.append((conn, released_at))
+                    else:
+                        await self.discard_conn(conn)
+                self._idle.extendleft(reversed(healthy))
+                await self._prune_idle()
+                await self.warmup()
+            except Exception:
+                l.debug('Exception in connection pool health check', exc_info=True)
+
 connection_pool = ConnectionPool()
 
 
@@ -79,20 +413,54 @@ class RethinkConnection:
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if exc_type is not None:
             l.debug('Unhandled exception in RethinkConnection block', exc_info=(exc_type, exc_val, exc_tb))
-            try:
-                self._conn.close()
-            except Exception:
-                pass
+            await connection_pool.discard_conn(self._conn)
             return False
         await connection_pool.put_conn(self._conn)
 
 
+class QueryFunction:
+    """
+    Base class for functions passed as arguments in DatabaseQuery tuples, e.g. filter predicates.  Unlike a lambda,
+    the structure of the function (`shape`) is known separately from the values it uses (`params`), which is what
+    lets QueryRunner cache the compiled query and reuse it for different values.
+    """
+
+    shape = None  # Hashable description of the function, excluding its params
+    params = ()
+
+    def bind(self, params: Sequence) -> 'QueryFunction':
+        """
+        Returns a copy of this function using the given params instead of its own.
+        """
+        raise NotImplementedError()
+
+    def as_function(self) -> Callable:
+        """
+        Returns a plain function the rethinkdb driver can turn into a ReQL lambda.
+        """
+        raise NotImplementedError()
+
+    def evaluate(self, row) -> Any:
+        """
+        Applies the function to a document in Python, for queries answered from an in-memory replica (see
+        resync.replica).  Raises KeyError for missing fields, like the ReQL function would fail.
+        """
+        raise NotImplementedError()
+
+
 class QueryRunner:
 
     def __init__(self, table, queries):
         self.table = table
         self.queries = queries
         self._conn = None
+        self._cursor = None
+        self.info = None  # QueryInfo of the running query, only while instrumentation hooks are installed
+
+    def __del__(self):
+        if self._conn is not None:
+            # Dropped without being closed, e.g. by breaking out of an `async for` over a queryset
+            connection_pool.release_abandoned(self._conn, self._cursor)
 
     async def __aenter__(self):
         return self
@@ -100,19 +468,71 @@ class QueryRunner:
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.close()
 
-    async def run(self):
+    async def run(self, **run_options):
         """
-        Run a query against the database and return a cursor or query result as appropriate.
+        Run a query against the database and return a cursor or query result as appropriate.  `run_options` are
+        passed to the driver's `run`, e.g. `noreply=True`.
         Returns:
-            Result dictionary or cursor, depending on the type of the final query.
+            Result dictionary or cursor, depending on the type of the final query.  None for `noreply` queries.
         """
         self._conn = await connection_pool.get_conn()
-        query_to_run = self._build_query(self.table, self.queries)
-        result = await query_to_run.run(self._conn)
+        query_to_run = query_cache.get_query(self.table, self.queries)
+        if instrumentation.hooks:
+            result = await self._run_instrumented(query_to_run, run_options)
+        else:
+            result = await query_to_run.run(self._conn, **run_options)
+        if is_cursor(result):
+            self._cursor = result
         return result
 
+    def record_rows(self, rows: list):
+        """
+        Report a batch of rows read from the cursor returned by `run` to the instrumentation hooks.
+        """
+        if self.info is not None and rows:
+            instrumentation.rows_received(self.info, rows)
+
     async def close(self):
-        await connection_pool.put_conn(self._conn)
+        if self.info is not None:
+            self._finish()
+        self._cursor = None
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await connection_pool.put_conn(conn)
+
+    async def abort(self):
+        """
+        Close the cursor before it was read to the end, so the server stops sending its results, and release the
+        connection.
+        """
+        if self._cursor is not None:
+            _close_cursor(self._cursor)
+        await self.close()
+
+    async def _run_instrumented(self, query_to_run, run_options):
+        loop = asyncio.get_event_loop()
+        info = self.info = QueryInfo(self.table, self.queries, loop.time())
+        instrumentation.query_started(info)
+        try:
+            result = await query_to_run.run(self._conn, **run_options)
+        except Exception as e:
+            info.error = e
+            self._finish()
+            raise
+        info.latency = loop.time() - info.started
+        value = result['value'] if run_options.get('profile') and isinstance(result, dict) else result
+        if not is_cursor(value):
+            info.rows = count_rows(value)
+            if instrumentation.measure_bytes:
+                info.bytes = get_size(value)
+            self._finish()
+        # Otherwise it's finished when the cursor is closed
+        return result
+
+    def _finish(self):
+        info, self.info = self.info, None
+        info.duration = asyncio.get_event_loop().time() - info.started
+        instrumentation.query_finished(info)
 
     @staticmethod
     def _build_query(table: str, queries: Iterable[DatabaseQuery]):
@@ -123,10 +543,286 @@ class QueryRunner:
         final_query = r.table(table)
         for query_type, args, kwargs in queries:
             query_func = getattr(final_query, query_type)
+            args = [arg.as_function() if isinstance(arg, QueryFunction) else arg for arg in args]
             final_query = query_func(*args, **kwargs)
         return final_query
 
 
+def _close_cursor(cursor, loop=None):
+    """
+    Close a cursor which wasn't read to the end.  Some versions of the driver return the coroutine sending the
+    server the request to stop, which is scheduled.
+    """
+    try:
+        stopping = cursor.close()
+        if inspect.isawaitable(stopping):
+            asyncio.ensure_future(stopping, loop=loop)
+    except Exception:
+        l.debug('Exception in closing cursor', exc_info=True)
+
+
+class UncacheableQuery(Exception):
+    pass
+
+
+class CompiledQuery(RqlQuery):
+    """
+    A query which has already been built into the nested lists and dicts the driver sends as JSON, so running it
+    skips building the ReQL term objects from the DatabaseQuery tuples.
+    """
+
+    def __init__(self, built, table, queries):
+        super(CompiledQuery, self).__init__()
+        self._built = built
+        self._source = (table, queries)
+
+    def build(self):
+        return self._built
+
+    def compose(self, args, optargs):
+        # Used by the driver to print the query in error messages
+        return str(QueryRunner._build_query(*self._source))
+
+
+class QueryCache:
+    """
+    LRU cache of compiled queries, keyed on the shape of the query: the table, the query types, the names of the
+    fields in filters and updates, options etc. with the values left out.  The values are stood in for by unique
+    marker strings while compiling, and the positions of the markers in the built query are recorded, so for later
+    queries of the same shape only the values need to be built and slotted in.
+    """
+
+    MARKER_PREFIX = '\x00resync-param-'
+    MARKER = MARKER_PREFIX + '{}\x00'
+    _UNCACHEABLE = object()
+    _SCALAR_TYPES = (str, int, float, bool, type(None))
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._counters = dict.fromkeys(('hits', 'misses', 'uncacheable', 'evictions'), 0)
+
+    def get_query(self, table: str, queries: Tuple[DatabaseQuery]) -> RqlQuery:
+        """
+        Returns a query object ready to run, compiling and caching its shape if it hasn't been seen before.
+        """
+        if self.maxsize <= 0:
+            return QueryRunner._build_query(table, queries)
+        try:
+            shape, params = self._parametrize(queries)
+        except UncacheableQuery:
+            self._counters['uncacheable'] += 1
+            return QueryRunner._build_query(table, queries)
+
+        key = (table, shape)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._counters['misses'] += 1
+            entry = self._compile(table, queries)
+            self._entries[key] = entry
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+        else:
+            self._counters['hits'] += 1
+            self._entries.move_to_end(key)
+
+        if entry is self._UNCACHEABLE:
+            self._counters['uncacheable'] += 1
+            return QueryRunner._build_query(table, queries)
+        template, param_positions = entry
+        built = self._fill(template, param_positions, [self._build_param(param) for param in params])
+        return CompiledQuery(built, table, queries)
+
+    def resize(self, maxsize: int):
+        """
+        Change the maximum number of cached query shapes, 0 disables the cache.
+        """
+        self.maxsize = maxsize
+        while len(self._entries) > max(maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> QueryCacheStats:
+        return QueryCacheStats(size=len(self._entries), maxsize=self.maxsize, **self._counters)
+
+    def _parametrize(self, queries, markers=None):
+        """
+        Split queries into their shape and their parameter values.  If a list is passed as `markers`, it is filled
+        with copies of the queries with the parameters replaced by marker strings.
+        Raises:
+            UncacheableQuery if the queries contain something that can't be parametrized safely, e.g. a lambda.
+        """
+        shape = []
+        params = []
+        for query_type, args, kwargs in queries:
+            arg_shapes = []
+            marker_args = []
+            for arg in args:
+                arg_shape, marker_arg = self._parametrize_value(arg, params, markers is not None)
+                arg_shapes.append(arg_shape)
+                marker_args.append(marker_arg)
+            kwarg_shapes = []
+            for name, value in sorted(kwargs.items()):
+                if isinstance(value, RqlQuery):
+                    kwarg_shapes.append((name, self._term_shape(value)))
+                elif isinstance(value, self._SCALAR_TYPES):
+                    kwarg_shapes.append((name, value))
+                else:
+                    raise UncacheableQuery()
+            shape.append((query_type, tuple(arg_shapes), tuple(kwarg_shapes)))
+            if markers is not None:
+                markers.append((query_type, tuple(marker_args), kwargs))
+        return tuple(shape), params
+
+    def _parametrize_value(self, value, params, with_markers):
+        if isinstance(value, RqlQuery):
+            return ('term', self._term_shape(value)), value
+        if isinstance(value, QueryFunction):
+            start = len(params)
+            for param in value.params:
+                self._check_param(param)
+            params.extend(value.params)
+            marker_value = value.bind([self.MARKER.format(i) for i in range(start, len(params))]) \
+                if with_markers else None
+            return (type(value), value.shape), marker_value
+        if isinstance(value, dict):
+            marker_value = {}
+            for key, item in value.items():
+                self._check_param(item)
+                marker_value[key] = self.MARKER.format(len(params))
+                params.append(item)
+            return ('dict', tuple(value)), marker_value
+        self._check_param(value)
+        params.append(value)
+        return 'param', self.MARKER.format(len(params) - 1)
+
+    def _check_param(self, value):
+        """
+        Values containing ReQL terms (e.g. `r.row`) or functions can change how the driver builds the query around
+        them, so they have to be part of the shape, which we don't support.
+        """
+        if isinstance(value, (RqlQuery, QueryFunction)) or callable(value):
+            raise UncacheableQuery()
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, (RqlQuery, QueryFunction)) or callable(item):
+                    raise UncacheableQuery()
+
+    def _term_shape(self, term):
+        built = self._build_term(term)
+        if self._contains_function(built):
+            raise UncacheableQuery()  # Lambdas get new variable ids every time they're built
+        return json.dumps(built, sort_keys=True)
+
+    @classmethod
+    def _contains_function(cls, built) -> bool:
+        """
+        In a built query every list is a term of the form [type, [args], {optargs}], literal arrays are MAKE_ARRAY
+        terms.
+        """
+        if isinstance(built, list):
+            if built[0] == Term.TermType.FUNC:
+                return True
+            return any(cls._contains_function(arg) for arg in built[1]) or \
+                any(cls._contains_function(optarg) for optarg in built[2:])
+        if isinstance(built, dict):
+            return any(cls._contains_function(value) for value in built.values())
+        return False
+
+    def _compile(self, table, queries):
+        """
+        Build the query once with markers instead of parameters, and record where each marker ended up.
+        """
+        marker_queries = []
+        shape, params = self._parametrize(queries, marker_queries)
+        template = self._build_term(QueryRunner._build_query(table, marker_queries))
+        positions = {}
+        self._find_markers(template, (), positions)
+        if sorted(positions) != list(range(len(params))):
+            # The driver did something unexpected with a parameter, play it safe
+            l.debug('Query shape not cacheable: {}'.format(shape))
+            return self._UNCACHEABLE
+        param_positions = {}
+        for index, paths in positions.items():
+            for path in paths:
+                node = param_positions
+                for key in path[:-1]:
+                    node = node.setdefault(key, {})
+                node[path[-1]] = index
+        return template, param_positions
+
+    def _find_markers(self, node, path, positions):
+        if isinstance(node, str):
+            if node.startswith(self.MARKER_PREFIX):
+                positions.setdefault(int(node[len(self.MARKER_PREFIX):-1]), []).append(path)
+        elif isinstance(node, list):
+            for i, item in enumerate(node):
+                self._find_markers(item, path + (i,), positions)
+        elif isinstance(node, dict):
+            for key, item in node.items():
+                self._find_markers(item, path + (key,), positions)
+
+    @classmethod
+    def _fill(cls, node, param_positions, values):
+        """
+        Copy the template, replacing markers with values.  Only the containers leading to a marker are copied, the
+        rest of the template is shared between queries.
+        """
+        node = list(node) if isinstance(node, list) else dict(node)
+        for key, position in param_positions.items():
+            if isinstance(position, int):
+                node[key] = values[position]
+            else:
+                node[key] = cls._fill(node[key], position, values)
+        return node
+
+    @classmethod
+    def _build_param(cls, value):
+        if isinstance(value, cls._SCALAR_TYPES):
+            return value
+        return cls._build_term(r.expr(value))
+
+    @classmethod
+    def _build_term(cls, term):
+        """
+        Fully build a term into plain lists and dicts, the driver's own `build` only does one level.
+        """
+        if isinstance(term, RqlQuery):
+            term = term.build()
+        if isinstance(term, list):
+            return [cls._build_term(item) for item in term]
+        if isinstance(term, dict):
+            return {key: cls._build_term(item) for key, item in term.items()}
+        return term
+
+query_cache = QueryCache()
+
+
+async def fetch_batch(cursor, size: int) -> list:
+    """
+    Get up to `size` results from a cursor in one go.  Waits only if the driver has nothing buffered, otherwise takes
+    whatever it already received from the server instead of awaiting each row separately.
+    Returns:
+        A list of raw results, empty once the cursor is exhausted.
+    """
+    if not await cursor.fetch_next():
+        return []
+    items = cursor.items
+    if not items:
+        # fetch_next returns True when there's an error waiting, let next() raise it
+        return [await cursor.next()]
+    if size >= len(items):
+        batch = list(items)
+        items.clear()
+    else:
+        batch = [items.popleft() for _ in range(size)]
+    cursor._maybe_fetch_batch()  # Ask for the next batch from the server, as cursor.next() would have done
+    return batch
+
+
 def get_sync_connection(timeout=20):
     """
     Convenience method for testing.
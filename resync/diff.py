@@ -1,6 +1,10 @@
-from typing import NamedTuple, Union, List, Tuple, Any
+from collections.abc import Sequence
+from copy import deepcopy
+from typing import NamedTuple, Union, List, Tuple, Any, Dict, Mapping
 
 import dictdiffer
+import rethinkdb as r
+from dictdiffer.utils import EPSILON, are_different
 
 DiffObject = NamedTuple('DiffObject', [
         ('change_type', str),
@@ -9,11 +13,13 @@ DiffObject = NamedTuple('DiffObject', [
     ])
 Diff = Union[object, DiffObject]
 
+_CONTAINER_TYPES = (dict, list, set)
+
 
 def get_diff_from_changeset(changeset) -> Diff:
     """
     Change a change object from rethink (dictionary with 2 keys, 'old_val' and 'new_val' into our internal
-    representation.
+    representation.  The list of DiffObjects is a ChangeDiff, only worked out when it is first used.
     """
     old, new = changeset['old_val'], changeset['new_val']
     if old is None:
@@ -21,10 +27,110 @@ def get_diff_from_changeset(changeset) -> Diff:
     elif new is None:
         diff = delete
     else:
-        diff = [DiffObject(*x) for x in dictdiffer.diff(old, new)]
+        diff = ChangeDiff(old, new)
     return diff
 
 
+class ChangeDiff(Sequence):
+    """
+    The DiffObjects between two versions of a document, the same as `dictdiffer.diff` would give, in the same order.
+    Works like a read-only list, and compares equal to a list with the same items.
+
+    They are only computed when the diff is first used, so changes nobody looks at cost nothing.  Top level fields are
+    compared directly, dictdiffer only has to walk nested objects and lists which changed.
+    """
+
+    __slots__ = ('_old', '_new', '_items')
+
+    def __init__(self, old: Mapping[str, Any], new: Mapping[str, Any]):
+        self._old = old
+        self._new = new
+        self._items = None
+
+    def _get_items(self) -> List[DiffObject]:
+        if self._items is None:
+            self._items = _diff_documents(self._old, self._new)
+            self._old = self._new = None  # Only needed until the diff is worked out
+        return self._items
+
+    def __getitem__(self, index):
+        return self._get_items()[index]
+
+    def __len__(self):
+        return len(self._get_items())
+
+    def __iter__(self):
+        return iter(self._get_items())
+
+    def __eq__(self, other):
+        if isinstance(other, ChangeDiff):
+            other = other._get_items()
+        return isinstance(other, list) and self._get_items() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._get_items())
+
+
+def _diff_documents(old: Mapping[str, Any], new: Mapping[str, Any]) -> List[DiffObject]:
+    """
+    `dictdiffer.diff(old, new)` for two documents, only calling it for the nested values which differ.
+    """
+    diff = []
+    removed = []
+    for key, old_value in old.items():
+        if key not in new:
+            removed.append((key, deepcopy(old_value)))
+            continue
+        new_value = new[key]
+        if old_value == new_value:
+            continue
+        if isinstance(old_value, _CONTAINER_TYPES) and type(old_value) is type(new_value):
+            diff.extend(DiffObject(*x) for x in dictdiffer.diff(old_value, new_value, node=[key]))
+        elif are_different(old_value, new_value, EPSILON):
+            diff.append(DiffObject('change', _get_key_path(key), (deepcopy(old_value), deepcopy(new_value))))
+    added = [(key, deepcopy(new_value)) for key, new_value in new.items() if key not in old]
+    if added:
+        diff.append(DiffObject('add', '', added))
+    if removed:
+        diff.append(DiffObject('remove', '', removed))
+    return diff
+
+
+def _get_key_path(key) -> Union[str, List[Union[str, int]]]:
+    """
+    The key path dictdiffer gives for a top level field.
+    """
+    if isinstance(key, str) and '.' not in key:
+        return key
+    return [key]
+
+
+def get_update_patch(old: Mapping[str, Any], new: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    Returns the argument for rethinkdb's `update` which turns document `old` into `new`, with only the fields which
+    changed.  `update` merges nested objects, so they only include their own changed fields, unless some were removed,
+    in which case the whole object is replaced with `r.literal`.  Fields missing from `new` are left alone.
+    """
+    patch = {}
+    for key, new_value in new.items():
+        old_value = old.get(key)
+        if key in old and old_value == new_value:
+            continue
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            if old_value.keys() - new_value.keys():
+                patch[key] = r.literal(new_value)
+            else:
+                patch[key] = get_update_patch(old_value, new_value)
+        else:
+            patch[key] = new_value
+    return patch
+
+
 # These singletons are returned instead of a list of DiffObjects when an object is created or deleted
 create = object()
 delete = object()
@@ -1,7 +1,11 @@
 from collections import MutableSequence, MutableMapping
+from functools import partial
+from operator import attrgetter, methodcaller
 
 import arrow
 
+from resync import codecs
+
 
 class Field:
     """
@@ -14,9 +18,15 @@ class Field:
 
     MUTABLE_DEFAULT_ERR = 'Try not to use mutable default arguments. You probably want a NestedDocument or ListField'
 
-    def __init__(self, default=None):
+    def __init__(self, default=None, index=False):
+        """
+        Args:
+            default: Value (or callable returning the value) for new instances and documents missing this field
+            index: Declare a secondary index on this field, see `resync.ensure_indexes`
+        """
         assert not isinstance(default, (MutableSequence, MutableMapping)), self.MUTABLE_DEFAULT_ERR
         self._default = default
+        self.index = index
         self.name = None
 
     @property
@@ -34,14 +44,28 @@ class Field:
     def from_db(value):
         return value
 
+    def get_encoder(self) -> codecs.Converter:
+        """
+        Describes `to_db` for the generated model codecs, see resync.codecs.  Must be overridden together with
+        `to_db`.
+        """
+        return None, True
+
+    def get_decoder(self) -> codecs.Converter:
+        """
+        Describes `from_db` for the generated model codecs, see resync.codecs.  Must be overridden together with
+        `from_db`.
+        """
+        return None, True
+
 
 class ForeignKeyField(Field):
     """
     Used to reference objects in another table.
     """
 
-    def __init__(self, model, related_name=None):
-        super(ForeignKeyField, self).__init__()
+    def __init__(self, model, related_name=None, index=False):
+        super(ForeignKeyField, self).__init__(index=index)
         self.model = model
         self.related_name = related_name
 
@@ -52,6 +76,12 @@ class ForeignKeyField(Field):
     def from_db(self, value):
         return RelatedObjectProxy(self.model, value)
 
+    def get_encoder(self):
+        return attrgetter('id'), True
+
+    def get_decoder(self):
+        return partial(RelatedObjectProxy, self.model), False
+
 
 class RelatedObjectProxy:
     """
@@ -96,6 +126,12 @@ class NestedDocumentField(Field):
     def from_db(self, value):
         return self.inner.from_db(value) if value is not None else None
 
+    def get_encoder(self):
+        return methodcaller('to_db'), True
+
+    def get_decoder(self):
+        return self.inner.from_db, True
+
 
 class ListField(Field):
     """
@@ -112,6 +148,21 @@ class ListField(Field):
     def from_db(self, value):
         return [self.inner.from_db(inner_obj) for inner_obj in value]
 
+    def get_encoder(self):
+        return self._list_converter(codecs.get_field_encoder(self.inner)), False
+
+    def get_decoder(self):
+        return self._list_converter(codecs.get_field_decoder(self.inner)), False
+
+    @staticmethod
+    def _list_converter(inner_converter: codecs.Converter):
+        convert, none_passthrough = inner_converter
+        if convert is None:
+            return list
+        if none_passthrough:
+            return lambda value: [None if item is None else convert(item) for item in value]
+        return lambda value: [convert(item) for item in value]
+
 
 class DictField(Field):
     """
@@ -127,6 +178,8 @@ def field_factory(name, to_db, from_db):
     field_class = type(name, (Field,), {})
     field_class.to_db = staticmethod(lambda x: to_db(x) if x is not None else None)
     field_class.from_db = staticmethod(lambda x: from_db(x) if x is not None else None)
+    field_class.get_encoder = lambda self: (to_db, True)
+    field_class.get_decoder = lambda self: (from_db, True)
     return field_class
 
 StrField = field_factory('StrField', str, str)
@@ -145,6 +198,12 @@ class DateTimeField(Field):
     def from_db(value):
         return arrow.get(value) if value is not None else None
 
+    def get_encoder(self):
+        return methodcaller('isoformat'), True
+
+    def get_decoder(self):
+        return arrow.get, True
+
 
 class IntEnumField(Field):
 
@@ -164,6 +223,13 @@ class IntEnumField(Field):
     def from_db(self, value):
         return self.enum_class(int(value)) if value is not None else None
 
+    def get_encoder(self):
+        return self.to_db, False
+
+    def get_decoder(self):
+        enum_class = self.enum_class
+        return lambda value: enum_class(int(value)), True
+
 
 class ReverseForeignKeyField:
     """
@@ -171,9 +237,22 @@ class ReverseForeignKeyField:
     user code.
     """
 
-    def __init__(self, target_model, field_name):
+    def __init__(self, target_model, field_name, related_name=None):
         self.target_model = target_model
         self.field_name = field_name
+        self.related_name = related_name
 
     def get_queryset(self, id):
         return self.target_model.objects.filter(**{self.field_name: id})
+
+    def __get__(self, instance, owner):
+        """
+        Only set on compact models, which can't hold the queryset as an instance attribute like other models do.
+        """
+        if instance is None:
+            return self
+        if instance.id is None:
+            raise AttributeError('{} must be saved before following its reverse relations'.format(owner.__name__))
+        queryset = self.get_queryset(instance.id)
+        queryset._result_cache = instance._get_prefetched().get(self.related_name)
+        return queryset
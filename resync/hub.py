@@ -0,0 +1,261 @@
+import asyncio
+import json
+from collections import OrderedDict
+from logging import getLogger
+from typing import Any, Mapping, NamedTuple, Optional, Tuple
+
+from resync.connection import query_cache, UncacheableQuery
+from resync.diff import Diff
+from resync.queryset import AsyncChangeFeed, BaseQueryset, PRIMARY_KEY
+
+l = getLogger('resync.hub')
+
+HubStats = NamedTuple('HubStats', [
+    ('feeds', int),
+    ('subscribers', int),
+    ('delivered', int),
+    ('dropped', int),
+    ('coalesced', int),
+    ('disconnected', int),
+])
+
+DROP = 'drop'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+SLOW_CONSUMER_POLICIES = frozenset([DROP, COALESCE, DISCONNECT])
+
+
+class SlowConsumerError(Exception):
+    pass
+
+
+class ChangefeedHub:
+    """
+    Shares changefeeds between subscribers: querysets with the same changes query (same table, filters and values)
+    are served by one feed on the server, and each change is decoded once and fanned out to the subscribers' queues.
+    A feed is closed when its last subscriber leaves, and resubscribed after `RETRY_DELAY` seconds if it fails.
+
+    Each subscriber has a queue of up to `maxsize` changes, and a policy for when it falls behind and its queue is full:
+        - 'drop': drop the oldest queued change.
+        - 'coalesce': merge changes to a document which already has one queued into that one, so the subscriber sees
+          its latest state and the diff from the state it last saw, and drop the oldest change if the queue is still
+          full.
+        - 'disconnect': close the subscription, the subscriber gets a SlowConsumerError once it has read the changes
+          already queued.  Later changes are lost unless it subscribes again.
+    """
+
+    RETRY_DELAY = 1.0
+
+    def __init__(self):
+        self._feeds = {}
+        self._counters = dict.fromkeys(('delivered', 'dropped', 'coalesced', 'disconnected'), 0)
+
+    def subscribe(self, queryset: BaseQueryset, maxsize: int=1000, policy: str=DROP,
+                  **changes_options) -> 'Subscription':
+        """
+        Subscribe to the changes of a queryset, e.g.:
+            async with changefeed_hub.subscribe(Widget.objects.filter(owner=user_id)) as subscription:
+                async for widget, diff in subscription:
+                    ...
+        Changes to a document are delivered in order.  Instances are shared between subscribers, don't modify them.
+        `changes_options` are passed to rethinkdb's `changes`, subscriptions with different options don't share a feed.
+        """
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError('Unknown slow consumer policy {}, expected one of {}'.format(
+                policy, ', '.join(sorted(SLOW_CONSUMER_POLICIES))))
+        queries = queryset.queries + (('changes', tuple(), changes_options),)
+        key = _get_feed_key(queryset.model.table, queries)
+        feed = self._feeds.get(key)
+        if feed is None:
+            feed = self._feeds[key] = SharedFeed(self, key, queryset.model, queries)
+        subscription = Subscription(self, feed, maxsize, policy)
+        feed.subscribers.append(subscription)
+        return subscription
+
+    def stats(self) -> HubStats:
+        return HubStats(
+            feeds=len(self._feeds),
+            subscribers=sum(len(feed.subscribers) for feed in self._feeds.values()),
+            **self._counters
+        )
+
+    async def close(self):
+        """
+        Close all feeds and subscriptions.
+        """
+        feeds = list(self._feeds.values())
+        self._feeds.clear()
+        for feed in feeds:
+            for subscription in list(feed.subscribers):
+                subscription.close()
+            await feed.close()
+
+    def _unsubscribe(self, subscription: 'Subscription'):
+        feed = subscription.feed
+        if subscription in feed.subscribers:
+            feed.subscribers.remove(subscription)
+        if not feed.subscribers and self._feeds.get(feed.key) is feed:
+            del self._feeds[feed.key]
+            asyncio.ensure_future(feed.close())
+
+
+class SharedFeed:
+    """
+    One changefeed on the server, see ChangefeedHub.
+    """
+
+    def __init__(self, hub: ChangefeedHub, key, model, queries):
+        self.hub = hub
+        self.key = key
+        self.model = model
+        self.queries = queries
+        self.subscribers = []
+        self._decoder = AsyncChangeFeed(model)
+        self._task = asyncio.ensure_future(self._follow_changes())
+
+    def decode(self, change: Mapping[str, Any]) -> Tuple[Any, Diff]:
+        return self._decoder.transform_query_result(change)
+
+    async def close(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _follow_changes(self):
+        while True:
+            feed = BaseQueryset(self.model, self.queries)
+            try:
+                await feed.__aiter__()
+                while True:
+                    changes = await feed._next_batch(feed.DEFAULT_BATCH_SIZE)
+                    if not changes:
+                        break
+                    for change in changes:
+                        self._publish(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                l.debug('Exception in shared changefeed on {}'.format(self.model.table), exc_info=True)
+            finally:
+                await feed.aclose()
+            await asyncio.sleep(self.hub.RETRY_DELAY)
+
+    def _publish(self, change):
+        if not self.subscribers:
+            return
+        event = self.decode(change)
+        for subscription in list(self.subscribers):
+            subscription._put(change, event)
+
+
+class Subscription:
+    """
+    A subscriber's queue of changes from a shared feed, iterate over it with `async for` to get (instance, diff)
+    pairs like from Queryset.changes().  Close it when done, or use it as an async context manager.
+    """
+
+    def __init__(self, hub: ChangefeedHub, feed: SharedFeed, maxsize: int, policy: str):
+        self.hub = hub
+        self.feed = feed
+        self.maxsize = maxsize
+        self.policy = policy
+        self._queue = OrderedDict()  # Entry key -> [raw change, decoded (instance, diff) or None], oldest first
+        self._next_key = 0
+        self._waiter = None
+        self._closed = False
+        self._error = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Tuple[Any, Diff]:
+        while not self._queue:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = asyncio.Future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        _, (change, event) = self._queue.popitem(last=False)
+        self.hub._counters['delivered'] += 1
+        if event is None:
+            event = self.feed.decode(change)
+        return event
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.hub._unsubscribe(self)
+            self._wake()
+
+    def _put(self, change: Mapping[str, Any], event: Tuple[Any, Diff]):
+        if self._closed:
+            return
+        counters = self.hub._counters
+        id = _get_document_id(change) if self.policy == COALESCE else None
+        if id is not None:
+            key = ('id', id)
+            entry = self._queue.get(key)
+            if entry is not None:
+                self._coalesce(key, entry, change)
+                counters['coalesced'] += 1
+                return
+        else:
+            key = ('change', self._next_key)
+            self._next_key += 1
+        if len(self._queue) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                counters['disconnected'] += 1
+                self._error = SlowConsumerError(
+                    'Subscriber fell more than {} changes behind the changefeed on {}'.format(
+                        self.maxsize, self.feed.model.table))
+                self.close()
+                return
+            self._queue.popitem(last=False)
+            counters['dropped'] += 1
+        self._queue[key] = [change, event]
+        self._wake()
+
+    def _coalesce(self, key, entry, change):
+        """
+        Replace the queued change with one from the state before it to the state after the new change.
+        """
+        merged_change = {'old_val': entry[0].get('old_val'), 'new_val': change.get('new_val')}
+        if merged_change['old_val'] is None and merged_change['new_val'] is None:
+            del self._queue[key]  # Created and deleted since the subscriber last looked
+        else:
+            self._queue[key] = [merged_change, None]
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+def _get_document_id(change: Mapping[str, Any]) -> Optional[Any]:
+    document = change.get('new_val') or change.get('old_val') or {}
+    return document.get(PRIMARY_KEY)
+
+
+def _get_feed_key(table: str, queries):
+    """
+    Changes queries with the same shape and parameter values share a feed.
+    """
+    try:
+        shape, params = query_cache._parametrize(queries)
+    except UncacheableQuery:
+        return object()  # Can't tell whether it's the same as another query, give it its own feed
+    return table, shape, json.dumps(params, sort_keys=True, default=repr)
+
+
+changefeed_hub = ChangefeedHub()
@@ -0,0 +1,144 @@
+"""
+Identity map, so that each document is decoded and held only once per unit of work, e.g.:
+
+    async with resync.identity_scope():
+        widget = await Widget.objects.get(id=widget_id)
+        same_widget = await Widget.objects.get(id=widget_id)  # No query, `same_widget is widget`
+
+Inside a scope, querysets return the instance already loaded for a `(table, id)` pair instead of decoding the document
+again, and `get(id=...)` doesn't query the database at all if the instance is loaded.  Instances keep the values they
+were first loaded with, use a new scope (or none) to see later changes.
+"""
+import asyncio
+import weakref
+from typing import Any, Callable, Mapping, Optional
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7
+    ContextVar = None
+
+PRIMARY_KEY = 'id'
+
+
+class IdentityMap:
+    """
+    The instances loaded in an identity scope, by table and primary key.
+    """
+
+    def __init__(self):
+        self._instances = {}
+
+    def __len__(self):
+        return len(self._instances)
+
+    def get(self, model, id):
+        """
+        Returns the instance of the model with the given primary key, or None if it isn't loaded.
+        """
+        return self._instances.get((model.table, id))
+
+    def add(self, instance):
+        if instance.id is not None:
+            self._instances[(instance.__class__.table, instance.id)] = instance
+
+    def discard(self, model, id):
+        self._instances.pop((model.table, id), None)
+
+    def discard_all(self, model):
+        """
+        Forget all the instances of the model, e.g. when documents were deleted without knowing which.
+        """
+        for key in [key for key in self._instances if key[0] == model.table]:
+            del self._instances[key]
+
+    def clear(self):
+        self._instances.clear()
+
+    def get_or_decode(self, model, document: Mapping[str, Any], decode: Callable[[Mapping[str, Any]], Any]):
+        """
+        Returns the loaded instance for the document if there is one, otherwise decodes the document with `decode`
+        and adds the new instance.
+        """
+        id = document.get(PRIMARY_KEY)
+        if id is None:
+            return decode(document)
+        key = (model.table, id)
+        instance = self._instances.get(key)
+        if instance is None:
+            instance = self._instances[key] = decode(document)
+        return instance
+
+
+class _TaskLocal:
+    """
+    Stand-in for `contextvars.ContextVar` before Python 3.7.  The value is local to the current task and, unlike with
+    a ContextVar, isn't inherited by the tasks it starts.
+    """
+
+    def __init__(self, name: str, default=None):
+        self.name = name
+        self._default = default
+        self._task_values = weakref.WeakKeyDictionary()
+        self._value = default  # Outside of any task
+
+    def get(self):
+        task = asyncio.Task.current_task()
+        if task is None:
+            return self._value
+        return self._task_values.get(task, self._default)
+
+    def set(self, value):
+        """
+        Returns the previous value, as the token to pass to `reset`.
+        """
+        token = self.get()
+        task = asyncio.Task.current_task()
+        if task is None:
+            self._value = value
+        else:
+            self._task_values[task] = value
+        return token
+
+    def reset(self, token):
+        self.set(token)
+
+
+_current_identity_map = (ContextVar or _TaskLocal)('resync_identity_map', default=None)
+
+
+def get_identity_map() -> Optional[IdentityMap]:
+    """
+    Returns the identity map of the current scope, or None outside of any scope.
+    """
+    return _current_identity_map.get()
+
+
+class identity_scope:
+    """
+    Async (or plain) context manager opening an identity scope, returns its IdentityMap.  A scope opened inside
+    another one shares its identity map.
+    """
+
+    def __init__(self):
+        self._opened = False
+        self._token = None
+
+    def __enter__(self) -> IdentityMap:
+        identity_map = get_identity_map()
+        if identity_map is None:
+            identity_map = IdentityMap()
+            self._token = _current_identity_map.set(identity_map)
+            self._opened = True
+        return identity_map
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._opened:
+            _current_identity_map.reset(self._token)
+            self._opened = False
+
+    async def __aenter__(self) -> IdentityMap:
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.__exit__(exc_type, exc_val, exc_tb)
@@ -0,0 +1,245 @@
+"""
+Hooks into the queries resync runs, for timing and logging them, e.g.:
+
+    from resync.instrumentation import instrumentation, QueryStats, SlowQueryLog
+
+    query_stats = QueryStats()
+    instrumentation.add_hook(query_stats)
+    instrumentation.add_hook(SlowQueryLog(threshold=0.5))
+    ...
+    json.dumps(query_stats.snapshot())
+
+Nothing is measured while no hooks are installed.
+"""
+import bisect
+import json
+from logging import getLogger
+from typing import Any, Dict, Optional, Sequence
+
+l = getLogger('resync.instrumentation')
+
+# Upper bounds (seconds) of the latency histogram buckets, the last one catches everything slower
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class QueryInfo:
+    """
+    What is known about a query, handed to the hooks and filled in as the query runs.  Times are in seconds, from the
+    event loop's clock:
+        - `latency`: from sending the query until the first response.
+        - `duration`: from sending the query until it finished, i.e. for cursors until the cursor was closed after
+          reading its rows.
+        - `rows`: rows received so far, 1 for a single value (e.g. a write's counts), 0 for None.
+        - `bytes`: size of the rows as JSON, only measured if `instrumentation.measure_bytes` is on, None otherwise.
+        - `error`: the exception the query raised, if any.
+    """
+
+    __slots__ = ('table', 'queries', 'started', 'latency', 'duration', 'rows', 'bytes', 'error')
+
+    def __init__(self, table: str, queries: Sequence, started: float):
+        self.table = table
+        self.queries = queries
+        self.started = started
+        self.latency = None
+        self.duration = None
+        self.rows = 0
+        self.bytes = None
+        self.error = None
+
+    @property
+    def shape(self) -> str:
+        """
+        The query's steps without their arguments, e.g. 'get_all.filter.limit', to group similar queries by.
+        """
+        return '.'.join(query_type for query_type, args, kwargs in self.queries)
+
+    @property
+    def is_changefeed(self) -> bool:
+        return any(query_type == 'changes' for query_type, args, kwargs in self.queries)
+
+    def __repr__(self):
+        return '<QueryInfo {}.{} latency={} rows={}>'.format(self.table, self.shape, self.latency, self.rows)
+
+
+class QueryHook:
+    """
+    Base class for hooks, override the methods for the events you want.  Hooks are called synchronously in the
+    middle of running queries, so they should be quick; exceptions they raise are logged and otherwise ignored.
+    """
+
+    def query_started(self, query: QueryInfo):
+        """
+        Called when a query is about to be sent, once it has a connection.
+        """
+
+    def rows_received(self, query: QueryInfo, rows: list):
+        """
+        Called with each batch of rows read from a cursor.  For changefeeds (`query.is_changefeed`) these are the
+        changes.
+        """
+
+    def query_finished(self, query: QueryInfo):
+        """
+        Called once a query has its result, or for cursors once the cursor is closed, or when the query failed.
+        Cursors which are abandoned before they're read to the end aren't reported.
+        """
+
+    def connection_acquired(self, wait_time: float):
+        """
+        Called when a connection is taken from the pool, with the seconds spent waiting for it.
+        """
+
+
+class Instrumentation:
+    """
+    Dispatches events to the installed hooks, see QueryHook.  `measure_bytes` turns on measuring the size of the
+    rows, which means encoding them to JSON again.
+    """
+
+    def __init__(self):
+        self.hooks = []  # QueryHooks, called in the order they were added
+        self.measure_bytes = False
+
+    def add_hook(self, hook: QueryHook):
+        if hook not in self.hooks:
+            self.hooks.append(hook)
+
+    def remove_hook(self, hook: QueryHook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
+
+    def query_started(self, query: QueryInfo):
+        self._dispatch('query_started', query)
+
+    def rows_received(self, query: QueryInfo, rows: list):
+        query.rows += len(rows)
+        if self.measure_bytes:
+            query.bytes = (query.bytes or 0) + get_size(rows)
+        self._dispatch('rows_received', query, rows)
+
+    def query_finished(self, query: QueryInfo):
+        self._dispatch('query_finished', query)
+
+    def connection_acquired(self, wait_time: float):
+        self._dispatch('connection_acquired', wait_time)
+
+    def _dispatch(self, event, *args):
+        for hook in list(self.hooks):
+            try:
+                getattr(hook, event)(*args)
+            except Exception:
+                l.debug('Exception in {} hook of {!r}'.format(event, hook), exc_info=True)
+
+instrumentation = Instrumentation()
+
+
+class SlowQueryLog(QueryHook):
+    """
+    Logs queries whose latency is at least `threshold` seconds, and failed queries, as warnings.
+    """
+
+    def __init__(self, threshold: float=1.0, logger=None):
+        self.threshold = threshold
+        self.logger = logger or getLogger('resync.slow_queries')
+
+    def query_finished(self, query: QueryInfo):
+        if query.error is not None:
+            self.logger.warning('Query on {} failed after {:.3f}s: {}: {!r}'.format(
+                query.table, query.duration, query.shape, query.error))
+        elif query.latency is not None and query.latency >= self.threshold:
+            self.logger.warning('Slow query on {} ({:.3f}s, {} rows): {}'.format(
+                query.table, query.latency, query.rows, query.queries))
+
+
+class LatencyHistogram:
+    """
+    Counts of observed latencies in buckets, given by their upper bounds in seconds.
+    """
+
+    def __init__(self, buckets: Sequence[float]=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[min(bisect.bisect_left(self.buckets, value), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """
+        The upper bound of the bucket holding the given fraction (e.g. 0.99) of observations, None if there are none.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'buckets': [[_format_bound(bound), count] for bound, count in zip(self.buckets, self.counts)],
+            'count': self.count,
+            'sum': self.total,
+        }
+
+
+class QueryStats(QueryHook):
+    """
+    Counts queries, errors, rows and bytes, with a latency histogram, for each table (i.e. each model).
+    `snapshot()` gives them as plain dicts and lists, ready to be exported as JSON.
+    """
+
+    def __init__(self, buckets: Sequence[float]=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._tables = {}
+
+    def query_finished(self, query: QueryInfo):
+        stats = self._tables.get(query.table)
+        if stats is None:
+            stats = self._tables[query.table] = {
+                'queries': 0, 'errors': 0, 'rows': 0, 'bytes': 0, 'latency': LatencyHistogram(self.buckets)}
+        stats['queries'] += 1
+        if query.error is not None:
+            stats['errors'] += 1
+        stats['rows'] += query.rows
+        stats['bytes'] += query.bytes or 0
+        if query.latency is not None:
+            stats['latency'].observe(query.latency)
+
+    def get_histogram(self, table: str) -> Optional[LatencyHistogram]:
+        stats = self._tables.get(table)
+        return stats['latency'] if stats is not None else None
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {table: dict(stats, latency=stats['latency'].snapshot()) for table, stats in self._tables.items()}
+
+    def reset(self):
+        self._tables.clear()
+
+
+def is_cursor(result) -> bool:
+    return hasattr(result, 'fetch_next')
+
+
+def count_rows(result) -> int:
+    if result is None:
+        return 0
+    return len(result) if isinstance(result, list) else 1
+
+
+def get_size(value) -> int:
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _format_bound(bound: float):
+    # JSON has no infinity
+    return '+Inf' if bound == float('inf') else bound
@@ -1,45 +1,171 @@
 import asyncio
+import random
 from collections import Awaitable
 from logging import getLogger
-from typing import Callable
+from typing import Callable, List, Tuple, Union
 
 from rethinkdb import ReqlTimeoutError, ReqlAvailabilityError
 
 from resync.diff import Diff
+from resync.hub import DISCONNECT, SlowConsumerError, changefeed_hub
 from resync.models import Model
 from resync.queryset import Queryset
 
 l = getLogger('resync.listener')
 
+Change = Tuple[Model, Diff]
+
+_STOP = object()  # Queued for the workers when the listener stops reading changes
+
 
 class ChangeListener:
     """
     Generic change listener, listens to a given Queryset for changes and calls provided callback with the results.
-    Recovers from connection being dropped.
+    Recovers from connection being dropped, resubscribing after an exponentially growing, jittered delay so that many
+    listeners don't all reconnect at the same moment.
+
+    Callbacks run in `concurrency` workers.  Changes to the same document always go to the same worker, so they are
+    handled in order.  Each worker has a queue of up to `queue_size` changes, when a queue is full the listener stops
+    reading from the changefeed until the worker catches up.
     """
 
-    def __init__(self, queryset: Queryset, callback: Callable[[Model, Diff], Awaitable]):
+    def __init__(self, queryset: Queryset, callback: Callable[..., Awaitable], shared: bool=False,
+                 concurrency: int=1, queue_size: int=100, batch_size: int=None, batch_timeout: float=0.05,
+                 squash: Union[bool, float]=None, retry_delay: float=0.5, max_retry_delay: float=30.0,
+                 max_retries: int=None, policy: str=DISCONNECT):
         """
         Args:
             queryset: The queryset on which to listen for changes.
-            callback: The callback to call with each change.  Should have the signature (Model, Diff) -> Awaitable
+            callback: The callback to call with each change.  Should have the signature (Model, Diff) -> Awaitable,
+                or List[(Model, Diff)] -> Awaitable if `batch_size` is given.
+            shared: Subscribe through `resync.changefeed_hub`, sharing one changefeed with other listeners on the
+                same queryset.
+            concurrency: Number of callbacks running at once.
+            queue_size: Number of changes waiting for each worker before the listener stops reading more.
+            batch_size: Call the callback with lists of up to `batch_size` changes.
+            batch_timeout: Seconds to wait for a batch to fill up after its first change.
+            squash: Passed to the changefeed, to have the server combine changes to a document over the given number
+                of seconds (True: as long as the listener is behind).
+            retry_delay: Base delay in seconds before resubscribing after a database error, doubled with each attempt.
+            max_retry_delay: Upper bound of the delay before resubscribing.
+            max_retries: Give up and raise after this many consecutive failures, None to retry forever.
+            policy: With `shared`, what the hub does when the listener falls behind the shared changefeed, see
+                ChangefeedHub.  By default the listener is disconnected, handles the changes already queued for it
+                and resubscribes like after a database error, losing the changes which arrive in between.  'drop'
+                and 'coalesce' lose changes while it is behind instead.  A shared listener stops when the hub is
+                closed, e.g. by `resync.teardown()`.
         """
+        assert concurrency >= 1, 'Expected concurrency >= 1'
         self.queryset = queryset
         self.callback = callback
+        self.shared = shared
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.squash = squash
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retries = max_retries
+        self.policy = policy
 
     async def listen(self):
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.concurrency)]
+        workers = [asyncio.ensure_future(self._work(queue)) for queue in queues]
+        reader = asyncio.ensure_future(self._read_changes(queues))
+        tasks = workers + [reader]
         try:
-            while True:
-                try:
-                    async for obj, diff in self.queryset.changes():
-                        await self.callback(obj, diff)
-                except (ReqlTimeoutError, ReqlAvailabilityError):
-                    l.debug('ReqlError in listener {}'.format(self), exc_info=True)
-                    await asyncio.sleep(1)  # Prevent busy looping if database fails terminally.
-                    # TODO: Implement some kind of backoff strategy
-                    # TODO: Implement a limit on the number of retries
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for worker in workers:
+                if worker.done():
+                    worker.result()  # Raise the callback's exception
+            # Reading changes stopped or failed for good, handle the changes already read before returning or raising
+            for queue in queues:
+                await queue.put(_STOP)
+            await asyncio.gather(*workers)
+            reader.result()
         finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
             l.debug('Shutting down {}'.format(self))
 
+    async def _read_changes(self, queues: List[asyncio.Queue]):
+        failures = 0
+        while True:
+            try:
+                changes_options = {} if self.squash is None else {'squash': self.squash}
+                if self.shared:
+                    subscription = changefeed_hub.subscribe(self.queryset, policy=self.policy, **changes_options)
+                    async with subscription:
+                        async for obj, diff in subscription:
+                            failures = 0
+                            await queues[self._get_worker_index(obj)].put((obj, diff))
+                    return  # The hub closed the subscription, e.g. in resync.teardown()
+                else:
+                    async for obj, diff in self.queryset.changes(**changes_options):
+                        failures = 0
+                        await queues[self._get_worker_index(obj)].put((obj, diff))
+            except (ReqlTimeoutError, ReqlAvailabilityError, SlowConsumerError):
+                l.debug('ReqlError in listener {}'.format(self), exc_info=True)
+                if self.max_retries is not None and failures >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._get_retry_delay(failures))
+                failures += 1
+
+    def _get_worker_index(self, obj: Model) -> int:
+        if self.concurrency == 1:
+            return 0
+        return hash(obj.id) % self.concurrency
+
+    def _get_retry_delay(self, failures: int) -> float:
+        """
+        Exponential backoff with jitter: a random delay between half and all of the capped exponential delay.
+        """
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** failures)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _work(self, queue: asyncio.Queue):
+        stop = False
+        while not stop:
+            change = await queue.get()
+            if change is _STOP:
+                return
+            if self.batch_size is None:
+                await self.callback(*change)
+            else:
+                batch, stop = await self._fill_batch(queue, [change])
+                await self.callback(batch)
+
+    async def _fill_batch(self, queue: asyncio.Queue, batch: List[Change]) -> Tuple[List[Change], bool]:
+        """
+        Add changes to the batch until it's full or `batch_timeout` is up.  Also returns whether the worker should
+        stop after this batch.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            if queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                # Not wait_for, which can drop an item the getter received just as the timeout expired
+                getter = asyncio.ensure_future(queue.get())
+                try:
+                    await asyncio.wait([getter], timeout=timeout)
+                finally:
+                    timed_out = not getter.done()
+                    if timed_out:
+                        getter.cancel()
+                if timed_out:
+                    break
+                change = getter.result()
+            else:
+                change = queue.get_nowait()
+            if change is _STOP:
+                return batch, True
+            batch.append(change)
+        return batch, False
+
     def __str__(self):
         return 'ChangeListener for {}'.format(self.queryset)
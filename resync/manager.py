@@ -1,10 +1,14 @@
+import asyncio
 from logging import getLogger
-from typing import Tuple
+from typing import Any, Tuple, Iterable, List, Mapping, Optional
 
 import rethinkdb as r
 
-from resync.connection import connection_pool, QueryRunner
-from resync.queryset import Queryset
+from resync import codecs
+from resync.connection import QueryRunner
+from resync.identity import get_identity_map
+from resync.queryset import BulkPatch, DBUpdateError, Queryset, WriteResult, get_write_query_options, get_write_result
+from resync.replica import TableReplica
 
 l = getLogger('resync.manager')
 
@@ -12,10 +16,24 @@ l = getLogger('resync.manager')
 class BaseManager:
 
     INSERT_ERROR_MSG = '{n_errors} errors in insert query. \n First error message: {error_msg}\n Query: {query}'
+    BULK_INSERT_ERROR_MSG = '{n_errors} errors in insert query for chunk {chunk} (documents {start} to {end}). ' \
+                            '\n First error message: {error_msg}\n Query: {query}'
+    BULK_UPDATE_ERROR_MSG = '{n_errors} errors in update query for chunk {chunk} (documents {start} to {end}). ' \
+                            '\n First error message: {error_msg}'
+    DEFAULT_BATCH_SIZE = 200
+
+    replica = None  # In-memory copy of the table answering reads, see Manager.replicate
 
     def attach_model(self, model):
         self.model = model
 
+    def copy(self) -> 'BaseManager':
+        """
+        A new manager of the same kind and options, not attached to a model yet.  Used to give subclasses of a model
+        their own manager, override it in managers taking arguments.
+        """
+        return type(self)()
+
     class DBInsertError(Exception):
         pass
 
@@ -37,7 +55,17 @@ class Manager(BaseManager):
         """
         Update an instance in the database with the passed kwargs.
         """
-        changes_list = await self.filter(id=instance.id).update(**kwargs)
+        return await self.update_document(instance, self.model.serialize_fields(kwargs))
+
+    async def update_document(self, instance, document: Mapping[str, Any]) -> Tuple[str, str, tuple]:
+        """
+        Update an instance's document, looked up by primary key, with values already in their db form.  Nested objects
+        are merged like rethinkdb's `update` does.  Returns the changes, or a WriteResult or None depending on the
+        model's `write_options`, see Queryset.with_options.
+        """
+        changes_list = await Queryset(self.model, (('get', (instance.id,), {}),))._run_update(document)
+        if not isinstance(changes_list, list):
+            return changes_list
         if changes_list:
             instance, changes = changes_list[0]
         else:
@@ -51,11 +79,118 @@ class Manager(BaseManager):
         """
         return self.all().filter(**kwargs)
 
-    def changes(self) -> Queryset:
+    def only(self, *field_names) -> Queryset:
+        """
+        Returns a Queryset fetching only the given fields, see Queryset.only.
+        """
+        return self.all().only(*field_names)
+
+    def defer(self, *field_names) -> Queryset:
+        """
+        Returns a Queryset fetching all but the given fields, see Queryset.defer.
+        """
+        return self.all().defer(*field_names)
+
+    def select_related(self, *field_names) -> Queryset:
+        """
+        Returns a Queryset fetching the objects referenced by the given foreign keys in the same query, see
+        Queryset.select_related.
+        """
+        return self.all().select_related(*field_names)
+
+    def prefetch_related(self, *related_names) -> Queryset:
+        """
+        Returns a Queryset fetching the objects of the given reverse relations in bulk, see Queryset.prefetch_related.
+        """
+        return self.all().prefetch_related(*related_names)
+
+    def with_options(self, **write_options) -> Queryset:
+        """
+        Returns a Queryset whose writes use the given options, see Queryset.with_options.
+        """
+        return self.all().with_options(**write_options)
+
+    def lazy(self) -> Queryset:
+        """
+        Returns a Queryset of instances decoding their fields on first access, see Queryset.lazy.
+        """
+        return self.all().lazy()
+
+    def values(self, *field_names) -> Queryset:
+        """
+        Returns a Queryset of plain dictionaries of field values, see Queryset.values.
+        """
+        return self.all().values(*field_names)
+
+    def values_list(self, *field_names, flat=False) -> Queryset:
+        """
+        Returns a Queryset of tuples of field values, see Queryset.values_list.
+        """
+        return self.all().values_list(*field_names, flat=flat)
+
+    async def to_columns(self, field_names, encode=(), fill=None, batch_size=Queryset.DEFAULT_BATCH_SIZE):
+        """
+        Fetch fields of all documents into columns, see Queryset.to_columns.
+        """
+        return await self.all().to_columns(field_names, encode, fill, batch_size)
+
+    async def to_numpy(self, field_names, encode=(), fill=None, batch_size=Queryset.DEFAULT_BATCH_SIZE):
+        """
+        Fetch fields of all documents into NumPy arrays, see Queryset.to_numpy.
+        """
+        return await self.all().to_numpy(field_names, encode, fill, batch_size)
+
+    async def count(self) -> int:
+        """
+        The number of documents in this model's table, see Queryset.count.
+        """
+        return await self.all().count()
+
+    async def exists(self) -> bool:
         """
-        Returns a change feed of this model's table.
+        Whether this model's table has any documents, see Queryset.exists.
         """
-        return self.all().changes()
+        return await self.all().exists()
+
+    async def aggregate(self, **aggregates) -> Mapping[str, Any]:
+        """
+        Compute aggregates over all the documents of this model's table, see Queryset.aggregate.
+        """
+        return await self.all().aggregate(**aggregates)
+
+    def group_by(self, *field_names):
+        """
+        Group the documents of this model's table to compute aggregates for each group, see Queryset.group_by.
+        """
+        return self.all().group_by(*field_names)
+
+    def paginate(self, by: str, page_size: int=100, cursor: str=None):
+        """
+        Walk this model's table in pages in the order of an indexed field, see Queryset.paginate.
+        """
+        return self.all().paginate(by, page_size=page_size, cursor=cursor)
+
+    def replicate(self) -> TableReplica:
+        """
+        Keep a copy of this model's table in memory, kept up to date by a changefeed, and answer reads (`get`,
+        `filter`, `order_by`, `limit`...) on the model's querysets from it instead of the database once it has loaded,
+        e.g.:
+            replica = FeatureFlag.objects.replicate()
+            await replica.wait_ready()
+            flag = await FeatureFlag.objects.get(name='new_ui')  # No query
+        For small tables which are read much more than they change.  See TableReplica for what is answered locally,
+        and `replica.stats()` for its readiness and staleness.  `await replica.stop()` to go back to the database.
+        """
+        if self.replica is None:
+            self.replica = TableReplica(self.model)
+        self.replica.start()
+        return self.replica
+
+    def changes(self, **options) -> Queryset:
+        """
+        Returns a change feed of this model's table, see Queryset.changes.
+        """
+        return self.all().changes(**options)
 
     async def create(self, **field_data):
         """
@@ -63,12 +198,17 @@ class Manager(BaseManager):
         :param field_data: Attributes to set on the model
         :return: Created instance
         """
+        return await self._create(field_data, self.model._meta.write_options)
+
+    async def _create(self, field_data: Mapping[str, Any], write_options: Mapping[str, Any]):
         unsaved_instance = self.model(**field_data)
         serialized_data = unsaved_instance.to_db()
-        query_kwargs = {'return_changes': True}
+        query_kwargs, run_options = get_write_query_options(write_options)
         queries = (('insert', (serialized_data,), query_kwargs),)
         async with QueryRunner(self.model.table, queries) as query:
-            result = await query.run()
+            result = await query.run(**run_options)
+        if result is None:
+            return unsaved_instance  # noreply
 
         if result['errors']:
             msg = self.INSERT_ERROR_MSG.format(
@@ -76,8 +216,144 @@ class Manager(BaseManager):
             l.debug(msg)
             raise self.DBInsertError(msg)
 
-        new_object_data = result['changes'][0]['new_val']
-        return self.model.from_db(new_object_data)
+        if query_kwargs.get('return_changes'):
+            new_object_data = result['changes'][0]['new_val']
+            instance = self.model.from_db(new_object_data)
+        else:
+            # The document is what we sent, plus the generated id
+            instance = unsaved_instance
+            if instance.id is None:
+                instance.id = result['generated_keys'][0]
+                serialized_data['id'] = instance.id
+                instance._set_reverse_relations()  # Skipped by __init__ without an id
+            if self.model._track_changes:
+                instance._snapshot = codecs.copy_document(serialized_data)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.add(instance)
+        return instance
+
+    async def bulk_create(self, instances: Iterable, batch_size: int=None, return_changes: bool=False) -> List:
+        """
+        Inserts many unsaved instances into the database, sending them in chunks of `batch_size` documents per
+        query instead of one query per document.  Ids generated by rethinkdb are set on the instances in place.
+        :param instances: Unsaved model instances
+        :param batch_size: Maximum number of documents to send in a single insert query
+        :param return_changes: Ask the server to send back the inserted documents, and refresh the instances from them.
+                               Off by default, since the generated ids are all we need in the usual case.
+        :return: The list of instances, with their ids set.  The model's `durability` and `noreply` write options
+                 apply, with `noreply` the ids generated by rethinkdb aren't set.
+        """
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError('Expected batch_size > 0, got {}'.format(batch_size))
+        instances = list(instances)
+        batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        query_kwargs, run_options = get_write_query_options(
+            dict(self.model._meta.write_options, return_changes=return_changes))
+        identity_map = get_identity_map()
+        for chunk_number, start in enumerate(range(0, len(instances), batch_size)):
+            chunk = instances[start:start + batch_size]
+            serialized_data = [instance.to_db() for instance in chunk]
+            queries = (('insert', (serialized_data,), query_kwargs),)
+            async with QueryRunner(self.model.table, queries) as query:
+                result = await query.run(**run_options)
+            if result is None:
+                continue  # noreply
+
+            if result['errors']:
+                msg = self.BULK_INSERT_ERROR_MSG.format(
+                    n_errors=result['errors'], chunk=chunk_number, start=start, end=start + len(chunk) - 1,
+                    error_msg=result['first_error'], query=queries)
+                l.debug(msg)
+                raise self.DBInsertError(msg)
+
+            # rethinkdb returns the generated keys in the same order as the documents which didn't supply an id
+            generated_keys = iter(result.get('generated_keys', ()))
+            for instance in chunk:
+                if instance.id is None:
+                    instance.id = next(generated_keys)
+                    instance._set_reverse_relations()
+
+            if query_kwargs.get('return_changes'):
+                self._refresh_from_changes(chunk, result['changes'])
+            elif self.model._track_changes:
+                # The documents are what we sent, plus the generated ids
+                for instance, document in zip(chunk, serialized_data):
+                    document['id'] = instance.id
+                    instance._snapshot = codecs.copy_document(document)
+            if identity_map is not None:
+                for instance in chunk:
+                    identity_map.add(instance)
+        return instances
+
+    async def bulk_update(self, instances: Iterable, fields: Iterable[str],
+                          batch_size: int=None) -> Optional[WriteResult]:
+        """
+        Saves the given fields of many instances, each with its own values, in chunks of `batch_size` documents per
+        query instead of one query per instance.  Each chunk is a single `get_all(...).update(...)` which looks up each
+        document's values by its id, so documents deleted meanwhile are skipped rather than inserted again.  Fields
+        are set to exactly the instances' values, nested objects aren't merged.
+        :param instances: Model instances, which must have been saved before
+        :param fields: Names of the fields to send
+        :param batch_size: Maximum number of documents to update in a single query
+        :return: The counts of documents replaced, unchanged, skipped etc. over all the chunks.  None for `noreply`
+                 writes, see the model's `write_options` (`return_changes` doesn't apply).
+        """
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError('Expected batch_size > 0, got {}'.format(batch_size))
+        instances = list(instances)
+        field_names = tuple(fields)
+        for field_name in field_names:
+            if field_name not in self.model._meta.fields or field_name == 'id':
+                raise ValueError('Cannot bulk update {} field {}'.format(self.model.__name__, field_name))
+        if any(instance.id is None for instance in instances):
+            raise ValueError('Cannot bulk update unsaved instances, create them first')
+        batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        query_kwargs, run_options = get_write_query_options(
+            dict(self.model._meta.write_options, return_changes=False))
+        results = []
+        for chunk_number, start in enumerate(range(0, len(instances), batch_size)):
+            chunk = instances[start:start + batch_size]
+            documents = [self.model.serialize_fields({field_name: getattr(instance, field_name)
+                                                      for field_name in field_names})
+                         for instance in chunk]
+            patches = {BulkPatch.get_patch_key(instance.id): document for instance, document in zip(chunk, documents)}
+            queries = (('get_all', tuple(instance.id for instance in chunk), {}),
+                       ('update', (BulkPatch(field_names, patches),), query_kwargs))
+            async with QueryRunner(self.model.table, queries) as query:
+                result = await query.run(**run_options)
+            if result is None:
+                continue  # noreply
+
+            if result['errors']:
+                msg = self.BULK_UPDATE_ERROR_MSG.format(
+                    n_errors=result['errors'], chunk=chunk_number, start=start, end=start + len(chunk) - 1,
+                    error_msg=result['first_error'])
+                l.debug(msg)
+                raise DBUpdateError(msg)
+            results.append(get_write_result(result))
+            for instance, document in zip(chunk, documents):
+                snapshot = instance._get_snapshot()
+                if snapshot is not None:
+                    instance._snapshot = dict(snapshot, **codecs.copy_document(document))
+        if run_options.get('noreply'):
+            return None
+        return WriteResult(*[sum(counts) for counts in zip(*results)]) if results else WriteResult(0, 0, 0, 0, 0, 0)
+
+    def _refresh_from_changes(self, instances, changes):
+        """
+        Copy the field values from the documents returned by the server onto the matching instances.
+        """
+        new_values = {changeset['new_val']['id']: changeset['new_val'] for changeset in changes}
+        for instance in instances:
+            new_object_data = new_values.get(instance.id)
+            if new_object_data is None:
+                continue
+            new_instance = self.model.from_db(new_object_data)
+            for field_name, value in new_instance._get_field_data().items():
+                setattr(instance, field_name, value)
+            if self.model._track_changes:
+                instance._snapshot = new_instance._get_snapshot()
 
     # TODO: Fix or remove this.
     # def create_sync(self, conn, **kwargs):
@@ -96,12 +372,16 @@ class Manager(BaseManager):
         Deletes a record from the database. Returns True if the object was deleted, otherwise it
         probably throws an Exception of some kind tbh I'm not really sure
         :param instance: Model instance
-        :return: bool
+        :return: bool, None for `noreply` writes (see the model's `write_options`)
         """
-        conn = await connection_pool.get_conn()
-        query = await r.table(self.model.table).get(instance.id).delete().run(conn)
-        await connection_pool.put_conn(conn)
-        return bool(query['deleted'])
+        query_kwargs, run_options = get_write_query_options(dict(self.model._meta.write_options, return_changes=False))
+        queries = (('get', (instance.id,), {}), ('delete', (), query_kwargs))
+        async with QueryRunner(self.model.table, queries) as query:
+            result = await query.run(**run_options)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.discard(self.model, instance.id)
+        return None if result is None else bool(result['deleted'])
 
     def delete_sync(self, conn, instance):
         """
@@ -114,6 +394,31 @@ class Manager(BaseManager):
         query = r.table(self.model.table).get(instance.id).delete().run(conn)
         return bool(query['deleted'])
 
+    async def ensure_indexes(self):
+        """
+        Create the model's declared secondary indexes which don't exist yet, concurrently, then wait for all of them
+        to be ready.  Models without declared indexes don't query the database, their table may not even exist.
+        """
+        if not self.model._meta.indexes:
+            return
+        async with QueryRunner(self.model.table, (('index_list', (), {}),)) as query:
+            existing_indexes = set(await query.run())
+        missing_indexes = {name: fields for name, fields in self.model._meta.indexes.items()
+                           if name not in existing_indexes}
+        await asyncio.gather(*[self._create_index(name, fields) for name, fields in missing_indexes.items()])
+        queries = (('index_wait', tuple(self.model._meta.indexes), {}),)
+        async with QueryRunner(self.model.table, queries) as query:
+            await query.run()
+
+    async def _create_index(self, name, fields):
+        if len(fields) == 1 and fields[0] == name:
+            args = (name,)
+        else:
+            args = (name, [r.row[field_name] for field_name in fields])
+        l.debug('Creating index {} on {}'.format(name, self.model.table))
+        async with QueryRunner(self.model.table, (('index_create', args, {}),)) as query:
+            await query.run()
+
     def all(self) -> Queryset:
         """
         Returns an async iterator of all the objects in this table.
@@ -1,19 +1,31 @@
-from typing import NamedTuple, Mapping, Dict, Any, List, Optional
+import asyncio
+import itertools
+from typing import NamedTuple, Mapping, Dict, Any, List, Optional, Tuple
 
+from resync import codecs
 from resync.fields import Field, ForeignKeyField, ReverseForeignKeyField
 from resync.manager import Manager
+from resync.queryset import check_write_options
 from resync.utils import RegistryPatternMetaclass
-from resync.diff import DiffObject
+from resync.diff import DiffObject, get_update_patch
 
 ModelMeta = NamedTuple(
     'Meta',
-    [('table', str), ('fields', Mapping['str', Field]), ('reverse_relations', Mapping[str, ReverseForeignKeyField])]
+    [
+        ('table', str),
+        ('fields', Mapping['str', Field]),
+        ('reverse_relations', Mapping[str, ReverseForeignKeyField]),
+        ('indexes', Mapping[str, Tuple[str, ...]]),
+        ('write_options', Mapping[str, Any]),
+    ]
 )
 
 
 class DocumentBase(type):
 
     def __new__(mcs, name, bases, attrs):
+        compact = attrs.pop('compact', any(getattr(base, '_compact', False) for base in bases))
+        track_changes = attrs.pop('track_changes', None)
         fields = {}
         for base in bases:
             fields.update(base._meta.fields)
@@ -24,33 +36,125 @@ class DocumentBase(type):
                 fields[key] = value
             else:
                 non_field_attrs[key] = value
+        if compact:
+            non_field_attrs['__slots__'] = mcs._get_slots(bases, fields)
+            non_field_attrs['_compact'] = True
+        if track_changes is not None:
+            non_field_attrs['_track_changes'] = track_changes
         new_class = super(DocumentBase, mcs).__new__(mcs, name, bases, non_field_attrs)
-        new_class._meta = ModelMeta(None, fields, {})
+        new_class._meta = ModelMeta(None, fields, {}, {}, {})
+        mcs._install_codecs(new_class)
         return new_class
 
+    @staticmethod
+    def _get_slots(bases, fields) -> Tuple[str, ...]:
+        """
+        Slots for a compact class: one per field plus the instance state named in `_state_slots`, leaving out those
+        a base class already has a slot for.  Only saves memory if every base class is compact, otherwise instances
+        still get a `__dict__` from the non-compact base.
+        """
+        existing_slots = set()
+        state_slots = []
+        for base in bases:
+            for klass in base.__mro__:
+                slots = klass.__dict__.get('__slots__', ())
+                existing_slots.update((slots,) if isinstance(slots, str) else slots)
+            state_slots.extend(getattr(base, '_state_slots', ()))
+        slots = []
+        for slot in itertools.chain(fields, state_slots):
+            if slot not in existing_slots and slot not in slots:
+                slots.append(slot)
+        return tuple(slots)
+
+    @staticmethod
+    def _install_codecs(new_class):
+        """
+        Generate the functions used by `from_db` and `to_db`, see resync.codecs.
+        """
+        new_class._decode = staticmethod(codecs.build_decoder(new_class))
+        new_class._encode = staticmethod(codecs.build_encoder(new_class))
+        fields = new_class._meta.fields
+        new_class._field_decoders = {name: codecs.build_field_decoder(field) for name, field in fields.items()}
+        new_class._field_encoders = {name: codecs.build_field_encoder(field) for name, field in fields.items()}
+
 
 class ModelBase(DocumentBase, RegistryPatternMetaclass):
 
     def __new__(mcs, name, bases, attrs):
         table_name = attrs.pop('table', name.lower())
+        declared_indexes = attrs.pop('indexes', None)
+        declared_write_options = attrs.pop('write_options', {})
         foreign_key_fields = {}
         for key, value in attrs.items():
             if isinstance(value, ForeignKeyField):
                 foreign_key_fields[key] = value
         new_class = super(ModelBase, mcs).__new__(mcs, name, bases, attrs)
-        new_class._meta = ModelMeta(table_name, new_class._meta.fields, {})
+        indexes = mcs._get_indexes(bases, new_class._meta.fields, declared_indexes)
+        write_options = mcs._get_write_options(bases, declared_write_options)
+        # Keep the reverse relations mapping the generated decoder already refers to
+        new_class._meta = ModelMeta(
+            table_name, new_class._meta.fields, new_class._meta.reverse_relations, indexes, write_options)
         for foreign_key_field_name, field in foreign_key_fields.items():
             related_model = field.model
             reverse_relation_name = field.related_name or name.lower() + '_set'
-            related_model._meta.reverse_relations[reverse_relation_name] = ReverseForeignKeyField(new_class, foreign_key_field_name)
+            reverse_field = ReverseForeignKeyField(new_class, foreign_key_field_name, reverse_relation_name)
+            related_model._meta.reverse_relations[reverse_relation_name] = reverse_field
+            if related_model._compact:
+                # Compact instances can't get new attributes, look the relation up on the class instead
+                setattr(related_model, reverse_relation_name, reverse_field)
         return new_class
 
+    @staticmethod
+    def _get_indexes(bases, fields, declared_indexes) -> Dict[str, Tuple[str, ...]]:
+        """
+        Collect the secondary indexes of a model, as a mapping of index name to the field names it covers.  Indexes
+        come from fields declared with `index=True`, and from the model's `indexes` attribute, a list of field names
+        and tuples of field names for compound indexes, e.g. `indexes = [('owner', 'created')]`.  Compound indexes
+        are named by joining their field names with underscores.
+        """
+        indexes = {}
+        for base in bases:
+            indexes.update(base._meta.indexes)
+        for field_name, field in fields.items():
+            if field.index:
+                indexes[field_name] = (field_name,)
+        for index in declared_indexes or ():
+            index_fields = (index,) if isinstance(index, str) else tuple(index)
+            for field_name in index_fields:
+                if field_name not in fields:
+                    raise AttributeError('Cannot index unknown field {}'.format(field_name))
+            indexes['_'.join(index_fields)] = index_fields
+        return indexes
+
+    @staticmethod
+    def _get_write_options(bases, declared_write_options) -> Dict[str, Any]:
+        """
+        Collect the options for the model's writes, from its `write_options` attribute on top of those of its base
+        classes, e.g. `write_options = {'durability': 'soft'}`.  See Queryset.with_options.
+        """
+        check_write_options(declared_write_options)
+        write_options = {}
+        for base in bases:
+            write_options.update(base._meta.write_options)
+        write_options.update(declared_write_options)
+        return write_options
+
     @property
     def table(cls):
         return cls._meta.table
 
 
 class NestedDocument(metaclass=DocumentBase):
+    """
+    Set `compact = True` in a subclass to store its instances' fields in `__slots__` rather than a `__dict__`, which
+    takes a lot less memory for large result sets.  Subclasses of a compact class are compact too.  Instances of
+    compact classes can't be given attributes which aren't fields.
+    """
+
+    __slots__ = ()
+    _compact = False
+    # Names of the non-field attributes compact instances need a slot for
+    _state_slots = ()
 
     def __init__(self, **kwargs):
         fields = frozenset(self._meta.fields.keys())
@@ -67,19 +171,14 @@ class NestedDocument(metaclass=DocumentBase):
         Converts itself into a plain Python dictionary of values serialized into a form suitable for the database.
         This method is called by parent/container models when they are serialized.
         """
-        field_data = self._get_field_data()
-        return self.serialize_fields(field_data)
+        return self._encode(self)
 
     @classmethod
     def from_db(cls, data_dict: Mapping[str, Any]):
         """
-        Deserializes the data from its db representation into Python values and returns a
+        Deserializes the data from its db representation into Python values and returns a new instance.
         """
-        transformed_data = {}
-        for field_name, field in cls._meta.fields.items():
-            value = data_dict.get(field_name, field.default)
-            transformed_data[field_name] = field.from_db(value)
-        return cls(**transformed_data)
+        return cls._decode(data_dict)
 
     @classmethod
     def serialize_fields(cls, data_dict: Mapping[str, Any]) -> Dict[str, Any]:
@@ -103,38 +202,180 @@ class NestedDocument(metaclass=DocumentBase):
 
 class Model(NestedDocument, metaclass=ModelBase):
 
+    __slots__ = ()
+    # `_deferred_fields`: fields left out of the query which loaded this instance, see Queryset.only and
+    # Queryset.defer.  `_raw`: the document a lazy instance decodes its fields from, see Queryset.lazy.
+    # `_prefetched`: reverse relation name to the related objects fetched by Queryset.prefetch_related, for compact
+    # instances.  They are unset unless needed, read them with `_get_deferred_fields`, `_get_raw` and `_get_prefetched`.
+    # `_snapshot`: the document the instance was loaded from or last saved as, to find the changes to save.
+    _state_slots = ('_deferred_fields', '_raw', '_prefetched', '_snapshot')
+    # Set `track_changes = True` in a subclass to keep snapshots, so that `save()` only sends the changed fields
+    # instead of every field, at the cost of a copy of each document loaded
+    _track_changes = False
+
     class DoesNotExist(Exception):
         pass
 
     def __init__(self, **kwargs):
         super(Model, self).__init__(**kwargs)
-        if self.id is not None:
+        self._set_reverse_relations()
+
+    @classmethod
+    def from_db_lazy(cls, data_dict: Mapping[str, Any]):
+        """
+        Returns a new instance wrapping the document, which decodes each field the first time it is accessed.  Models
+        with their own `__init__` are decoded straight away, like `from_db` does.
+        """
+        if not codecs.is_stock_init(cls.__init__):
+            return cls.from_db(data_dict)
+        instance = object.__new__(cls)
+        instance._raw = data_dict
+        if cls._track_changes:
+            instance._snapshot = codecs.copy_document(data_dict)
+        if cls._meta.reverse_relations:
+            instance._set_reverse_relations()
+        return instance
+
+    def __getattr__(self, name):
+        # Only called when the attribute isn't set: decode the field if this is a lazy instance
+        raw = self._get_raw() if name in self._meta.fields else None
+        if raw is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
+        value = self._field_decoders[name](raw)
+        setattr(self, name, value)
+        return value
+
+    def _get_raw(self) -> Optional[Mapping[str, Any]]:
+        return getattr(self, '_raw', None)
+
+    def _get_loaded_field_data(self) -> Dict[str, Any]:
+        """
+        Like `_get_field_data`, but for lazy instances only the fields which were accessed or assigned.
+        """
+        if self._get_raw() is None:
+            return self._get_field_data()
+        field_data = {}
+        for field_name in self._meta.fields:
+            try:
+                field_data[field_name] = object.__getattribute__(self, field_name)
+            except AttributeError:
+                pass
+        return field_data
+
+    def _get_prefetched(self) -> Mapping[str, list]:
+        return getattr(self, '_prefetched', {})
+
+    def _set_prefetched(self, related_name: str, related_objects: list):
+        """
+        Make the reverse relation's queryset return the given objects instead of querying the database.
+        """
+        if self._compact:
+            self._prefetched = dict(self._get_prefetched(), **{related_name: related_objects})
+        else:
+            getattr(self, related_name)._result_cache = related_objects
+
+    def _set_reverse_relations(self):
+        # Compact classes have the reverse relations as class attributes, see ReverseForeignKeyField.__get__
+        if self.id is not None and not self._compact:
             for related_name, field in self._meta.reverse_relations.items():
                 setattr(self, related_name, field.get_queryset(self.id))
 
     async def save(self) -> Optional[List[DiffObject]]:
-        field_data = self._get_field_data()
-        create = self.id is None
-        if create:
+        """
+        Create the document, or update it.  With `track_changes = True` on the model, only the fields which changed
+        since the instance was loaded or last saved are sent, and nothing if none did.  Otherwise every loaded field is
+        sent.
+        Returns:
+            The changes made to the document, None when it's created.  With the model's `write_options`, a WriteResult
+            if `return_changes` is off, and None for `noreply` writes.
+        """
+        deferred_fields = self._get_deferred_fields()
+        if self.id is None:
+            field_data = self._get_field_data()
+            for field_name in deferred_fields:
+                field_data.pop(field_name, None)
             field_data.pop('id')
             new_obj = await self.objects.create(**field_data)
             self.id = new_obj.id
-            changes = None
-        else:
-            changes = await self.objects.update(self, **field_data)
+            self._set_reverse_relations()
+            if self._track_changes:
+                self._snapshot = new_obj._get_snapshot()
+            return None
+
+        snapshot = self._get_snapshot()
+        if snapshot is None:
+            # Lazy instances only send back the fields that were accessed, the others can't have changed
+            field_data = self._get_loaded_field_data()
+            for field_name in deferred_fields:
+                field_data.pop(field_name, None)
+            return await self.objects.update(self, **field_data)
+
+        document = self.to_db()
+        for field_name in deferred_fields:
+            document.pop(field_name, None)
+        patch = get_update_patch(self._fill_missing_fields(snapshot, document), document)
+        changes = await self.objects.update_document(self, patch) if patch else []
+        self._snapshot = codecs.copy_document(document)  # Nested values of `document` belong to the instance
         return changes
 
+    def _get_snapshot(self) -> Optional[Mapping[str, Any]]:
+        return getattr(self, '_snapshot', None)
+
+    def _fill_missing_fields(self, snapshot: Mapping[str, Any], document: Mapping[str, Any]) -> Mapping[str, Any]:
+        """
+        Fields missing from the loaded document were given their default value, which doesn't count as a change.
+        """
+        missing_fields = [field_name for field_name in document if field_name not in snapshot]
+        if not missing_fields:
+            return snapshot
+        snapshot = dict(snapshot)
+        for field_name in missing_fields:
+            snapshot[field_name] = self._field_encoders[field_name](self._meta.fields[field_name].default)
+        return snapshot
+
+    def _get_deferred_fields(self) -> frozenset:
+        return getattr(self, '_deferred_fields', frozenset())
+
     def to_db(self):
-        serialized_data = super(Model, self).to_db()
+        raw = self._get_raw()
+        if raw is None:
+            serialized_data = super(Model, self).to_db()
+        else:
+            # Copy the fields a lazy instance hasn't decoded from its document rather than decoding them
+            loaded_data = self._get_loaded_field_data()
+            serialized_data = {}
+            for field_name, encode in self._field_encoders.items():
+                if field_name in loaded_data:
+                    serialized_data[field_name] = encode(loaded_data[field_name])
+                elif field_name in raw:
+                    serialized_data[field_name] = raw[field_name]
+                else:
+                    serialized_data[field_name] = encode(getattr(self, field_name))
         if self.id is None:
             serialized_data.pop('id')
         return serialized_data
 
 
+codecs.register_stock_init(NestedDocument.__init__)
+codecs.register_stock_init(Model.__init__)
+
+
 def setup():
     for subclass in RegistryPatternMetaclass.REGISTRY:
         if subclass is Model:
             continue
-        if not hasattr(subclass, 'objects'):
-            subclass.objects = Manager()
+        if 'objects' not in subclass.__dict__:
+            # Not the manager inherited from a parent model, which is attached to the parent, but a new one like it
+            inherited_manager = getattr(subclass, 'objects', None)
+            subclass.objects = inherited_manager.copy() if inherited_manager is not None else Manager()
         subclass.objects.attach_model(subclass)
+
+
+async def ensure_indexes(models=None):
+    """
+    Create the secondary indexes declared on the given models (default: all models) which don't exist yet, and wait
+    until they are all ready to use.  Indexes are created concurrently.
+    """
+    if models is None:
+        models = [subclass for subclass in RegistryPatternMetaclass.REGISTRY if subclass is not Model]
+    await asyncio.gather(*[model.objects.ensure_indexes() for model in models])
@@ -1,23 +1,61 @@
+import asyncio
+import base64
+import json
 import logging
 import operator
-from typing import List, Any, Tuple, Mapping, Callable
+from collections import OrderedDict, deque
+from typing import List, Any, Tuple, Iterable, Mapping, Callable, NamedTuple, Optional, Sequence, Union
 
 import rethinkdb as r
 
-from resync.connection import DatabaseQuery, QueryRunner
+from resync.aggregates import Aggregate, Count, GroupedQueryset, check_aggregates, run_aggregate, run_query
+from resync.columns import Column, get_column_builders, to_numpy
+from resync.connection import DatabaseQuery, QueryRunner, QueryFunction, fetch_batch
 from resync.diff import get_diff_from_changeset, Diff, delete
+from resync.fields import ForeignKeyField, RelatedObjectProxy
+from resync.identity import get_identity_map
 
 l = logging.getLogger('resync.queryset')
 
 ALLOWED_COMPARATORS = frozenset(['eq', 'ne', 'gt', 'lt', 'ge', 'le'])
+LOWER_BOUND_COMPARATORS = {'gt': 'open', 'ge': 'closed'}
+UPPER_BOUND_COMPARATORS = {'lt': 'open', 'le': 'closed'}
+PRIMARY_KEY = 'id'
+# Documents fetched by select_related are merged into each document under this prefix followed by the field name
+SELECT_RELATED_PREFIX = '__related_'
+
+# Options for writes, see Queryset.with_options
+WRITE_OPTIONS = frozenset(['return_changes', 'durability', 'noreply'])
+
+Lookup = Tuple[str, str, Any]  # (field name, comparator or None for equality, value)
+
+# A page of Queryset.paginate, with the cursor to resume after it or None if it's the last page
+Page = NamedTuple('Page', [('items', list), ('cursor', Optional[str])])
+
+# The results of Queryset.profile, with the server's profile of the query
+Profile = NamedTuple('Profile', [('results', list), ('profile', Any)])
+
+# The counts rethinkdb returns for a write, returned instead of the changes when `return_changes` is off
+WriteResult = NamedTuple('WriteResult', [
+    ('inserted', int),
+    ('replaced', int),
+    ('unchanged', int),
+    ('skipped', int),
+    ('deleted', int),
+    ('errors', int),
+])
 
 
 class BaseQueryset:
 
+    DEFAULT_BATCH_SIZE = 1000
+
     def __init__(self, model, queries=tuple()):
         self.model = model
         self._queries = queries
         self._query = None
+        self._options = {}
+        self._result_cache = None  # Results already fetched by prefetch_related, used instead of running the query
 
     @property
     def queries(self) -> Tuple[DatabaseQuery]:
@@ -26,26 +64,132 @@ class BaseQueryset:
         """
         return self._queries
 
+    def _clone(self, queries=None, klass=None, **options):
+        """
+        Returns a new queryset with the given queries (default: the same queries), keeping the options set on this
+        one, e.g. field projections, updated with `options`.
+        """
+        klass = klass or self.__class__
+        new_queryset = klass(self.model, self.queries if queries is None else queries)
+        new_queryset._options = dict(self._options, **options)
+        return new_queryset
+
+    def _get_run_queries(self) -> Tuple[DatabaseQuery]:
+        """
+        The queries to send when the queryset is evaluated, with anything that must come last added on the end.
+        """
+        return self.queries
+
     async def __aiter__(self):
-        self._query = QueryRunner(self.model.table, self.queries)
+        self._buffer = deque()
+        if self._result_cache is not None:
+            self._query = None
+            self._cached_results = deque(self._result_cache)
+            return self
+        local_rows = self._get_local_rows()
+        if local_rows is not None:
+            self._query = None
+            self._cached_results = deque(await self._load_batch(local_rows) if local_rows else ())
+            return self
+        self._query = QueryRunner(self.model.table, self._get_run_queries())
         self.cursor = await self._query.run()
         return self
 
     async def __anext__(self):
-        if await self.cursor.fetch_next():
-            value = await self.cursor.next()
-        else:
+        if not self._buffer:
+            self._buffer.extend(await self._next_batch(self.DEFAULT_BATCH_SIZE))
+            if not self._buffer:
+                raise StopAsyncIteration
+        return self._buffer.popleft()
+
+    async def aclose(self):
+        """
+        Stop iterating over the queryset before the end, closing its cursor and returning its connection to the pool
+        straight away, e.g.:
+            async for widget in queryset:
+                if widget.foo == 'bar':
+                    await queryset.aclose()
+                    break
+        Otherwise the connection of an abandoned iteration is only returned once the queryset is garbage collected.
+        """
+        self._buffer = deque()
+        self._cached_results = deque()
+        query, self._query = self._query, None
+        if query is not None:
+            await query.abort()
+
+    def batches(self, size: int=DEFAULT_BATCH_SIZE) -> 'QuerysetBatches':
+        """
+        Iterate over the results in lists of up to `size` items, e.g.:
+            async for batch in Widget.objects.filter(foo='bar').batches(size=1000):
+                ...
+        Rows the driver has already received are handed over without waiting for the batch to fill up, so batches
+        can be shorter than `size`.
+        """
+        return QuerysetBatches(self, size)
+
+    async def _next_batch(self, size: int) -> list:
+        """
+        Fetch and transform the next batch of results.  Returns an empty list and releases the connection when the
+        results are exhausted.
+        """
+        if self._query is None:
+            cached_results = self._cached_results
+            return [cached_results.popleft() for _ in range(min(size, len(cached_results)))]
+        values = await self._fetch_raw_batch(size)
+        if not values:
             await self._query.close()
-            raise StopAsyncIteration
-        return self.transform_query_result(value)
+            return []
+        return await self._load_batch(values)
+
+    async def _load_batch(self, values: list) -> list:
+        """
+        Turn a batch of raw results into the queryset's results.
+        """
+        return self.transform_query_results(values)
+
+    def _get_local_rows(self) -> Optional[list]:
+        """
+        The raw results, if they can be had without querying the database, see Manager.replicate.
+        """
+        return None
+
+    async def _fetch_raw_batch(self, size: int) -> list:
+        values = await fetch_batch(self.cursor, size)
+        self._query.record_rows(values)
+        return values
+
+    def transform_query_results(self, values: list) -> list:
+        return [self.transform_query_result(value) for value in values]
 
     def transform_query_result(self, value):
         return value
 
 
+class QuerysetBatches:
+    """
+    Async iterator over a queryset's results in lists, see BaseQueryset.batches.
+    """
+
+    def __init__(self, queryset: BaseQueryset, size: int):
+        self.queryset = queryset
+        self.size = size
+
+    async def __aiter__(self):
+        await self.queryset.__aiter__()
+        return self
+
+    async def __anext__(self):
+        batch = await self.queryset._next_batch(self.size)
+        if not batch:
+            raise StopAsyncIteration
+        return batch
+
+
 class Queryset(BaseQueryset):
 
     UPDATE_ERROR_MSG = '{n_errors} errors in update query. \n First error message: {error_msg}\n Query: {query}'
+    DELETE_ERROR_MSG = '{n_errors} errors in delete query. \n First error message: {error_msg}\n Query: {query}'
 
     def __await__(self):
         """
@@ -58,8 +202,8 @@ class Queryset(BaseQueryset):
         Consume the cursor into a list and return it.
         """
         result = []
-        async for item in self:
-            result.append(item)
+        async for batch in self.batches():
+            result.extend(batch)
         return result
 
     def all(self):
@@ -68,53 +212,411 @@ class Queryset(BaseQueryset):
         Might be useful one day to re-evaluate a cached queryset once I implement queryset caching.
         :return: A new Queryset with the same query
         """
-        return self.__class__(self.model, self.queries)
+        return self._clone()
+
+    def only(self, *field_names: str):
+        """
+        Fetch only the given fields (and the id) of each document.  The other fields of the instances hold their
+        default values, and aren't sent back to the database by `save()`.
+        """
+        self._check_field_names(field_names)
+        return self._clone(only=tuple(field_names))
+
+    def defer(self, *field_names: str):
+        """
+        Fetch all fields of each document except for the given ones.  Deferred fields of the instances hold their
+        default values, and aren't sent back to the database by `save()`.  The id can't be deferred, `save()` needs it.
+        """
+        self._check_field_names(field_names)
+        if PRIMARY_KEY in field_names:
+            raise ValueError('The primary key of {} can\'t be deferred'.format(self.model.__name__))
+        return self._clone(defer=self._options.get('defer', ()) + tuple(field_names))
+
+    def values(self, *field_names: str):
+        """
+        Return plain dictionaries of field values instead of model instances, with only the given fields (default:
+        all fields).  Foreign keys are given as ids.
+        """
+        self._check_field_names(field_names)
+        return self._clone(values=field_names or tuple(self.model._meta.fields), values_type=dict)
+
+    def values_list(self, *field_names: str, flat: bool=False):
+        """
+        Like `values`, but return tuples of field values.  If `flat` is True and there is a single field, return the
+        values themselves.
+        """
+        self._check_field_names(field_names)
+        if flat and len(field_names) != 1:
+            raise ValueError('values_list(flat=True) needs exactly one field, got {}'.format(field_names))
+        return self._clone(values=field_names or tuple(self.model._meta.fields), values_type='flat' if flat else tuple)
+
+    def select_related(self, *field_names: str):
+        """
+        Fetch the objects referenced by the given foreign keys in the same query, with a server-side join, so that
+        awaiting them doesn't query the database again.
+        """
+        for field_name in field_names:
+            if not isinstance(self.model._meta.fields.get(field_name), ForeignKeyField):
+                raise ValueError('{} is not a foreign key of {}'.format(field_name, self.model.__name__))
+        return self._clone(select_related=self._options.get('select_related', ()) + tuple(field_names))
+
+    def prefetch_related(self, *related_names: str):
+        """
+        Fetch the objects of the given reverse relations along with each batch of results, in one query per relation
+        and batch.  Iterating over e.g. `widget.gadget_set` then doesn't query the database.
+        """
+        for related_name in related_names:
+            if related_name not in self.model._meta.reverse_relations:
+                raise ValueError('{} is not a reverse relation of {}'.format(related_name, self.model.__name__))
+        return self._clone(prefetch_related=self._options.get('prefetch_related', ()) + tuple(related_names))
+
+    def with_options(self, **write_options):
+        """
+        Returns a new queryset whose writes use the given options, on top of the model's `write_options`:
+            return_changes: Set to False to have `update` return a WriteResult with the counts of documents replaced,
+                unchanged etc. instead of the changed instances and their diffs, so the server doesn't send the
+                documents back.  `create` then returns the instance it inserted, with the id generated for it.
+            durability: 'soft' to have the server acknowledge writes before they are written to disk.
+            noreply: Don't wait for the server to process writes, which then return None (`create` returns the
+                unsaved instance, with no generated id).  Errors go unnoticed.
+        e.g.:
+            await Widget.objects.filter(owner=user_id).with_options(return_changes=False, durability='soft').update(
+                enabled=False)
+        """
+        check_write_options(write_options)
+        return self._clone(write_options=dict(self._options.get('write_options', {}), **write_options))
+
+    def _get_write_options(self) -> Mapping[str, Any]:
+        return dict(self.model._meta.write_options, **self._options.get('write_options', {}))
+
+    def lazy(self):
+        """
+        Return instances which decode each field from the document the first time it is accessed, rather than all
+        fields up front.  `save()` only sends back the fields which were accessed.
+        """
+        return self._clone(lazy=True)
+
+    def _check_field_names(self, field_names):
+        for field_name in field_names:
+            if field_name not in self.model._meta.fields:
+                raise ValueError('{} has no field {}'.format(self.model.__name__, field_name))
+
+    def _get_run_queries(self):
+        values_fields = self._options.get('values')
+        if values_fields is not None:
+            return self.queries + (('pluck', values_fields, {}),)
+        queries = self.queries
+        only_fields = self._options.get('only')
+        deferred_fields = self._options.get('defer', ())
+        if only_fields is not None:
+            fields = (PRIMARY_KEY,) + tuple(field_name for field_name in only_fields
+                                            if field_name != PRIMARY_KEY and field_name not in deferred_fields)
+            queries += (('pluck', fields, {}),)
+        elif deferred_fields:
+            queries += (('without', deferred_fields, {}),)
+        select_related = self._options.get('select_related')
+        if select_related:
+            model_fields = self.model._meta.fields
+            relations = tuple((field_name, model_fields[field_name].model.table) for field_name in select_related)
+            queries += (('merge', (RelatedDocuments(relations),), {}),)
+        return queries
+
+    def _get_deferred_fields(self) -> frozenset:
+        only_fields = self._options.get('only')
+        deferred_fields = frozenset(self._options.get('defer', ()))
+        if only_fields is not None:
+            deferred_fields |= frozenset(self.model._meta.fields).difference(only_fields)
+        # Instances always have their id, otherwise `save()` would insert them again
+        return deferred_fields - {PRIMARY_KEY}
+
+    def transform_query_results(self, results: list) -> list:
+        values_fields = self._options.get('values')
+        if values_fields is not None:
+            values_type = self._options['values_type']
+            if values_type is None:
+                return results  # The raw documents, see to_columns
+            return _to_values(self.model, results, values_fields, values_type)
+        select_related = self._options.get('select_related')
+        if select_related:
+            related_documents = [[result.pop(SELECT_RELATED_PREFIX + field_name, None) for field_name in select_related]
+                                 for result in results]
+        instances = [self.transform_query_result(result) for result in results]
+        deferred_fields = self._get_deferred_fields()
+        if deferred_fields:
+            for instance in instances:
+                instance._deferred_fields = deferred_fields
+        if select_related:
+            for instance, documents in zip(instances, related_documents):
+                _fill_related_objects(instance, select_related, documents)
+        return instances
 
     def transform_query_result(self, result):
-        return self.model.from_db(result)
+        decode = self.model.from_db_lazy if self._options.get('lazy') else self.model.from_db
+        identity_map = get_identity_map()
+        if identity_map is None or self._has_projection():
+            return decode(result)
+        return identity_map.get_or_decode(self.model, result, decode)
+
+    def _has_projection(self) -> bool:
+        """
+        Whether the results are missing some fields, in which case they're kept out of the identity map.
+        """
+        return self._options.get('only') is not None or bool(self._options.get('defer'))
+
+    def _get_local_rows(self) -> Optional[list]:
+        replica = self.model.objects.replica
+        if replica is None:
+            return None
+        return replica.query(self._get_run_queries())
+
+    async def _load_batch(self, values: list) -> list:
+        batch = await super(Queryset, self)._load_batch(values)
+        if self._options.get('values') is None:
+            for related_name in self._options.get('prefetch_related', ()):
+                await _prefetch_reverse_relation(self.model, related_name, batch)
+        return batch
 
     def filter(self, **filter_kwargs: Mapping[str, Any]):
-        extra_queries = []
+        """
+        Filter on field values, e.g. `filter(foo='bar', weight__gt=10)`.  When the filter is applied directly to the
+        table, one lookup on an indexed field is turned into a `get_all` or `between` query on the index instead of
+        scanning the whole table, and the rest are applied as ordinary filters.
+
+        Documents with a null or missing value for the field aren't in its index, so a range lookup answered by a
+        secondary index leaves them out: `weight__lt=10` doesn't match a null `weight`, though it would as a plain
+        filter.  Lookups in a later `filter` call, which don't use an index, keep them.
+        """
+        lookups = []
         for key, value in filter_kwargs.items():
             query_key_parts = key.split('__')
             if len(query_key_parts) == 1:
-                query = {key: value}
+                lookups.append((key, None, value))
             elif len(query_key_parts) == 2:
                 field, comparator = query_key_parts
-                query = _build_filter_query(field, comparator, value)
+                lookups.append((field, comparator, value))
             else:
                 raise ValueError('This is not a valid key for filtering: {}'.format(key))
-            extra_queries.append(('filter', (query,), {}))
-        return self.__class__(self.model, self.queries + tuple(extra_queries))
+
+        extra_queries = []
+        options = {}
+        if not self.queries:
+            index_query, index_lookups, lookups = _plan_index_query(self.model, lookups)
+            if index_query is not None:
+                extra_queries.append(index_query)
+                # Kept so that paginate can apply them as filters instead, see _get_filter_queries
+                options['index_lookups'] = tuple(index_lookups)
+        extra_queries.extend(_build_lookup_query(*lookup) for lookup in lookups)
+        return self._clone(self.queries + tuple(extra_queries), **options)
+
+    def _get_filter_queries(self) -> Tuple[DatabaseQuery, ...]:
+        """
+        The queryset's queries as filters which can be applied to any sequence, turning a `get_all` or `between`
+        picked by `filter` back into the lookups it stands for.
+        Raises:
+            ValueError if the queryset does anything but filter.
+        """
+        queries = self.queries
+        index_lookups = self._options.get('index_lookups')
+        if queries and index_lookups is not None:
+            queries = tuple(_build_lookup_query(*lookup) for lookup in index_lookups) + queries[1:]
+        for query_type, _, _ in queries:
+            if query_type != 'filter':
+                raise ValueError('Expected a queryset with only filters, found a {!r} query'.format(query_type))
+        return queries
 
     def order_by(self, field_name: str):
+        """
+        Order by a field, descending if its name starts with '-'.  On the table itself, or after a filter answered by
+        the same index, ordering by a field with a single field index (or the primary key) uses the index, which
+        returns a stream instead of loading all the results into an array on the server.  Documents with a null or
+        missing value for the field aren't in the index, so they are left out, where a plain `order_by` would put
+        them first.
+        """
         if field_name.startswith('-'):
             field_name = field_name[1:]
             order = r.desc
         else:
             order = r.asc
+        index_name = _get_order_by_index(self.model, self.queries, field_name)
+        if index_name is not None:
+            # Ordering by an index returns a stream rather than an array
+            query = ('order_by', tuple(), {'index': order(index_name)})
+            return self._clone(self.queries + (query,))
         query = ('order_by', (order(field_name),), {})
-        return OrderedQueryset(self.model, self.queries + (query,))
+        return self._clone(self.queries + (query,), klass=OrderedQueryset)
+
+    def paginate(self, by: str, page_size: int=100, cursor: Optional[str]=None) -> 'Paginator':
+        """
+        Walk the queryset in the order of an indexed field (the primary key, or a field with a single field index),
+        `page_size` results at a time, e.g.:
+            async for page in Widget.objects.filter(enabled=True).paginate(by='-created', page_size=100):
+                ...  # page.items
+        Each page is a query starting from the key of the last result of the previous page with `between` on the
+        index, so memory use doesn't grow with the size of the table, and later pages are as fast as the first.
+        `page.cursor` is a string to hand to clients, `paginate(..., cursor=page.cursor)` resumes after that page.  It
+        is None for the last page.
+
+        Results with equal keys come in primary key order.  Documents with a null or missing value for the field
+        aren't in the index, so they are left out.  The queryset can only have filters, and `order_by`/`limit` can't
+        be used with it.
+        """
+        descending = by.startswith('-')
+        field_name = by[1:] if descending else by
+        self._check_field_names((field_name,))
+        index_name = _get_single_field_indexes(self.model).get(field_name)
+        if index_name is None:
+            raise ValueError('paginate needs an index on {}.{}, declare one with index=True'.format(
+                self.model.__name__, field_name))
+        if page_size < 1:
+            raise ValueError('Expected page_size >= 1, got {}'.format(page_size))
+        values_fields = self._options.get('values')
+        if field_name in self._get_deferred_fields() or (values_fields is not None and (
+                field_name not in values_fields or PRIMARY_KEY not in values_fields)):
+            raise ValueError('paginate needs the {} and {} fields in the results'.format(field_name, PRIMARY_KEY))
+        position = None if cursor is None else _decode_page_cursor(cursor, by)
+        return Paginator(self, by, index_name, self._get_filter_queries(), page_size, position)
 
     def limit(self, num: int):
         query = ('limit', (num,), {})
-        return self.__class__(self.model, self.queries + (query,))
+        return self._clone(self.queries + (query,))
 
     async def get(self, **kwargs):
+        """
+        Returns the single instance matching the queryset and the given filters.  Inside an identity scope, a lookup
+        by primary key returns the instance already loaded if there is one, without a query.
+        """
         if kwargs:
-            self.filter(**kwargs)
+            return await self.filter(**kwargs).get()
+        identity_map = get_identity_map()
+        if identity_map is not None and not self._has_projection() and self._options.get('values') is None:
+            id = self._get_primary_key_lookup()
+            instance = identity_map.get(self.model, id) if id is not None else None
+            if instance is not None:
+                return instance
+        local_rows = self._get_local_rows()
+        if local_rows is not None:
+            if not local_rows:
+                raise self.model.DoesNotExist()
+            if len(local_rows) > 1:
+                raise TooManyResults(self.queries)
+            return self.transform_query_results(local_rows)[0]
+
         value = None
-        async with QueryRunner(self.model.table, self.queries) as query:
+        async with QueryRunner(self.model.table, self._get_run_queries()) as query:
             cursor = await query.run()
             if not await cursor.fetch_next():
                 raise self.model.DoesNotExist()
             value = await cursor.next()
+            query.record_rows([value])
             if await cursor.fetch_next():
                 raise TooManyResults(self.queries)
 
-        return self.transform_query_result(value)
+        return self.transform_query_results([value])[0]
 
-    async def update(self, **fields_to_update) -> List[Tuple[Any, List[Diff]]]:
+    async def profile(self) -> Profile:
+        """
+        Evaluate the queryset like `await queryset`, with rethinkdb's query profiler on, e.g.:
+            results, profile = await Widget.objects.filter(owner=user_id).profile()
+        `profile` is the server's account of how it ran the query (the steps, their timings and how they were
+        distributed across shards), as returned by `run(profile=True)`.  Profiling slows queries down, use it to
+        investigate them rather than in production code paths.
+        """
+        rows = []
+        async with QueryRunner(self.model.table, self._get_run_queries()) as query:
+            response = await query.run(profile=True)
+            value = response['value']
+            if isinstance(value, list):
+                rows = value
+            else:
+                while True:
+                    values = await fetch_batch(value, self.DEFAULT_BATCH_SIZE)
+                    if not values:
+                        break
+                    query.record_rows(values)
+                    rows.extend(values)
+        results = await self._load_batch(rows) if rows else []
+        return Profile(results, response['profile'])
+
+    async def count(self) -> int:
+        """
+        The number of documents matching the queryset, counted by the server.
+        """
+        return await run_aggregate(self.model, self.queries, Count())
+
+    async def exists(self) -> bool:
+        """
+        Whether any document matches the queryset, without fetching it.
+        """
+        return not await run_query(self.model.table, self.queries + (('is_empty', (), {}),))
+
+    async def aggregate(self, **aggregates: Aggregate) -> Mapping[str, Any]:
+        """
+        Compute aggregates over the documents matching the queryset on the server, e.g.:
+            await Widget.objects.filter(enabled=True).aggregate(total=Sum('weight'), n=Count())
+            {'total': 42.0, 'n': 3}
+        See resync.aggregates.  Each aggregate is a separate query, they are run concurrently.
+        """
+        check_aggregates(self.model, aggregates)
+        results = await asyncio.gather(*[run_aggregate(self.model, self.queries, aggregate)
+                                         for aggregate in aggregates.values()])
+        return dict(zip(aggregates, results))
+
+    async def to_columns(self, field_names: Sequence[str], encode: Iterable[str]=(),
+                         fill: Optional[Mapping[str, Any]]=None,
+                         batch_size: int=BaseQueryset.DEFAULT_BATCH_SIZE) -> 'OrderedDict[str, Column]':
+        """
+        Fetch the given fields of the matching documents into columns, by field name, without building model
+        instances, e.g.:
+            columns = await Widget.objects.filter(enabled=True).to_columns(['weight', 'created'])
+            sum(columns['weight']) / len(columns['weight'])
+        Only the fields are sent by the server, and each batch of documents is added to the columns as it arrives.
+        Boolean, int and float fields give `array`s of the matching type, datetime fields arrays of seconds since
+        the epoch.  String and foreign key fields named in `encode` are dictionary encoded, giving a DictionaryColumn
+        of codes and categories; other fields give lists of values like `values()`.  Null values become
+        `fill[field_name]` if given, see resync.columns.ColumnBuilder.
+        """
+        builders = get_column_builders(self.model, field_names, encode, fill)
+        queryset = self._clone(values=tuple(field_names), values_type=None)
+        async for batch in queryset.batches(batch_size):
+            for builder in builders:
+                builder.extend(batch)
+        return OrderedDict((builder.field_name, builder.column) for builder in builders)
+
+    async def to_numpy(self, field_names: Sequence[str], encode: Iterable[str]=(),
+                       fill: Optional[Mapping[str, Any]]=None,
+                       batch_size: int=BaseQueryset.DEFAULT_BATCH_SIZE) -> 'OrderedDict[str, Any]':
+        """
+        Like `to_columns`, but the columns are NumPy arrays, see resync.columns.to_numpy.  Needs NumPy installed.
+        """
+        return to_numpy(await self.to_columns(field_names, encode, fill, batch_size))
+
+    def group_by(self, *field_names: str) -> GroupedQueryset:
+        """
+        Group the documents matching the queryset on the values of the given fields, to compute aggregates for each
+        group, e.g. `await Widget.objects.group_by('owner').count()`.  See GroupedQueryset.
+        """
+        if not field_names:
+            raise ValueError('group_by needs at least one field')
+        self._check_field_names(field_names)
+        return GroupedQueryset(self, field_names)
+
+    def _get_primary_key_lookup(self):
+        """
+        Returns the primary key this queryset looks up, if that's all it does.
+        """
+        if len(self.queries) == 1:
+            query_type, args, kwargs = self.queries[0]
+            if query_type == 'get_all' and len(args) == 1 and kwargs == {'index': PRIMARY_KEY}:
+                return args[0]
+        return None
+
+    async def create(self, **field_data):
+        """
+        Inserts a new record into the database with this queryset's write options, see Manager.create.
+        """
+        return await self.model.objects._create(field_data, self._get_write_options())
+
+    async def update(self, **fields_to_update) -> Union[List[Tuple[Any, List[Diff]]], WriteResult, None]:
         """
         Update a queryset with new values for the fields passed as kwargs.  Returns a list of the changed objects.
         ### NOTE: Only the changed objects are returned, unchanged objects are ignored ###
@@ -125,18 +627,37 @@ class Queryset(BaseQueryset):
             [
                 <Hardware object>, [ ('change', 'status'. (0, 1)), ]
             ]  # One object changed status from 0 to 1
+            A WriteResult instead if `return_changes` is off, and None for `noreply` writes, see `with_options`.
+        """
+        return await self._run_update(self.model.serialize_fields(fields_to_update))
 
+    def update_stream(self, batch_size: int=BaseQueryset.DEFAULT_BATCH_SIZE, **fields_to_update) -> 'UpdateStream':
         """
-        serialized_data = self.model.serialize_fields(fields_to_update)
-        query_kwargs = {'return_changes': True}
+        Like `update`, but iterate over the changed objects and their diffs as they come instead of getting them all
+        in a list, e.g.:
+            async for widget, diff in Widget.objects.filter(enabled=True).update_stream(enabled=False):
+                ...
+        The ids of the matching documents are read with one connection, and the documents are updated in batches of
+        `batch_size` with another, so unlike `update` it doesn't happen in a single query.  Documents which stop
+        matching the filters between their id being read and their update are updated anyway.
+        """
+        return UpdateStream(self, self.model.serialize_fields(fields_to_update), batch_size)
+
+    async def _run_update(self, serialized_data: Mapping[str, Any]) -> Union[List[Tuple[Any, List[Diff]]],
+                                                                             WriteResult, None]:
+        query_kwargs, run_options = get_write_query_options(self._get_write_options())
         queries = self.queries + (('update', (serialized_data,), query_kwargs),)
         async with QueryRunner(self.model.table, queries) as query:
-            result = await query.run()
+            result = await query.run(**run_options)
+        if result is None:
+            return None  # noreply
         if result['errors']:
             msg = self.UPDATE_ERROR_MSG.format(
                 n_errors=result['errors'], error_msg=result['first_error'], query=self.queries)
             l.debug(msg)
             raise DBUpdateError(msg)
+        if not query_kwargs.get('return_changes'):
+            return get_write_result(result)
 
         changes = []
         for changeset in result['changes']:
@@ -145,16 +666,142 @@ class Queryset(BaseQueryset):
             changes.append((instance, diff))
         return changes
 
-    def changes(self):
+    async def delete(self) -> Optional[WriteResult]:
+        """
+        Delete the documents matching the queryset, in a single query.  Returns the counts of documents deleted etc.
+        The `durability` and `noreply` write options apply (see `with_options`), with `noreply` it returns None.
+        """
+        query_kwargs, run_options = get_write_query_options(dict(self._get_write_options(), return_changes=False))
+        queries = self.queries + (('delete', (), query_kwargs),)
+        async with QueryRunner(self.model.table, queries) as query:
+            result = await query.run(**run_options)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.discard_all(self.model)
+        if result is None:
+            return None  # noreply
+        if result['errors']:
+            msg = self.DELETE_ERROR_MSG.format(
+                n_errors=result['errors'], error_msg=result['first_error'], query=self.queries)
+            l.debug(msg)
+            raise DBDeleteError(msg)
+        return get_write_result(result)
+
+    def changes(self, **options):
         """
-        Subscribes to a change feed of the filtered queryset.
+        Subscribes to a change feed of the filtered queryset.  `options` are passed to rethinkdb's `changes`, e.g.
+        `squash=True`.
         Returns: A new AsyncChangeFeed similar to a Queryset in that it can be iterated over with `async for`,
         but without the chainable methods like `filter`.  You can make `filter` calls ahead of `changes`.
         """
-        query = ('changes', tuple(), {})
+        query = ('changes', tuple(), options)
         return AsyncChangeFeed(self.model, self.queries + (query,))
 
 
+class UpdateStream:
+    """
+    Async iterator over the changes made by Queryset.update_stream.
+    """
+
+    def __init__(self, queryset: Queryset, serialized_data: Mapping[str, Any], batch_size: int):
+        self.queryset = queryset.with_options(return_changes=True, noreply=False)
+        self.serialized_data = serialized_data
+        self.batch_size = batch_size
+        self._id_batches = None
+        self._buffer = deque()
+
+    async def __aiter__(self):
+        queryset = self.queryset
+        ids = queryset.__class__(queryset.model, queryset.queries).values_list(PRIMARY_KEY, flat=True)
+        self._id_batches = await ids.batches(self.batch_size).__aiter__()
+        return self
+
+    async def __anext__(self):
+        while not self._buffer:
+            ids = await self._id_batches.__anext__()
+            batch = self.queryset._clone(queries=(('get_all', tuple(ids), {}),), klass=Queryset)
+            self._buffer.extend(await batch._run_update(self.serialized_data))
+        return self._buffer.popleft()
+
+
+class Paginator:
+    """
+    Async iterator over the pages of a queryset, see Queryset.paginate.
+    """
+
+    def __init__(self, queryset: Queryset, by: str, index_name: str, filter_queries: Tuple[DatabaseQuery, ...],
+                 page_size: int, position: Optional[Tuple[Any, Any]]):
+        self.queryset = queryset
+        self.by = by
+        self.descending = by.startswith('-')
+        self.field_name = by.lstrip('-')
+        self.index_name = index_name
+        self.filter_queries = filter_queries
+        self.page_size = page_size
+        self._position = position  # (key, primary key) of the last result returned, None before the first page
+        self._done = False
+
+    async def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Page:
+        if self._done:
+            raise StopAsyncIteration
+        return await self.next_page()
+
+    async def next_page(self) -> Page:
+        """
+        Fetch the next page, an empty one after the last page.
+        """
+        if self._done:
+            return Page([], None)
+        queryset = self.queryset._clone(queries=self._get_page_queries(), klass=Queryset)
+        # One more than a page, to know whether there is a next one
+        rows = queryset._get_local_rows()
+        if rows is None:
+            rows = await self._fetch_rows(queryset)
+        has_next_page = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if rows:
+            # Read before decoding, which can modify the documents
+            self._position = (rows[-1][self.field_name], rows[-1][PRIMARY_KEY])
+        self._done = not has_next_page
+        items = await queryset._load_batch(rows)
+        cursor = _encode_page_cursor(self.by, self._position) if has_next_page else None
+        return Page(items, cursor)
+
+    async def _fetch_rows(self, queryset: 'Queryset') -> list:
+        queryset._query = QueryRunner(queryset.model.table, queryset._get_run_queries())
+        queryset.cursor = await queryset._query.run()
+        rows = []
+        try:
+            while len(rows) <= self.page_size:
+                values = await queryset._fetch_raw_batch(self.page_size + 1 - len(rows))
+                if not values:
+                    break
+                rows.extend(values)
+        finally:
+            await queryset._query.close()
+        return rows
+
+    def _get_page_queries(self) -> Tuple[DatabaseQuery, ...]:
+        order = r.desc if self.descending else r.asc
+        on_primary_key = self.index_name == PRIMARY_KEY
+        queries = ()
+        if self._position is not None:
+            key, id = self._position
+            # Results with the same key as the last one may be left, unless keys are unique
+            bound = 'open' if on_primary_key else 'closed'
+            if self.descending:
+                queries += (('between', (r.minval, key), {'index': self.index_name, 'right_bound': bound}),)
+            else:
+                queries += (('between', (key, r.maxval), {'index': self.index_name, 'left_bound': bound}),)
+        queries += (('order_by', tuple(), {'index': order(self.index_name)}),)
+        if self._position is not None and not on_primary_key:
+            queries += (('filter', (AfterPosition(self.field_name, key, id, self.descending),), {}),)
+        return queries + self.filter_queries + (('limit', (self.page_size + 1,), {}),)
+
+
 class OrderedQueryset(Queryset):
     """
     A separate class is required because an order_by query returns an array instead of a cursor.
@@ -164,17 +811,203 @@ class OrderedQueryset(Queryset):
         super(OrderedQueryset, self).__init__(*args, **kwargs)
         self._index = 0
 
-    async def __anext__(self):
-        try:
-            value = self.cursor[self._index]
-        except IndexError:
-            await self._query.close()
-            raise StopAsyncIteration
-        self._index += 1
-        return self.transform_query_result(value)
+    async def _fetch_raw_batch(self, size: int) -> list:
+        values = self.cursor[self._index:self._index + size]
+        self._index += len(values)
+        return values
+
+
+def _to_values(model, results: list, field_names: Tuple[str, ...], values_type) -> list:
+    """
+    Decode the given fields of raw documents into dicts, tuples or single values (values_type 'flat'), without
+    building model instances.
+    """
+    decoders = []
+    for field_name in field_names:
+        field = model._meta.fields[field_name]
+        # Foreign keys are left as ids rather than wrapped in a RelatedObjectProxy
+        decoders.append((field_name, field, None if isinstance(field, ForeignKeyField) else field.from_db))
+    rows = []
+    for result in results:
+        row = []
+        for field_name, field, from_db in decoders:
+            value = result.get(field_name, field.default)
+            row.append(value if from_db is None else from_db(value))
+        rows.append(row)
+    if values_type is dict:
+        return [dict(zip(field_names, row)) for row in rows]
+    if values_type is tuple:
+        return [tuple(row) for row in rows]
+    return [row[0] for row in rows]
+
+
+def check_write_options(write_options: Mapping[str, Any]):
+    unknown_options = set(write_options) - WRITE_OPTIONS
+    if unknown_options:
+        raise ValueError('Unknown write options {}, expected some of {}'.format(
+            ', '.join(sorted(unknown_options)), ', '.join(sorted(WRITE_OPTIONS))))
+
+
+def get_write_query_options(write_options: Mapping[str, Any]) -> Tuple[dict, dict]:
+    """
+    Split write options into the arguments of the write query (`insert`, `update` etc.) and the options to run it
+    with.  `return_changes` defaults to True, and is turned off for `noreply` writes since there is nobody to receive
+    the changes.
+    """
+    noreply = write_options.get('noreply', False)
+    return_changes = write_options.get('return_changes', True) and not noreply
+    query_kwargs = {'return_changes': return_changes} if return_changes else {}
+    if write_options.get('durability') is not None:
+        query_kwargs['durability'] = write_options['durability']
+    run_options = {'noreply': True} if noreply else {}
+    return query_kwargs, run_options
+
+
+def get_write_result(result: Mapping[str, Any]) -> WriteResult:
+    return WriteResult(**{name: result.get(name, 0) for name in WriteResult._fields})
+
+
+async def gather(*queries, limit: Optional[int]=None) -> list:
+    """
+    Run independent reads concurrently and return their results in order, e.g.:
+        widgets, n_users = await resync.gather(Widget.objects.filter(enabled=True), User.objects.count(), limit=10)
+    Querysets give lists of instances as when they're awaited, other awaitables (e.g. `count()`) are awaited.  At
+    most `limit` of them run at once, all of them if None.  If one fails, the others are cancelled.  With the pool in
+    shared mode (see ConnectionPool) they're multiplexed over a few connections rather than needing one each.
+    """
+    if limit is not None and limit < 1:
+        raise ValueError('Expected limit >= 1, got {}'.format(limit))
+    semaphore = asyncio.Semaphore(limit if limit is not None else max(len(queries), 1))
+
+    async def run_limited(query):
+        async with semaphore:
+            return await query
+
+    tasks = [asyncio.ensure_future(run_limited(query)) for query in queries]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def _get_single_field_indexes(model) -> Mapping[str, str]:
+    """
+    Returns a mapping of field name to the name of the index on only that field, including the primary key.
+    """
+    indexes = {PRIMARY_KEY: PRIMARY_KEY}
+    for index_name, fields in model._meta.indexes.items():
+        if len(fields) == 1:
+            indexes[fields[0]] = index_name
+    return indexes
+
+
+def _plan_index_query(model, lookups: List[Lookup]) -> Tuple[DatabaseQuery, List[Lookup], List[Lookup]]:
+    """
+    Pick at most one index to answer some of the lookups of a filter applied directly to a table.  Equality lookups
+    covering all the fields of an index are preferred (the widest index wins) and become a `get_all`, otherwise lower
+    and/or upper bounds on a single field index become a `between`.  Note that documents with a null or missing value
+    for the field are not in the index, so they are never matched by a lookup that used it.  Lookups on null or
+    objects, which aren't valid index keys, are left to the filter.
+    Returns:
+        The index query (or None), the lookups it answers, and the lookups still to be applied with `filter`.
+    """
+    equal_lookups = {}
+    for position, (field, comparator, value) in enumerate(lookups):
+        if comparator in (None, 'eq') and _is_index_key(value):
+            equal_lookups.setdefault(field, position)
+
+    indexes = dict(model._meta.indexes)
+    indexes[PRIMARY_KEY] = (PRIMARY_KEY,)
+    best_index = None
+    for index_name, fields in indexes.items():
+        if all(field in equal_lookups for field in fields):
+            if best_index is None or len(fields) > len(indexes[best_index]):
+                best_index = index_name
+    if best_index is not None:
+        fields = indexes[best_index]
+        used = {equal_lookups[field] for field in fields}
+        values = [lookups[equal_lookups[field]][2] for field in fields]
+        key = values[0] if len(values) == 1 else values
+        used_lookups = [lookup for position, lookup in enumerate(lookups) if position in used]
+        remaining = [lookup for position, lookup in enumerate(lookups) if position not in used]
+        return ('get_all', (key,), {'index': best_index}), used_lookups, remaining
+
+    single_field_indexes = _get_single_field_indexes(model)
+    for field, comparator, value in lookups:
+        if field in single_field_indexes and _is_index_key(value) and (comparator in LOWER_BOUND_COMPARATORS or
+                                                                       comparator in UPPER_BOUND_COMPARATORS):
+            break
+    else:
+        return None, [], lookups
+
+    lower = upper = None
+    used_lookups = []
+    remaining = []
+    for position, lookup in enumerate(lookups):
+        lookup_field, comparator, value = lookup
+        if lookup_field != field or not _is_index_key(value):
+            remaining.append(lookup)
+        elif lower is None and comparator in LOWER_BOUND_COMPARATORS:
+            lower = lookup
+            used_lookups.append(lookup)
+        elif upper is None and comparator in UPPER_BOUND_COMPARATORS:
+            upper = lookup
+            used_lookups.append(lookup)
+        else:
+            remaining.append(lookup)
+    kwargs = {'index': single_field_indexes[field]}
+    if lower is not None:
+        kwargs['left_bound'] = LOWER_BOUND_COMPARATORS[lower[1]]
+    if upper is not None:
+        kwargs['right_bound'] = UPPER_BOUND_COMPARATORS[upper[1]]
+    args = (lower[2] if lower is not None else r.minval, upper[2] if upper is not None else r.maxval)
+    return ('between', args, kwargs), used_lookups, remaining
+
+
+def _is_index_key(value) -> bool:
+    return value is not None and not isinstance(value, Mapping)
 
 
-def _build_filter_query(field: str, comparator: str, value: Any) -> Callable[[Any], bool]:
+def _get_order_by_index(model, queries: Tuple[DatabaseQuery], field_name: str):
+    """
+    Returns the name of the index to order by for `field_name`, if there is one and the queryset can use it: indexed
+    ordering is only possible on the table itself, or on a `between` query on the same index.
+    """
+    index_name = _get_single_field_indexes(model).get(field_name)
+    if index_name is None:
+        return None
+    if not queries:
+        return index_name
+    if len(queries) == 1 and queries[0][0] == 'between' and queries[0][2]['index'] == index_name:
+        return index_name
+    return None
+
+
+def _build_lookup_query(field: str, comparator: Optional[str], value: Any) -> DatabaseQuery:
+    if comparator is None:
+        return 'filter', ({field: value},), {}
+    return 'filter', (_build_filter_query(field, comparator, value),), {}
+
+
+def _encode_page_cursor(by: str, position: Tuple[Any, Any]) -> str:
+    data = json.dumps([by, position[0], position[1]], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_page_cursor(cursor: str, by: str) -> Tuple[Any, Any]:
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_by, key, id = json.loads(data.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid pagination cursor {!r}'.format(cursor))
+    if cursor_by != by:
+        raise ValueError('Pagination cursor is for paginate(by={!r}), not {!r}'.format(cursor_by, by))
+    return key, id
+
+
+def _build_filter_query(field: str, comparator: str, value: Any) -> 'FilterPredicate':
     """
     Returns a function that returns a boolean, for use in a ReQL query as in the examples here:
         http://rethinkdb.com/api/python/filter/
@@ -186,8 +1019,175 @@ def _build_filter_query(field: str, comparator: str, value: Any) -> Callable[[An
     """
     if comparator not in ALLOWED_COMPARATORS:
         raise KeyError('Comparator "{}" is not recognized'.format(comparator))
-    compare = getattr(operator, comparator)  # type: Callable[[Any, Any], bool]
-    return lambda row: compare(row[field], value)
+    return FilterPredicate(field, comparator, value)
+
+
+class FilterPredicate(QueryFunction):
+    """
+    Compares a field of each document to a value, see _build_filter_query.
+    """
+
+    def __init__(self, field: str, comparator: str, value: Any):
+        self.field = field
+        self.comparator = comparator
+        self.value = value
+        self.shape = (field, comparator)
+        self.params = (value,)
+
+    def bind(self, params):
+        return self.__class__(self.field, self.comparator, params[0])
+
+    def as_function(self) -> Callable[[Any], bool]:
+        field, value = self.field, self.value
+        compare = getattr(operator, self.comparator)  # type: Callable[[Any, Any], bool]
+        return lambda row: compare(row[field], value)
+
+    def evaluate(self, row) -> bool:
+        field_value, value = row[self.field], self.value
+        if isinstance(field_value, bool) != isinstance(value, bool):
+            # Unlike in Python, booleans aren't numbers in ReQL, they are never equal and order by type
+            if self.comparator in ('eq', 'ne'):
+                return self.comparator == 'ne'
+            raise TypeError('Cannot order {!r} and {!r}'.format(field_value, value))
+        return getattr(operator, self.comparator)(field_value, value)
+
+
+class AfterPosition(QueryFunction):
+    """
+    Skips the results with the same key as the last one of the previous page which came before it, see Paginator.
+    """
+
+    def __init__(self, field: str, key: Any, id: Any, descending: bool):
+        self.field = field
+        self.key = key
+        self.id = id
+        self.descending = descending
+        self.shape = (field, descending)
+        self.params = (key, id)
+
+    def bind(self, params):
+        return self.__class__(self.field, params[0], params[1], self.descending)
+
+    def as_function(self) -> Callable[[Any], bool]:
+        field, key, id = self.field, self.key, self.id
+        if self.descending:
+            return lambda row: (row[field] != key) | (row[PRIMARY_KEY] < id)
+        return lambda row: (row[field] != key) | (row[PRIMARY_KEY] > id)
+
+    def evaluate(self, row) -> bool:
+        if row[self.field] != self.key:
+            return True
+        return row[PRIMARY_KEY] < self.id if self.descending else row[PRIMARY_KEY] > self.id
+
+
+class BulkPatch(QueryFunction):
+    """
+    Update function setting fields to different values for each document, from a mapping of primary key (as a
+    string, see `get_patch_key`) to the document's values, see Manager.bulk_update.
+    """
+
+    def __init__(self, field_names: Tuple[str, ...], patches: Mapping[str, Mapping[str, Any]]):
+        self.field_names = field_names
+        self.patches = patches
+        self.shape = field_names
+        self.params = (patches,)
+
+    def bind(self, params):
+        return self.__class__(self.field_names, params[0])
+
+    def as_function(self) -> Callable[[Any], Any]:
+        field_names, patches = self.field_names, self.patches
+
+        def get_patch(row):
+            patch = r.expr(patches)[row[PRIMARY_KEY].coerce_to('string')]
+            # Set the fields to exactly these values, rather than merging nested objects into them
+            return {field_name: r.literal(patch[field_name]) for field_name in field_names}
+        return get_patch
+
+    @staticmethod
+    def get_patch_key(id) -> str:
+        """
+        The key for a primary key in `patches`: ReQL objects only have string keys.
+        """
+        return id if isinstance(id, str) else str(id)
+
+
+class RelatedDocuments(QueryFunction):
+    """
+    Merges the documents referenced by foreign keys into each document, see Queryset.select_related.
+    """
+
+    def __init__(self, relations: Tuple[Tuple[str, str], ...]):
+        self.relations = relations  # (field name, table of the related model)
+        self.shape = relations
+
+    def bind(self, params):
+        return self
+
+    def as_function(self) -> Callable[[Any], Any]:
+        relations = self.relations
+
+        def get_related_documents(row):
+            return {SELECT_RELATED_PREFIX + field_name: r.branch(row[field_name].default(None).eq(None), None,
+                                                                 r.table(table).get(row[field_name]))
+                    for field_name, table in relations}
+        return get_related_documents
+
+
+class ContainedIn(QueryFunction):
+    """
+    Matches documents where a field has one of the given values, see _prefetch_reverse_relation.
+    """
+
+    def __init__(self, field: str, values: list):
+        self.field = field
+        self.values = values
+        self.shape = field
+        self.params = (values,)
+
+    def bind(self, params):
+        return self.__class__(self.field, params[0])
+
+    def as_function(self) -> Callable[[Any], bool]:
+        field, values = self.field, self.values
+        return lambda row: r.expr(values).contains(row[field])
+
+    def evaluate(self, row) -> bool:
+        return row[self.field] in self.values
+
+
+def _fill_related_objects(instance, field_names, documents):
+    for field_name, document in zip(field_names, documents):
+        proxy = getattr(instance, field_name)
+        if document is not None and isinstance(proxy, RelatedObjectProxy):
+            identity_map = get_identity_map()
+            if identity_map is None:
+                proxy._cache = proxy.model.from_db(document)
+            else:
+                proxy._cache = identity_map.get_or_decode(proxy.model, document, proxy.model.from_db)
+
+
+async def _prefetch_reverse_relation(model, related_name: str, instances: list):
+    """
+    Fetch the related objects of all instances in one query, through the foreign key's index if it has one, and
+    hand each instance its share.
+    """
+    reverse_field = model._meta.reverse_relations[related_name]
+    target_model, field_name = reverse_field.target_model, reverse_field.field_name
+    instances_by_id = {instance.id: instance for instance in instances if instance.id is not None}
+    related_objects = {id: [] for id in instances_by_id}
+    if instances_by_id:
+        ids = list(instances_by_id)
+        if target_model._meta.indexes.get(field_name) == (field_name,):
+            query = ('get_all', tuple(ids), {'index': field_name})
+        else:
+            query = ('filter', (ContainedIn(field_name, ids),), {})
+        async for related_object in Queryset(target_model, (query,)):
+            proxy = getattr(related_object, field_name)
+            proxy._cache = instances_by_id[proxy.id]
+            related_objects[proxy.id].append(related_object)
+    for id, instance in instances_by_id.items():
+        instance._set_prefetched(related_name, related_objects[id])
 
 
 class AsyncChangeFeed(BaseQueryset):
@@ -205,3 +1205,7 @@ class TooManyResults(Exception):
 
 class DBUpdateError(Exception):
     pass
+
+
+class DBDeleteError(Exception):
+    pass
@@ -0,0 +1,425 @@
+import asyncio
+import bisect
+import weakref
+from logging import getLogger
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+import rethinkdb as r
+from rethinkdb.ast import RqlQuery
+
+from resync.codecs import copy_document
+from resync.connection import DatabaseQuery, QueryFunction, QueryRunner, fetch_batch
+from resync.queryset import PRIMARY_KEY
+
+l = getLogger('resync.replica')
+
+ReplicaStats = NamedTuple('ReplicaStats', [
+    ('ready', bool),
+    ('documents', int),
+    ('changes', int),
+    ('reloads', int),
+    ('local_reads', int),
+    ('fallbacks', int),
+    ('seconds_since_change', Optional[float]),
+    ('seconds_since_ready', Optional[float]),
+])
+
+_running_replicas = weakref.WeakSet()
+
+
+class UnsupportedQuery(Exception):
+    """
+    Raised for queries a replica can't answer the way the server would, which are sent to the server instead.
+    """
+
+
+class TableReplica:
+    """
+    An in-memory copy of a model's table, kept up to date by a changefeed, which answers reads on the model's
+    querysets locally instead of querying the database.  Meant for small tables which are read far more often than
+    they change (feature flags, tenants, prices...).  Start it with `Model.objects.replicate()`.
+
+    The changefeed is opened with `include_initial`, so it sends the whole table, then the changes.  Once the table
+    is loaded the replica is `ready` and answers querysets made of `filter`s (with the eq/ne/gt/lt/ge/le lookups),
+    `get`, `order_by`, `limit`, `only`/`defer` and `values`, using hash indexes for `get_all` (equality lookups on an
+    index or the primary key) and sorted indexes for `between` and ordering on an index.  Anything else, e.g.
+    `select_related`, updates or aggregates, goes to the database as usual, as do all reads while the replica isn't
+    ready.  If the changefeed fails, the replica stops answering and reloads the table after `RETRY_DELAY` seconds.
+
+    Reads aren't guaranteed to see the replica's own writes straight away: the changes reach the replica through
+    the changefeed, shortly after the write.
+    """
+
+    RETRY_DELAY = 1.0  # Seconds to wait before reloading after the changefeed fails
+    BATCH_SIZE = 1000
+
+    def __init__(self, model):
+        self.model = model
+        self._documents = {}  # id -> document
+        self._loading = None  # Documents received while the table is being loaded
+        self._hash_indexes = {}  # index name -> {key: [ids]}, built the first time they're used
+        self._sorted_indexes = {}  # index name -> (keys, ids) sorted on (key, id), built when used after a change
+        self._ready = asyncio.Event()
+        self._feed_task = None
+        self._ready_at = None
+        self._changed_at = None
+        self._counters = dict.fromkeys(('changes', 'reloads', 'local_reads', 'fallbacks'), 0)
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self):
+        """
+        Start loading the table and following its changes, if it isn't already.
+        """
+        if self._feed_task is None:
+            self._feed_task = asyncio.ensure_future(self._follow_changes())
+            _running_replicas.add(self)
+
+    async def stop(self):
+        """
+        Stop following the changefeed and drop the copy, reads go to the database again.
+        """
+        _running_replicas.discard(self)
+        task, self._feed_task = self._feed_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._reset()
+
+    async def wait_ready(self, timeout: Optional[float]=None):
+        """
+        Wait until the table is loaded.
+        Raises:
+            asyncio.TimeoutError if it takes longer than `timeout` seconds.
+        """
+        await asyncio.wait_for(self._ready.wait(), timeout)
+
+    def stats(self) -> ReplicaStats:
+        """
+        The replica's state and counters.  `seconds_since_change` is the time since the last change arrived, which
+        on a table that rarely changes grows without the copy being out of date; `seconds_since_ready` is the time
+        since the copy was last (re)loaded.
+        """
+        now = asyncio.get_event_loop().time()
+        return ReplicaStats(
+            ready=self.ready,
+            documents=len(self._documents),
+            seconds_since_change=None if self._changed_at is None else now - self._changed_at,
+            seconds_since_ready=None if self._ready_at is None or not self.ready else now - self._ready_at,
+            **self._counters
+        )
+
+    def query(self, queries: Tuple[DatabaseQuery, ...]) -> Optional[List[Mapping[str, Any]]]:
+        """
+        The raw documents the queries would return, copied so they can be modified, or None if the replica isn't
+        ready or can't answer the queries.
+        """
+        if not self.ready:
+            return None
+        try:
+            documents = self._evaluate(queries)
+        except (UnsupportedQuery, TypeError):
+            # TypeError: Python can't compare values of different types, ReQL orders them by type
+            l.debug('Replica of {} falling back to the database for {}'.format(self.model.table, queries))
+            self._counters['fallbacks'] += 1
+            return None
+        self._counters['local_reads'] += 1
+        return [copy_document(document) for document in documents]
+
+    def _evaluate(self, queries):
+        documents = None  # All of them, in no particular order
+        index_order = None  # The index the documents are ordered on after a `between`
+        for position, (query_type, args, kwargs) in enumerate(queries):
+            if query_type == 'get_all' and position == 0:
+                documents = self._get_all(args, kwargs.get('index', PRIMARY_KEY))
+            elif query_type == 'between' and position == 0:
+                documents = self._between(args, kwargs)
+                index_order = kwargs.get('index', PRIMARY_KEY)
+            elif query_type == 'order_by':
+                documents = self._order_by(documents, args, kwargs, position, index_order)
+            elif query_type == 'filter' and len(args) == 1 and not kwargs:
+                documents = [document for document in self._all(documents) if _matches(document, args[0])]
+            elif query_type == 'limit' and len(args) == 1:
+                documents = list(self._all(documents))[:args[0]]
+            elif query_type == 'pluck' and not kwargs:
+                documents = [{key: document[key] for key in args if key in document}
+                             for document in self._all(documents)]
+            elif query_type == 'without' and not kwargs:
+                documents = [{key: value for key, value in document.items() if key not in args}
+                             for document in self._all(documents)]
+            else:
+                raise UnsupportedQuery(query_type)
+        return list(self._all(documents))
+
+    def _all(self, documents):
+        return self._documents.values() if documents is None else documents
+
+    def _get_all(self, keys, index_name):
+        if index_name == PRIMARY_KEY:
+            if any(isinstance(key, bool) for key in keys):
+                raise UnsupportedQuery('boolean key')  # True == 1 in Python, it would find the document with id 1
+            return [self._documents[key] for key in keys if _is_hashable(key) and key in self._documents]
+        index = self._get_hash_index(index_name)
+        documents = []
+        for key in keys:
+            key = _freeze(key)
+            documents.extend(self._documents[id] for id in index.get(key, ()))
+        return documents
+
+    def _between(self, args, kwargs):
+        lower, upper = args
+        keys, ids = self._get_sorted_index(kwargs.get('index', PRIMARY_KEY))
+        if lower is r.minval:
+            start = 0
+        else:
+            lower = _freeze(lower)
+            start = (bisect.bisect_right if kwargs.get('left_bound') == 'open' else bisect.bisect_left)(keys, lower)
+        if upper is r.maxval:
+            end = len(keys)
+        else:
+            upper = _freeze(upper)
+            end = (bisect.bisect_right if kwargs.get('right_bound') == 'closed' else bisect.bisect_left)(keys, upper)
+        return [self._documents[id] for id in ids[start:end]]
+
+    def _order_by(self, documents, args, kwargs, position, index_order):
+        if 'index' in kwargs:
+            if args or not (position == 0 or index_order is not None):
+                raise UnsupportedQuery('order_by')
+            index_name, descending = _get_order(kwargs['index'])
+            if index_order is not None and index_order != index_name:
+                raise UnsupportedQuery('order_by')
+            fields = self._get_index_fields(index_name)
+            # Documents which aren't in the index are left out
+            keyed = [(key, document[PRIMARY_KEY], document) for key, document in
+                     ((_get_index_key(document, fields), document) for document in self._all(documents))
+                     if key is not None]
+        else:
+            if len(args) != 1:
+                raise UnsupportedQuery('order_by')
+            field_name, descending = _get_order(args[0])
+            keyed = []
+            for document in self._all(documents):
+                if document.get(field_name) is None:
+                    raise UnsupportedQuery('order_by on a missing value')
+                keyed.append((_freeze(document[field_name]), document[PRIMARY_KEY], document))
+        keyed.sort(key=lambda item: item[:2], reverse=descending)
+        return [document for key, id, document in keyed]
+
+    def _get_index_fields(self, index_name) -> Tuple[str, ...]:
+        if index_name == PRIMARY_KEY:
+            return (PRIMARY_KEY,)
+        fields = self.model._meta.indexes.get(index_name)
+        if fields is None:
+            raise UnsupportedQuery('unknown index {}'.format(index_name))
+        return fields
+
+    def _get_hash_index(self, index_name) -> Dict[Any, List[Any]]:
+        index = self._hash_indexes.get(index_name)
+        if index is None:
+            fields = self._get_index_fields(index_name)
+            index = {}
+            for id, document in self._documents.items():
+                key = _get_index_key(document, fields)
+                if key is not None:
+                    index.setdefault(key, []).append(id)
+            self._hash_indexes[index_name] = index
+        return index
+
+    def _get_sorted_index(self, index_name) -> Tuple[list, list]:
+        index = self._sorted_indexes.get(index_name)
+        if index is None:
+            fields = self._get_index_fields(index_name)
+            entries = []
+            for id, document in self._documents.items():
+                key = _get_index_key(document, fields)
+                if key is not None:
+                    entries.append((key, id))
+            entries.sort()
+            index = self._sorted_indexes[index_name] = ([key for key, id in entries], [id for key, id in entries])
+        return index
+
+    def _apply_change(self, change):
+        if 'state' in change:
+            if change['state'] == 'ready':
+                self._publish()
+            return
+        old_document, new_document = change.get('old_val'), change.get('new_val')
+        id = (new_document or old_document or {}).get(PRIMARY_KEY)
+        if id is None:
+            return
+        if self._loading is not None:
+            if new_document is None:
+                self._loading.pop(id, None)
+            else:
+                self._loading[id] = new_document
+            return
+
+        self._counters['changes'] += 1
+        self._changed_at = asyncio.get_event_loop().time()
+        old_document = self._documents.pop(id, None)
+        if new_document is not None:
+            self._documents[id] = new_document
+        for index_name, index in list(self._hash_indexes.items()):
+            fields = self._get_index_fields(index_name)
+            try:
+                old_key, new_key = _get_index_key(old_document, fields), _get_index_key(new_document, fields)
+            except UnsupportedQuery:
+                del self._hash_indexes[index_name]  # Rebuilt if it's used, when it will fall back to the database
+                continue
+            if old_key is not None:
+                ids = index.get(old_key, [])
+                if id in ids:
+                    ids.remove(id)
+                if not ids:
+                    index.pop(old_key, None)
+            if new_key is not None:
+                index.setdefault(new_key, []).append(id)
+        for index_name in list(self._sorted_indexes):
+            fields = self._get_index_fields(index_name)
+            try:
+                changed = _get_index_key(old_document, fields) != _get_index_key(new_document, fields)
+            except UnsupportedQuery:
+                changed = True
+            if changed:
+                del self._sorted_indexes[index_name]
+
+    def _publish(self):
+        """
+        The table is loaded, start answering reads from it.
+        """
+        if self._loading is None:
+            return
+        self._documents, self._loading = self._loading, None
+        self._hash_indexes.clear()
+        self._sorted_indexes.clear()
+        self._ready_at = self._changed_at = asyncio.get_event_loop().time()
+        self._ready.set()
+        l.debug('Replica of {} ready with {} documents'.format(self.model.table, len(self._documents)))
+
+    def _reset(self):
+        self._ready.clear()
+        self._documents = {}
+        self._loading = None
+        self._hash_indexes.clear()
+        self._sorted_indexes.clear()
+
+    async def _follow_changes(self):
+        queries = (('changes', (), {'include_initial': True, 'include_states': True}),)
+        while True:
+            self._loading = {}
+            query = QueryRunner(self.model.table, queries)
+            try:
+                cursor = await query.run()
+                while True:
+                    changes = await fetch_batch(cursor, self.BATCH_SIZE)
+                    if not changes:
+                        break
+                    query.record_rows(changes)
+                    for change in changes:
+                        self._apply_change(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                l.debug('Exception in changefeed of {} replica'.format(self.model.table), exc_info=True)
+            finally:
+                # Changes may be missed until the feed is back up
+                self._reset()
+                await query.abort()
+            self._counters['reloads'] += 1
+            await asyncio.sleep(self.RETRY_DELAY)
+
+
+async def stop_replicas():
+    """
+    Stop all running replicas, see TableReplica.
+    """
+    for replica in list(_running_replicas):
+        await replica.stop()
+
+
+def _matches(document, condition) -> bool:
+    if isinstance(condition, QueryFunction):
+        try:
+            return bool(condition.evaluate(document))
+        except KeyError:
+            return False  # A filter skips the documents its function fails on
+        except NotImplementedError:
+            raise UnsupportedQuery(condition.__class__.__name__)
+    if isinstance(condition, Mapping):
+        return _matches_object(document, condition)
+    raise UnsupportedQuery('filter on {!r}'.format(condition))
+
+
+def _matches_object(value, pattern) -> bool:
+    """
+    Filtering on an object matches documents with the same values for its keys, recursively for nested objects.
+    """
+    if not isinstance(value, Mapping):
+        return False
+    for key, expected in pattern.items():
+        if key not in value:
+            return False
+        if isinstance(expected, Mapping):
+            if not _matches_object(value[key], expected):
+                return False
+        elif isinstance(expected, (RqlQuery, QueryFunction)) or callable(expected):
+            raise UnsupportedQuery('filter on {!r}'.format(expected))
+        elif not _equal(value[key], expected):
+            return False
+    return True
+
+
+def _equal(value, other) -> bool:
+    # Unlike in Python, booleans aren't numbers in ReQL
+    return value == other and isinstance(value, bool) == isinstance(other, bool)
+
+
+def _get_order(term) -> Tuple[str, bool]:
+    """
+    The field or index name and whether the order is descending, from an `r.asc(...)`/`r.desc(...)` or a name.
+    """
+    if isinstance(term, str):
+        return term, False
+    if isinstance(term, RqlQuery) and type(term).__name__ in ('Asc', 'Desc') and len(term._args) == 1:
+        name = getattr(term._args[0], 'data', None)
+        if isinstance(name, str):
+            return name, type(term).__name__ == 'Desc'
+    raise UnsupportedQuery('order_by {!r}'.format(term))
+
+
+def _get_index_key(document, fields):
+    """
+    The document's key in an index, None if it isn't in the index (no value for one of the fields).
+    """
+    if document is None:
+        return None
+    values = []
+    for field in fields:
+        value = document.get(field)
+        if value is None:
+            return None
+        values.append(_freeze(value))
+    return values[0] if len(values) == 1 else tuple(values)
+
+
+def _freeze(value):
+    """
+    Arrays as tuples, so they can be used as keys.  Booleans aren't supported: in Python they are equal to and
+    ordered among the numbers, while ReQL keeps them apart and orders them by type.
+    """
+    if isinstance(value, bool):
+        raise UnsupportedQuery('key {!r}'.format(value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (dict, RqlQuery)):
+        raise UnsupportedQuery('key {!r}'.format(value))
+    return value
+
+
+def _is_hashable(value) -> bool:
+    return isinstance(value, (str, int, float))
@@ -0,0 +1,178 @@
+"""
+An in-process stand-in for a rethinkdb server, for tests and benchmarks which shouldn't need one.  Connections opened
+by the pool answer each query by calling a `responder` with the query, e.g.:
+
+    def responder(query, options):
+        if get_term_name(query) == 'COUNT':
+            return 3
+        return FakeCursor([{'id': '1'}, {'id': '2'}, {'id': '3'}])
+
+    with FakeConnector(responder):
+        resync.setup({'db': 'test'})
+        widgets = await Widget.objects.all()
+
+Everything above the connection runs as usual: the connection pool, query building and caching, cursors being read
+in batches, decoding, etc.
+"""
+import asyncio
+import itertools
+from collections import deque
+from typing import Any, Callable, Iterable, Mapping, Optional
+
+from rethinkdb.errors import ReqlCursorEmpty
+from rethinkdb.ql2_pb2 import Term
+
+from resync.connection import ConnectionPool, QueryCache, connection_pool
+
+# Term type names by their number in built queries
+TERM_NAMES = {value: name for name, value in vars(Term.TermType).items() if isinstance(value, int)}
+
+# Called with a fully built query and the run options (e.g. `noreply`), returns the query's result
+Responder = Callable[[list, Mapping[str, Any]], Any]
+
+
+class FakeCursor:
+    """
+    A cursor over the given rows, handed out in batches of `batch_size` like the server's.  The rows can be any
+    iterable, e.g. a generator for rows made up on the fly.  An `endless` cursor waits for more rows once they run out
+    instead of ending, like a changefeed, until it is closed.  More rows can be added with `push`, e.g. changes.
+    `closed` tells whether the cursor was closed, as a query which is stopped early should do.
+    """
+
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, rows: Iterable, batch_size: int=DEFAULT_BATCH_SIZE, endless: bool=False):
+        self.items = deque()
+        self.error = None
+        self.batch_size = batch_size
+        self.endless = endless
+        self.closed = False
+        self._rows = iter(rows)
+        self._waiter = None
+
+    async def fetch_next(self, wait=True) -> bool:
+        while not self.items:
+            # Let other tasks run, as waiting for the server's next batch would
+            await asyncio.sleep(0)
+            self.items.extend(itertools.islice(self._rows, self.batch_size))
+            if self.items:
+                break
+            if not self.endless:
+                return False
+            self._waiter = asyncio.Future()
+            await self._waiter
+        return True
+
+    def push(self, *rows):
+        self._rows = itertools.chain(self._rows, rows)
+        self._wake_up()
+
+    async def next(self, wait=True):
+        if not await self.fetch_next(wait):
+            raise ReqlCursorEmpty()
+        return self.items.popleft()
+
+    def _maybe_fetch_batch(self):
+        pass  # Batches are fetched by fetch_next
+
+    def close(self):
+        self.closed = True
+        self._rows = iter(())
+        self.endless = False
+        self._wake_up()
+
+    def _wake_up(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+class FakeConnection:
+    """
+    Stands in for a connection from `r.connect`, answering queries with the responder.  Queries are built into the
+    nested lists and dicts which would be sent as JSON, e.g. `[TABLE, ['widget']]` for `r.table('widget')`, see
+    `get_term_name` and `get_table`.  The responder returns the result: a FakeCursor for queries returning a stream,
+    anything else as it is (lists for arrays, dicts for write results...), or raises the query's error.
+    """
+
+    def __init__(self, responder: Responder, log: Optional[list]=None):
+        self.responder = responder
+        self.log = log
+        self._open = True
+
+    def is_open(self) -> bool:
+        return self._open
+
+    async def close(self, noreply_wait=False):
+        self._open = False
+
+    def _start(self, term, **options):
+        # Called by RqlQuery.run
+        future = asyncio.Future()
+        try:
+            query = QueryCache._build_term(term)
+            if self.log is not None:
+                self.log.append((query, options))
+            result = self.responder(query, options)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        if options.get('noreply'):
+            result = None
+        elif options.get('profile'):
+            result = {'value': result, 'profile': []}
+        future.set_result(result)
+        return future
+
+
+class FakeConnector:
+    """
+    Makes the connection pool open FakeConnections instead of connecting to a server, while installed (or inside a
+    `with` block).  If `log` is True, the queries sent and their run options are recorded in `queries`.
+    """
+
+    def __init__(self, responder: Responder, log: bool=False, pool: ConnectionPool=connection_pool):
+        self.responder = responder
+        self.queries = [] if log else None  # type: Optional[list]
+        self.pool = pool
+        self.connections = []
+        self._saved_connect = None
+
+    async def __call__(self, **config) -> FakeConnection:
+        connection = FakeConnection(self.responder, self.queries)
+        self.connections.append(connection)
+        return connection
+
+    def install(self) -> 'FakeConnector':
+        self._saved_connect = self.pool.connect
+        self.pool.connect = self
+        return self
+
+    def uninstall(self):
+        self.pool.connect = self._saved_connect
+
+    def __enter__(self) -> 'FakeConnector':
+        return self.install()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+
+
+def get_term_name(query) -> Optional[str]:
+    """
+    The name of the outermost term of a built query, e.g. 'UPDATE' for `r.table('widget').filter(...).update(...)`,
+    None for a plain value.
+    """
+    if isinstance(query, list) and query and isinstance(query[0], int):
+        return TERM_NAMES.get(query[0])
+    return None
+
+
+def get_table(query) -> Optional[str]:
+    """
+    The name of the table a built query starts from.
+    """
+    while isinstance(query, list) and len(query) > 1 and query[1]:
+        if query[0] == Term.TermType.TABLE:
+            return query[1][-1]
+        query = query[1][0]
+    return None
@@ -23,6 +23,7 @@ setup(
     packages=find_packages(exclude=('docs', 'tests')),
     include_package_data=True,
     install_requires=install_requires,
+    extras_require={'numpy': ['numpy']},
     use_scm_version=True,
     setup_requires=['setuptools_scm'],
     classifiers=[
@@ -0,0 +1,74 @@
+"""
+The tests run against resync.testing's stand-in connections instead of a server, see FakeConnector.
+"""
+import asyncio
+
+import pytest
+
+import resync
+from resync.testing import FakeConnector, FakeCursor, get_term_name
+
+
+class Responder:
+    """
+    Answers changes queries with endless cursors over `changes` (kept in `cursors`, newest last), and other queries
+    with `results[term name]`, called with the query if it's callable.  The queries are kept in `queries`.
+    """
+
+    def __init__(self):
+        self.changes = []
+        self.cursors = []
+        self.results = {}
+        self.queries = []
+
+    def __call__(self, query, options):
+        self.queries.append(query)
+        term_name = get_term_name(query)
+        if term_name == 'CHANGES':
+            cursor = FakeCursor(list(self.changes), endless=True)
+            self.cursors.append(cursor)
+            return cursor
+        result = self.results[term_name]
+        return result(query) if callable(result) else result
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def db(loop):
+    """
+    Sets resync up with connections answered by a Responder, and tears it down after the test.
+    """
+    responder = Responder()
+    with FakeConnector(responder):
+        resync.setup({'db': 'test'})
+        try:
+            yield responder
+        finally:
+            loop.run_until_complete(resync.teardown())
+
+
+def get_term_names(query) -> list:
+    """
+    The names of the terms of a chained query, from the table to the outermost, e.g. ['TABLE', 'FILTER', 'COUNT'].
+    """
+    names = []
+    while get_term_name(query) is not None:
+        names.append(get_term_name(query))
+        query = query[1][0] if len(query) > 1 and query[1] else None
+    return names[::-1]
+
+
+async def settle():
+    """
+    Let the other tasks run until they are all waiting.
+    """
+    for _ in range(20):
+        await asyncio.sleep(0)
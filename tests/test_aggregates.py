@@ -0,0 +1,59 @@
+import pytest
+
+from resync import fields
+from resync.aggregates import Avg, Count, Max, Min, Sum
+from resync.models import Model
+
+from conftest import get_term_names
+
+
+class WeighedWidget(Model):
+    id = fields.StrField()
+    owner = fields.StrField()
+    weight = fields.FloatField()
+
+
+def test_count(loop, db):
+    db.results['COUNT'] = 3
+    assert loop.run_until_complete(WeighedWidget.objects.filter(owner='foo').count()) == 3
+    assert get_term_names(db.queries[-1]) == ['TABLE', 'FILTER', 'COUNT']
+
+
+@pytest.mark.parametrize('aggregate, term_names', [
+    (Count('weight'), ['TABLE', 'HAS_FIELDS', 'COUNT']),
+    (Sum('weight'), ['TABLE', 'HAS_FIELDS', 'SUM']),
+    (Avg('weight'), ['TABLE', 'HAS_FIELDS', 'AVG', 'DEFAULT']),
+    (Min('weight'), ['TABLE', 'HAS_FIELDS', 'GET_FIELD', 'MIN', 'DEFAULT']),
+    (Max('weight'), ['TABLE', 'HAS_FIELDS', 'GET_FIELD', 'MAX', 'DEFAULT']),
+])
+def test_aggregates_skip_documents_without_the_field(loop, db, aggregate, term_names):
+    db.results[term_names[-1]] = 2
+    assert loop.run_until_complete(WeighedWidget.objects.aggregate(value=aggregate)) == {'value': 2}
+    assert get_term_names(db.queries[-1]) == term_names
+
+
+def test_min_decodes_the_value_like_the_field(loop, db):
+    db.results['DEFAULT'] = 2
+    assert loop.run_until_complete(WeighedWidget.objects.aggregate(lightest=Min('weight'))) == {'lightest': 2.0}
+
+
+def test_aggregate_rejects_unknown_fields(loop, db):
+    with pytest.raises(ValueError):
+        loop.run_until_complete(WeighedWidget.objects.aggregate(total=Sum('colour')))
+
+
+def test_grouped_aggregates(loop, db):
+    def ungroup(query):
+        if 'SUM' in get_term_names(query):
+            return [{'group': 'foo', 'reduction': 3.0}]
+        if 'COUNT' in get_term_names(query):
+            return [{'group': 'foo', 'reduction': 2}, {'group': 'bar', 'reduction': 1}]
+        # Avg's sum and count of the values
+        return [{'group': 'foo', 'reduction': [3.0, 2]}, {'group': 'bar', 'reduction': [0, 0]}]
+
+    db.results['UNGROUP'] = ungroup
+    groups = loop.run_until_complete(
+        WeighedWidget.objects.group_by('owner').aggregate(total=Sum('weight'), n=Count(), average=Avg('weight')))
+    assert groups == {'foo': {'total': 3.0, 'n': 2, 'average': 1.5}, 'bar': {'total': 0, 'n': 1, 'average': None}}
+    sum_query, = [query for query in db.queries if 'SUM' in get_term_names(query)]
+    assert get_term_names(sum_query) == ['TABLE', 'GROUP', 'HAS_FIELDS', 'SUM', 'UNGROUP']
@@ -0,0 +1,65 @@
+import resync
+from resync import fields
+from resync.cache import CachedManager
+from resync.connection import connection_pool
+from resync.models import Model
+
+from conftest import settle
+
+
+class CachedWidget(Model):
+    objects = CachedManager()
+
+    id = fields.StrField()
+    name = fields.StrField()
+
+
+def test_get_is_cached_and_refreshed_by_changes(loop, db):
+    async def scenario():
+        db.results['GET'] = {'id': '1', 'name': 'foo'}
+        await CachedWidget.objects.get(id='1')
+        await settle()
+        assert CachedWidget.objects.stats().live
+        assert (await CachedWidget.objects.get(id='1')).name == 'foo'
+        del db.results['GET']
+        assert (await CachedWidget.objects.get(id='1')).name == 'foo'
+        db.cursors[0].push({'old_val': {'id': '1', 'name': 'foo'}, 'new_val': {'id': '1', 'name': 'bar'}})
+        await settle()
+        assert (await CachedWidget.objects.get(id='1')).name == 'bar'
+        assert CachedWidget.objects.stats()[:2] == (2, 2)  # hits, misses
+
+    loop.run_until_complete(scenario())
+
+
+def test_documents_fetched_before_the_changefeed_is_live_arent_cached(loop, db):
+    async def scenario():
+        db.results['GET'] = {'id': '1', 'name': 'foo'}
+        await CachedWidget.objects.get(id='1')
+        await settle()
+        assert CachedWidget.objects.stats().live
+        # Changes made before the changefeed started aren't sent, the document may have changed since it was fetched
+        assert CachedWidget.objects.stats().size == 0
+
+    loop.run_until_complete(scenario())
+
+
+def test_stop_closes_the_changefeed(loop, db):
+    async def scenario():
+        db.results['GET'] = {'id': '1', 'name': 'foo'}
+        await CachedWidget.objects.get(id='1')
+        await CachedWidget.objects.stop()
+        assert db.cursors[0].closed
+        assert connection_pool.stats().in_use == 0
+        assert CachedWidget.objects.stats().size == 0
+
+    loop.run_until_complete(scenario())
+
+
+def test_teardown_closes_the_changefeed(loop, db):
+    async def scenario():
+        db.results['GET'] = {'id': '1', 'name': 'foo'}
+        await CachedWidget.objects.get(id='1')
+        await resync.teardown()
+        assert db.cursors[0].closed
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,30 @@
+from array import array
+
+from resync import fields
+from resync.columns import DictionaryColumn, get_column_builders
+from resync.models import Model
+
+
+class ExportedWidget(Model):
+    id = fields.StrField()
+    colour = fields.StrField()
+    weight = fields.FloatField()
+
+
+def build_columns(field_names, documents, **options):
+    builders = get_column_builders(ExportedWidget, field_names, **options)
+    for builder in builders:
+        builder.extend(documents)
+    return [builder.column for builder in builders]
+
+
+def test_nulls_become_nan_and_minus_one():
+    weights, colours = build_columns(['weight', 'colour'], [{'weight': 1.5, 'colour': 'red'}, {}], encode=['colour'])
+    assert weights[0] == 1.5 and weights[1] != weights[1]
+    assert colours == DictionaryColumn(array('i', [0, -1]), ['red'])
+
+
+def test_fill_applies_to_encoded_columns():
+    colours, = build_columns(['colour'], [{'colour': 'red'}, {'colour': None}, {'colour': 'none'}],
+                             encode=['colour'], fill={'colour': 'none'})
+    assert colours == DictionaryColumn(array('i', [0, 1, 1]), ['red', 'none'])
@@ -0,0 +1,78 @@
+import pytest
+
+from resync import fields
+from resync.connection import connection_pool
+from resync.hub import DISCONNECT, SlowConsumerError, changefeed_hub
+from resync.models import Model
+
+from conftest import settle
+
+
+class HubWidget(Model):
+    id = fields.StrField()
+    name = fields.StrField()
+
+
+def widget_change(id, name):
+    return {'old_val': None, 'new_val': {'id': id, 'name': name}}
+
+
+def test_subscribers_share_a_feed(loop, db):
+    async def scenario():
+        first = changefeed_hub.subscribe(HubWidget.objects.all())
+        second = changefeed_hub.subscribe(HubWidget.objects.all())
+        await settle()
+        assert len(db.cursors) == 1
+        db.cursors[0].push(widget_change('1', 'foo'))
+        for subscription in (first, second):
+            widget, diff = await subscription.__anext__()
+            assert (widget.id, widget.name) == ('1', 'foo')
+        first.close()
+        second.close()
+
+    loop.run_until_complete(scenario())
+
+
+def test_feed_closes_its_cursor_when_the_last_subscriber_leaves(loop, db):
+    async def scenario():
+        first = changefeed_hub.subscribe(HubWidget.objects.all())
+        second = changefeed_hub.subscribe(HubWidget.objects.all())
+        await settle()
+        cursor, = db.cursors
+        first.close()
+        await settle()
+        assert not cursor.closed
+        second.close()
+        await settle()
+        assert cursor.closed
+        assert changefeed_hub.stats().feeds == 0
+        assert connection_pool.stats().in_use == 0
+
+    loop.run_until_complete(scenario())
+
+
+def test_close_ends_subscriptions_and_closes_cursors(loop, db):
+    async def scenario():
+        subscription = changefeed_hub.subscribe(HubWidget.objects.all())
+        await settle()
+        await changefeed_hub.close()
+        with pytest.raises(StopAsyncIteration):
+            await subscription.__anext__()
+        assert db.cursors[0].closed
+        assert connection_pool.stats().in_use == 0
+
+    loop.run_until_complete(scenario())
+
+
+def test_disconnected_subscriber_reads_queued_changes_first(loop, db):
+    async def scenario():
+        subscription = changefeed_hub.subscribe(HubWidget.objects.all(), maxsize=2, policy=DISCONNECT)
+        await settle()
+        db.cursors[0].push(*[widget_change(str(i), 'foo') for i in range(3)])
+        await settle()
+        assert changefeed_hub.stats().disconnected == 1
+        assert [(await subscription.__anext__())[0].id for _ in range(2)] == ['0', '1']
+        with pytest.raises(SlowConsumerError):
+            await subscription.__anext__()
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,54 @@
+import asyncio
+
+import resync
+from resync import fields
+from resync.hub import changefeed_hub
+from resync.listener import ChangeListener
+from resync.models import Model
+
+from conftest import settle
+
+
+class ListenedWidget(Model):
+    id = fields.StrField()
+    name = fields.StrField()
+
+
+def test_callbacks_get_changes(loop, db):
+    async def scenario():
+        received = []
+
+        async def callback(widget, diff):
+            received.append(widget.name)
+
+        listener = asyncio.ensure_future(ChangeListener(ListenedWidget.objects.all(), callback).listen())
+        await settle()
+        db.cursors[0].push(*[{'old_val': None, 'new_val': {'id': str(i), 'name': str(i)}} for i in range(3)])
+        await settle()
+        assert received == ['0', '1', '2']
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+
+    loop.run_until_complete(scenario())
+
+
+def test_shared_listener_stops_on_teardown(loop, db):
+    async def scenario():
+        received = []
+
+        async def callback(widget, diff):
+            received.append(widget.name)
+
+        listener = ChangeListener(ListenedWidget.objects.all(), callback, shared=True)
+        listening = asyncio.ensure_future(listener.listen())
+        await settle()
+        assert changefeed_hub.stats().feeds == 1
+        db.cursors[0].push({'old_val': None, 'new_val': {'id': '1', 'name': 'foo'}})
+        await settle()
+        await resync.teardown()
+        await asyncio.wait_for(listening, 1)
+        assert received == ['foo']
+        assert changefeed_hub.stats().feeds == 0
+        assert len(db.cursors) == 1 and db.cursors[0].closed
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,54 @@
+import itertools
+
+import pytest
+
+import resync
+from resync import fields
+from resync.models import Model
+
+
+class CreatedWidget(Model):
+    track_changes = True
+
+    id = fields.StrField()
+    name = fields.StrField()
+
+
+class UnindexedWidget(Model):
+    id = fields.StrField()
+
+
+def insert_result(ids):
+    def result(query):
+        n_documents = len(query[1][1][1])
+        return {'errors': 0, 'inserted': n_documents, 'generated_keys': [next(ids) for _ in range(n_documents)]}
+    return result
+
+
+def test_bulk_create_sets_ids_and_snapshots(loop, db):
+    async def scenario():
+        db.results['INSERT'] = insert_result(map(str, itertools.count()))
+        async with resync.identity_scope():
+            widgets = await CreatedWidget.objects.bulk_create(
+                [CreatedWidget(name='foo'), CreatedWidget(name='bar'), CreatedWidget(name='baz')], batch_size=2)
+            assert [widget.id for widget in widgets] == ['0', '1', '2']
+            assert widgets[1]._snapshot == {'id': '1', 'name': 'bar'}
+            assert await CreatedWidget.objects.get(id='2') is widgets[2]
+
+    loop.run_until_complete(scenario())
+
+
+def test_bulk_create_rejects_negative_batch_size(loop, db):
+    with pytest.raises(ValueError):
+        loop.run_until_complete(CreatedWidget.objects.bulk_create([CreatedWidget(name='foo')], batch_size=-1))
+
+
+def test_bulk_update_rejects_negative_batch_size(loop, db):
+    with pytest.raises(ValueError):
+        loop.run_until_complete(CreatedWidget.objects.bulk_update([CreatedWidget(id='1', name='foo')], ['name'],
+                                                                  batch_size=-1))
+
+
+def test_ensure_indexes_skips_models_without_indexes(loop, db):
+    # No responses: any query would fail
+    loop.run_until_complete(UnindexedWidget.objects.ensure_indexes())
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from resync.connection import ConnectionPool, ConnectionPoolTimeout
+from resync.testing import FakeConnector
+
+from conftest import settle
+
+
+@pytest.fixture
+def pool(loop):
+    pool = ConnectionPool()
+    with FakeConnector(lambda query, options: None, pool=pool):
+        pool.set_config({'db': 'test'}, max_size=1, acquire_timeout=0.01)
+        try:
+            yield pool
+        finally:
+            loop.run_until_complete(pool.teardown())
+
+
+def test_waiters_get_returned_connections_in_order(loop, pool):
+    async def scenario():
+        conn = await pool.get_conn()
+        first = asyncio.ensure_future(pool.get_conn(timeout=1))
+        second = asyncio.ensure_future(pool.get_conn(timeout=1))
+        await settle()
+        assert pool.stats().waiters == 2
+        await pool.put_conn(conn)
+        assert await first is conn
+        assert not second.done()
+        await pool.put_conn(conn)
+        assert await second is conn
+        stats = pool.stats()
+        assert (stats.size, stats.waiters, stats.acquired, stats.waited, stats.opened) == (1, 0, 3, 2, 1)
+
+    loop.run_until_complete(scenario())
+
+
+def test_get_conn_times_out_after_acquire_timeout(loop, pool):
+    async def scenario():
+        conn = await pool.get_conn()
+        with pytest.raises(ConnectionPoolTimeout):
+            await pool.get_conn()
+        stats = pool.stats()
+        assert (stats.timeouts, stats.waiters, stats.in_use) == (1, 0, 1)
+        await pool.put_conn(conn)
+        assert await pool.get_conn() is conn
+
+    loop.run_until_complete(scenario())
+
+
+def test_cancelled_waiter_gives_back_the_connection_it_was_handed(loop, pool):
+    async def scenario():
+        conn = await pool.get_conn()
+        waiter = asyncio.ensure_future(pool.get_conn(timeout=1))
+        await settle()
+        await pool.put_conn(conn)  # Handed to the waiter, which is cancelled before it gets to run
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await settle()
+        stats = pool.stats()
+        assert (stats.in_use, stats.idle) == (0, 1)
+        assert await pool.get_conn(timeout=0) is conn
+
+    loop.run_until_complete(scenario())
+
+
+def test_discarded_connection_frees_a_slot_for_a_waiter(loop, pool):
+    async def scenario():
+        conn = await pool.get_conn()
+        waiter = asyncio.ensure_future(pool.get_conn(timeout=1))
+        await settle()
+        await pool.discard_conn(conn)
+        new_conn = await waiter
+        assert new_conn is not conn and new_conn.is_open() and not conn.is_open()
+        assert pool.stats().size == 1
+
+    loop.run_until_complete(scenario())
+
+
+def test_teardown_cancels_waiters(loop, pool):
+    async def scenario():
+        await pool.get_conn()
+        waiter = asyncio.ensure_future(pool.get_conn(timeout=1))
+        await settle()
+        await pool.teardown()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,67 @@
+from resync import fields
+from resync.connection import connection_pool
+from resync.models import Model
+from resync.testing import FakeCursor
+
+from conftest import settle
+
+
+class ReplicatedWidget(Model):
+    id = fields.StrField()
+    name = fields.StrField()
+    score = fields.Field()
+    level = fields.Field(index=True)
+
+
+def initial_changes(*documents):
+    return [{'new_val': document} for document in documents] + [{'state': 'ready'}]
+
+
+def test_stop_closes_the_changefeed(loop, db):
+    async def scenario():
+        db.changes = initial_changes({'id': '1', 'name': 'foo'})
+        replica = ReplicatedWidget.objects.replicate()
+        await replica.wait_ready(1)
+        widget = await ReplicatedWidget.objects.get(id='1')
+        assert widget.name == 'foo'
+        assert replica.stats().local_reads == 1
+        await replica.stop()
+        await settle()
+        assert db.cursors[0].closed
+        assert connection_pool.stats().in_use == 0
+
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        ReplicatedWidget.objects.replica = None
+
+
+def test_filters_dont_compare_booleans_as_numbers(loop, db):
+    async def scenario():
+        db.changes = initial_changes({'id': '1', 'score': 1}, {'id': '2', 'score': True})
+        replica = ReplicatedWidget.objects.replicate()
+        await replica.wait_ready(1)
+        assert [widget.id for widget in await ReplicatedWidget.objects.filter(score__ne=1)] == ['2']
+        assert [widget.id for widget in await ReplicatedWidget.objects.filter(score__eq=True)] == ['2']
+        # Ordered by type in ReQL, so left to the database
+        db.results['FILTER'] = FakeCursor([{'id': '1', 'score': 1}])
+        assert [widget.id for widget in await ReplicatedWidget.objects.filter(score__lt=2)] == ['1']
+        assert replica.stats().fallbacks == 1
+
+        # Nor in the indexes
+        db.changes = initial_changes({'id': '1', 'level': 1}, {'id': '2', 'level': True})
+        await replica.stop()
+        replica = ReplicatedWidget.objects.replicate()
+        await replica.wait_ready(1)
+        stats = replica.stats()
+        db.results['GET_ALL'] = FakeCursor([{'id': '2', 'level': True}])
+        assert [widget.id for widget in await ReplicatedWidget.objects.filter(level=True)] == ['2']
+        db.results['BETWEEN'] = FakeCursor([{'id': '1', 'level': 1}])
+        assert [widget.id for widget in await ReplicatedWidget.objects.filter(level__ge=0)] == ['1']
+        assert replica.stats().fallbacks == stats.fallbacks + 2
+        assert replica.stats().local_reads == stats.local_reads
+
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        ReplicatedWidget.objects.replica = None